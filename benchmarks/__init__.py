@@ -0,0 +1 @@
+"""Benchmarks for the txes2 client's hot paths."""
@@ -0,0 +1,4 @@
+from .scenarios import main
+
+
+main()
@@ -0,0 +1,266 @@
+"""
+An in-process Elasticsearch stand-in built on ``twisted.web``.
+
+It implements enough of the REST API for the client's hot paths (``_bulk``,
+``_search``, ``_search/scroll``, ``_mget``, ``_count``, ``_nodes`` and
+document CRUD) with a configurable response latency and payload size.
+Search and scroll pages are generated rather than stored, and encoded once
+per page size, so the server spends as little of the shared CPU as
+possible.
+"""
+
+import itertools
+import json
+import urlparse
+import zlib
+
+from urllib import unquote
+
+from twisted.internet import defer, reactor
+from twisted.protocols import policies
+from twisted.web import resource, server
+
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class FakeElasticsearch(resource.Resource):
+
+    """
+    A single fake Elasticsearch node.
+
+    :param float latency: seconds to wait before answering each request.
+    :param int doc_size: size in bytes of each generated document body.
+    :param int total_hits: number of documents every search matches.
+    """
+
+    isLeaf = True
+
+    def __init__(self, latency=0, doc_size=200, total_hits=10000,
+                 clock=reactor):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.doc_size = doc_size
+        self.total_hits = total_hits
+        self.clock = clock
+        self.port = None
+        self.factory = None
+        self.requests = 0
+        self.docs = {}
+        self.scrolls = {}
+        self._ids = itertools.count(1)
+        self._pages = {}
+
+    def listen(self, port=0, interface='127.0.0.1'):
+        """Start listening, returning the ``host:port`` to connect to."""
+        self.factory = policies.WrappingFactory(server.Site(self))
+        self.port = reactor.listenTCP(port, self.factory, interface=interface)
+        return '{}:{}'.format(interface, self.port.getHost().port)
+
+    def disconnect(self):
+        """Abort every open client connection."""
+        for connection in list(self.factory.protocols):
+            connection.transport.abortConnection()
+
+    def stop(self):
+        d = defer.maybeDeferred(self.port.stopListening)
+        self.disconnect()
+        return d
+
+    def render(self, request):
+        self.requests += 1
+        status, result = self.respond(request)
+        self.send(request, status, self.encode(request, result), self.latency)
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        """Return the status and response body for ``request``."""
+        body = request.content.read()
+        if request.getHeader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, _GZIP_WBITS)
+
+        try:
+            return self.handle(request, body)
+        except ValueError as e:
+            return 400, {
+                'error': {'type': 'parse_exception', 'reason': str(e)},
+                'status': 400}
+
+    def encode(self, request, result):
+        """Serialize ``result``, gzipping it if the client accepts it."""
+        if isinstance(result, unicode):
+            result = result.encode('utf-8')
+        elif not isinstance(result, bytes):
+            result = json.dumps(result)
+
+        request.setHeader('content-type', 'application/json; charset=UTF-8')
+        if 'gzip' in (request.getHeader('accept-encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+            result = compressor.compress(result) + compressor.flush()
+            request.setHeader('content-encoding', 'gzip')
+        return result
+
+    def send(self, request, status, data, latency=0):
+        """Write a response, ``latency`` seconds from now."""
+        def write():
+            if not request._disconnected:
+                request.setResponseCode(status)
+                request.write(data)
+                request.finish()
+
+        if latency:
+            self.clock.callLater(latency, write)
+        else:
+            write()
+
+    def handle(self, request, body):
+        """Route a request, returning the status and response body."""
+        method = request.method
+        path = [unquote(c) for c in request.path.split('/') if c]
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(
+            urlparse.urlparse(request.uri).query).items())
+
+        if not path:
+            return 200, {
+                'name': 'fake', 'cluster_name': 'fake',
+                'version': {'number': '5.0.0'},
+                'tagline': 'You Know, for Search'}
+
+        if path[0] == '_nodes':
+            return 200, self.nodes()
+        if path[0] == '_bulk':
+            return 200, self.bulk(body)
+        if path[0] == '_mget':
+            return 200, self.mget(json.loads(body))
+        if path[:2] == ['_search', 'scroll']:
+            query = json.loads(body) if body else {}
+            if method == 'DELETE':
+                for scroll_id in query.get('scroll_id', []):
+                    self.scrolls.pop(scroll_id, None)
+                return 200, {'succeeded': True}
+            return self.scroll(query.get('scroll_id'))
+
+        endpoint = path[-1]
+        if endpoint == '_search':
+            query = json.loads(body) if body else {}
+            return 200, self.search(query, params)
+        if endpoint == '_count':
+            return 200, {'count': self.total_hits, '_shards': self._shards()}
+        if endpoint in ('_refresh', '_flush'):
+            return 200, {'_shards': self._shards()}
+        if endpoint == '_update' and len(path) == 4:
+            return self.update(path[:3], json.loads(body))
+        if len(path) in (2, 3) and not endpoint.startswith('_'):
+            return self.document(method, path, body)
+        if len(path) == 1 and method in ('PUT', 'DELETE'):
+            return 200, {'acknowledged': True}
+
+        return 404, {'error': 'no handler found', 'status': 404}
+
+    def nodes(self):
+        address = 'inet[/127.0.0.1:{}]'.format(self.port.getHost().port)
+        return {'cluster_name': 'fake',
+                'nodes': {'fake-node': {'http_address': address}}}
+
+    def bulk(self, body):
+        items = []
+        lines = iter(body.splitlines())
+        for line in lines:
+            if not line:
+                continue
+            action = json.loads(line)
+            op, meta = action.items()[0]
+            key = (meta.get('_index'), meta.get('_type'),
+                   meta.get('_id') or str(next(self._ids)))
+            if op == 'delete':
+                found = self.docs.pop(key, None) is not None
+                items.append({op: {
+                    '_index': key[0], '_type': key[1], '_id': key[2],
+                    'status': 200 if found else 404}})
+                continue
+            self.docs[key] = next(lines)
+            items.append({op: {
+                '_index': key[0], '_type': key[1], '_id': key[2],
+                '_version': 1, 'status': 201}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def mget(self, query):
+        docs = []
+        for doc in query.get('docs', []):
+            key = (doc['_index'], doc['_type'], str(doc['_id']))
+            source = self.docs.get(key)
+            result = {'_index': key[0], '_type': key[1], '_id': key[2],
+                      'found': source is not None}
+            if source is not None:
+                result['_source'] = json.loads(source)
+            docs.append(result)
+        return {'docs': docs}
+
+    def search(self, query, params):
+        size = int(query.get('size', params.get('size', 10)))
+        if 'scroll' not in params:
+            return self._page(size)
+
+        scroll_id = 'scroll-{}'.format(next(self._ids))
+        self.scrolls[scroll_id] = [size, size]
+        return self._page(size, scroll_id)
+
+    def scroll(self, scroll_id):
+        if scroll_id not in self.scrolls:
+            return 404, {'error': {'type': 'search_context_missing_exception'},
+                         'status': 404}
+
+        size, served = self.scrolls[scroll_id]
+        count = max(0, min(size, self.total_hits - served))
+        self.scrolls[scroll_id][1] = served + count
+        return 200, self._page(count, scroll_id)
+
+    def document(self, method, path, body):
+        if len(path) == 2:
+            path = path + [str(next(self._ids))]
+        key = tuple(path)
+
+        if method == 'GET':
+            source = self.docs.get(key)
+            if source is None:
+                return 404, {'_index': key[0], '_type': key[1],
+                             '_id': key[2], 'found': False}
+            return 200, {'_index': key[0], '_type': key[1], '_id': key[2],
+                         'found': True, '_source': json.loads(source)}
+
+        if method == 'DELETE':
+            found = self.docs.pop(key, None) is not None
+            return 200 if found else 404, {'found': found, '_id': key[2]}
+
+        created = key not in self.docs
+        self.docs[key] = body
+        return 201 if created else 200, {
+            '_index': key[0], '_type': key[1], '_id': key[2],
+            '_version': 1, 'created': created}
+
+    def update(self, key, command):
+        key = tuple(key)
+        source = json.loads(self.docs.get(key, '{}'))
+        source.update(command.get('doc', {}))
+        self.docs[key] = json.dumps(source)
+        return 200, {'_index': key[0], '_type': key[1], '_id': key[2],
+                     '_version': 2}
+
+    def _page(self, size, scroll_id=None):
+        """Return an encoded search response with ``size`` hits."""
+        if size not in self._pages:
+            hit = json.dumps({
+                '_index': 'bench', '_type': 'doc', '_id': '1', '_score': 1.0,
+                '_source': {'body': 'x' * self.doc_size}})
+            self._pages[size] = (
+                '{"took":1,"timed_out":false,"_shards":%s,'
+                '"hits":{"total":%d,"max_score":1.0,"hits":[%s]}' % (
+                    json.dumps(self._shards()), self.total_hits,
+                    ','.join([hit] * size)))
+        page = self._pages[size]
+        if scroll_id is None:
+            return page + '}'
+        return page + ',"_scroll_id":"%s"}' % scroll_id
+
+    def _shards(self):
+        return {'total': 1, 'successful': 1, 'failed': 0}
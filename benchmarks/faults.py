@@ -0,0 +1,335 @@
+"""
+Failover benchmarks against a cluster of fake nodes that misbehave on cue.
+
+A :class:`FakeCluster` runs several :class:`FaultyNode` servers. While a
+steady search load runs against the cluster, one node is failed in one of
+the :data:`FAULTS` and later healed. Each run reports, as a JSON line, the
+throughput before and during the fault, the share of throughput lost, how
+long the client took to route around the failed node, how long the healed
+node took to receive traffic again, and the client's error, retry and
+dead node counters.
+
+Run with ``python -m benchmarks.faults`` (see ``--help``).
+"""
+
+import argparse
+import collections
+import json
+import platform
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web import server
+from twisted.web.client import HTTPConnectionPool
+
+from txes2.elasticsearch import Elasticsearch
+
+from .fake_server import FakeElasticsearch
+from .scenarios import git_commit, percentile
+
+
+#: Fault modes, mapped to the arguments given to :meth:`FaultyNode.fail`.
+FAULTS = collections.OrderedDict([
+    ('refuse', ('refuse', {})),
+    ('hang', ('hang', {})),
+    ('503', ('error', {'status': 503})),
+    ('504', ('error', {'status': 504})),
+    ('429', ('error', {'status': 429})),
+    ('drop', ('drop', {})),
+    ('slow', ('slow', {})),
+])
+
+
+def _error_body(status):
+    if status == 429:
+        return {'error': {
+            'type': 'es_rejected_execution_exception',
+            'reason': 'rejected execution of search on EsThreadPoolExecutor'},
+            'status': 429}
+    return {'error': 'fault injected', 'status': status}
+
+
+class FaultyNode(FakeElasticsearch):
+
+    """
+    A fake node that can be told to fail.
+
+    The modes of :meth:`fail` are:
+
+    - ``refuse``: close the listening port and every open connection.
+    - ``hang``: accept requests and never answer them.
+    - ``error``: answer every request with ``status``.
+    - ``drop``: send the headers and half the body, then reset the
+      connection.
+    - ``slow``: add ``delay`` seconds to every response.
+    """
+
+    def __init__(self, **kwargs):
+        FakeElasticsearch.__init__(self, **kwargs)
+        self.fault = None
+        self.fault_status = 503
+        self.fault_delay = 0
+        self.address = None
+        self.healed_at = None
+        self.rejoined_at = None
+
+    def listen(self, port=0, interface='127.0.0.1'):
+        self.address = (port, interface)
+        server = FakeElasticsearch.listen(self, port, interface)
+        self.address = (self.port.getHost().port, interface)
+        return server
+
+    def fail(self, mode, status=503, delay=0.5):
+        """Start failing in ``mode``."""
+        self.fault = mode
+        self.fault_status = status
+        self.fault_delay = delay
+        if mode == 'refuse':
+            return self.stop()
+        return defer.succeed(None)
+
+    def heal(self):
+        """Stop failing."""
+        fault, self.fault = self.fault, None
+        self.healed_at = time.time()
+        self.rejoined_at = None
+        if fault == 'refuse':
+            self.listen(*self.address)
+        elif fault == 'hang':
+            self.disconnect()
+
+    def render(self, request):
+        self.requests += 1
+        if self.fault == 'hang':
+            return server.NOT_DONE_YET
+
+        if self.fault == 'error':
+            body = self.encode(request, _error_body(self.fault_status))
+            self.send(request, self.fault_status, body)
+            return server.NOT_DONE_YET
+
+        status, result = self.respond(request)
+        data = self.encode(request, result)
+
+        if self.fault == 'drop':
+            request.setResponseCode(status)
+            request.setHeader('content-length', str(len(data)))
+            request.write(data[:len(data) // 2])
+            request.transport.abortConnection()
+            return server.NOT_DONE_YET
+
+        latency = self.latency
+        if self.fault == 'slow':
+            latency += self.fault_delay
+        elif self.healed_at is not None and self.rejoined_at is None:
+            self.rejoined_at = time.time()
+        self.send(request, status, data, latency)
+        return server.NOT_DONE_YET
+
+
+class FakeCluster(object):
+
+    """
+    ``size`` :class:`FaultyNode` servers.
+
+    Keyword arguments are passed to every node.
+    """
+
+    def __init__(self, size=3, **kwargs):
+        self.nodes = [FaultyNode(**kwargs) for _ in range(size)]
+        self.servers = []
+
+    def start(self):
+        """Start every node, returning their addresses."""
+        self.servers = [node.listen() for node in self.nodes]
+        return self.servers
+
+    def fail(self, index, mode, **kwargs):
+        return self.nodes[index].fail(mode, **kwargs)
+
+    def heal(self, index):
+        self.nodes[index].heal()
+
+    def stop(self):
+        return defer.gatherResults([
+            node.stop() for node in self.nodes
+            if node.port is not None and node.port.connected])
+
+
+@defer.inlineCallbacks
+def run_load(es, concurrency, duration, query):
+    """
+    Search from ``concurrency`` workers for ``duration`` seconds.
+
+    Returns a list of ``(finished, latency, error)`` tuples, one per
+    search, where ``error`` is the exception class name or None.
+    """
+    events = []
+    deadline = time.time() + duration
+
+    @defer.inlineCallbacks
+    def worker():
+        while time.time() < deadline:
+            start = time.time()
+            error = None
+            try:
+                yield es.search(query, cache_ttl=0)
+            except Exception as e:
+                error = type(e).__name__
+            now = time.time()
+            events.append((now, now - start, error))
+
+    yield defer.gatherResults([worker() for _ in range(concurrency)])
+    defer.returnValue(events)
+
+
+def summarize(events, start, options):
+    """Turn the events of a run into throughput and recovery figures."""
+    fault_at = start + options.fault_at
+    heal_at = start + options.heal_at
+    bucket = options.bucket
+
+    def rate(begin, end):
+        ok = sum(1 for t, _, e in events if begin <= t < end and e is None)
+        return ok / (end - begin)
+
+    baseline = rate(start + bucket, fault_at)
+    during = rate(fault_at, heal_at)
+
+    # The end of the last interval during the fault in which throughput was
+    # below 90% of the baseline.
+    recovery = 0
+    begin = fault_at
+    while begin < heal_at:
+        end = min(begin + bucket, heal_at)
+        if rate(begin, end) < 0.9 * baseline:
+            recovery = end - fault_at
+        begin = end
+
+    errors = collections.Counter(e for _, _, e in events if e is not None)
+    latencies = sorted(l for t, l, e in events
+                       if fault_at <= t < heal_at and e is None)
+    return {
+        'baseline_ops_per_sec': baseline,
+        'fault_ops_per_sec': during,
+        'throughput_lost': 1 - during / baseline if baseline else None,
+        'recovery_seconds': recovery,
+        'errors': dict(errors),
+        'fault_latency_ms': dict(
+            ('p{}'.format(p),
+             percentile(latencies, p) * 1000 if latencies else None)
+            for p in (50, 90, 99)),
+    }
+
+
+@defer.inlineCallbacks
+def run_fault(name, options):
+    """Run a search load while node 0 fails with fault ``name``."""
+    mode, kwargs = FAULTS[name]
+    cluster = FakeCluster(
+        options.nodes, latency=options.latency, total_hits=options.page_size)
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = options.concurrency
+    es = Elasticsearch(
+        cluster.start(), discover=False, timeout=options.timeout,
+        retry_time=options.retry_time, pool=pool,
+        health_check_interval=options.health_check_interval,
+        **options.client_kwargs)
+    query = {'query': {'match_all': {}}, 'size': options.page_size}
+
+    start = time.time()
+    reactor.callLater(
+        options.fault_at, cluster.fail, 0, mode, delay=options.slow_delay,
+        **kwargs)
+    reactor.callLater(options.heal_at, cluster.heal, 0)
+    try:
+        events = yield run_load(
+            es, options.concurrency, options.duration, query)
+    finally:
+        yield es.connection.close()
+        yield pool.closeCachedConnections()
+        yield cluster.stop()
+
+    result = summarize(events, start, options)
+    node = cluster.nodes[0]
+    counters = es.stats()['counters']
+    result.update({
+        'fault': name,
+        'nodes': options.nodes,
+        'concurrency': options.concurrency,
+        'rejoin_seconds': (node.rejoined_at - node.healed_at
+                           if node.rejoined_at else None),
+        'retries': counters.get('retries', 0),
+        'nodes_marked_dead': counters.get('nodes_marked_dead', 0),
+    })
+    defer.returnValue(result)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.faults',
+        description='Measure txes2 failover against misbehaving nodes.')
+    parser.add_argument('--fault', action='append', choices=list(FAULTS),
+                        help='fault to inject, may be repeated '
+                             '(default: all)')
+    parser.add_argument('--nodes', type=int, default=3,
+                        help='nodes in the cluster (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='concurrent searches (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=9,
+                        help='seconds per run (default: %(default)s)')
+    parser.add_argument('--fault-at', type=float, default=3,
+                        help='seconds before failing node 0 '
+                             '(default: %(default)s)')
+    parser.add_argument('--heal-at', type=float, default=6,
+                        help='seconds before healing node 0 '
+                             '(default: %(default)s)')
+    parser.add_argument('--bucket', type=float, default=0.25,
+                        help='resolution in seconds of the recovery time '
+                             '(default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='server latency in seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--slow-delay', type=float, default=0.5,
+                        help='latency added by the slow fault '
+                             '(default: %(default)s)')
+    parser.add_argument('--page-size', type=int, default=10,
+                        help='hits per search (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='client request timeout (default: %(default)s)')
+    parser.add_argument('--retry-time', type=float, default=1,
+                        help='seconds before retrying a dead node '
+                             '(default: %(default)s)')
+    parser.add_argument('--health-check-interval', type=float,
+                        help='probe dead nodes this often instead of '
+                             'retrying them with live traffic')
+    parser.add_argument('--selector', default='latency',
+                        help='node selector (default: %(default)s)')
+    options = parser.parse_args(argv)
+    options.client_kwargs = {'selector': options.selector}
+    return options
+
+
+@defer.inlineCallbacks
+def run(options, output=sys.stdout):
+    """Run the selected faults, writing one JSON line per result."""
+    results = []
+    tags = {'commit': git_commit(),
+            'python': platform.python_version()}
+    for name in options.fault or list(FAULTS):
+        result = yield run_fault(name, options)
+        result.update(tags)
+        output.write(json.dumps(result, sort_keys=True) + '\n')
+        output.flush()
+        results.append(result)
+    defer.returnValue(results)
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    task.react(lambda reactor: run(options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+End-to-end benchmarks of the client against :mod:`benchmarks.fake_server`.
+
+Each scenario runs ``requests`` operations spread over ``concurrency``
+workers and reports throughput and client-side latency percentiles as one
+JSON object per line, tagged with the commit being measured, so runs can be
+compared commit to commit.
+
+The server shares the reactor and the CPU with the client, so absolute
+numbers are only comparable between runs on the same machine.
+
+Run with ``python -m benchmarks`` (see ``--help``).
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web.client import HTTPConnectionPool
+
+from txes2.elasticsearch import Elasticsearch
+
+from .fake_server import FakeElasticsearch
+
+
+INDEX = 'bench'
+DOC_TYPE = 'doc'
+
+
+def percentile(values, percent):
+    """Return the ``percent`` percentile of the sorted list ``values``."""
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@defer.inlineCallbacks
+def run_concurrently(operation, requests, concurrency):
+    """
+    Call ``operation(i)`` for ``i`` in ``range(requests)`` from
+    ``concurrency`` workers, returning the sorted latency of every call.
+    """
+    latencies = []
+    work = iter(range(requests))
+
+    @defer.inlineCallbacks
+    def worker():
+        for i in work:
+            start = time.time()
+            yield operation(i)
+            latencies.append(time.time() - start)
+
+    yield defer.gatherResults(
+        [worker() for _ in range(concurrency)], consumeErrors=True)
+    defer.returnValue(sorted(latencies))
+
+
+class Scenario(object):
+
+    """
+    A benchmarked operation.
+
+    :param int items: documents (or hits) handled by each operation, used
+                      to report ``items_per_sec``.
+    """
+
+    name = None
+    items = 1
+
+    def __init__(self, es, options):
+        self.es = es
+        self.options = options
+
+    def setup(self):
+        return defer.succeed(None)
+
+    def operation(self, i):
+        raise NotImplementedError
+
+    def finish(self):
+        """Complete outstanding work, timed as part of the run."""
+        return defer.succeed(None)
+
+
+class BulkIndexScenario(Scenario):
+
+    """``index(bulk=True)``, flushed every ``bulk_size`` documents."""
+
+    name = 'bulk_index'
+
+    def __init__(self, es, options):
+        Scenario.__init__(self, es, options)
+        self.doc = {'body': 'x' * options.doc_size}
+
+    def operation(self, i):
+        return self.es.index(self.doc, INDEX, DOC_TYPE, id=i, bulk=True)
+
+    def finish(self):
+        return self.es.force_bulk()
+
+
+class BulkProcessorScenario(BulkIndexScenario):
+
+    """``BulkProcessor.index``, waiting on its backpressure."""
+
+    name = 'bulk_processor'
+
+    def __init__(self, es, options):
+        BulkIndexScenario.__init__(self, es, options)
+        self.processor = es.bulk_processor(
+            max_actions=options.bulk_size, max_concurrent_requests=2)
+
+    def operation(self, i):
+        return self.processor.index(self.doc, INDEX, DOC_TYPE, id=i)
+
+    def finish(self):
+        return self.processor.flush()
+
+
+class SearchScenario(Scenario):
+
+    """A ``search`` returning ``page_size`` hits."""
+
+    name = 'search'
+
+    def __init__(self, es, options):
+        Scenario.__init__(self, es, options)
+        self.items = options.page_size
+
+    def operation(self, i):
+        query = {'query': {'match_all': {}}, 'size': self.options.page_size}
+        return self.es.search(query, indexes=[INDEX], cache_ttl=0)
+
+
+class ScanScenario(Scenario):
+
+    """A ``scan`` followed by ``Scroller.next_page`` until exhausted."""
+
+    name = 'scan'
+
+    def __init__(self, es, options):
+        Scenario.__init__(self, es, options)
+        self.items = options.total_hits
+
+    @defer.inlineCallbacks
+    def operation(self, i):
+        query = {'query': {'match_all': {}}, 'size': self.options.page_size}
+        scroller = yield self.es.scan(query, indexes=[INDEX])
+        while scroller.results:
+            yield scroller.next_page()
+        yield scroller.delete()
+
+
+class MgetScenario(Scenario):
+
+    """An ``mget`` of ``page_size`` previously indexed documents."""
+
+    name = 'mget'
+
+    def __init__(self, es, options):
+        Scenario.__init__(self, es, options)
+        self.items = options.page_size
+
+    @defer.inlineCallbacks
+    def setup(self):
+        doc = {'body': 'x' * self.options.doc_size}
+        for i in range(self.options.page_size * 10):
+            self.es.index(doc, INDEX, DOC_TYPE, id=i, bulk=True)
+        yield self.es.force_bulk()
+
+    def operation(self, i):
+        start = i % 10 * self.options.page_size
+        ids = range(start, start + self.options.page_size)
+        return self.es.mget(ids, index=INDEX, doc_type=DOC_TYPE)
+
+
+SCENARIOS = dict((s.name, s) for s in (
+    BulkIndexScenario, BulkProcessorScenario, SearchScenario, ScanScenario,
+    MgetScenario))
+
+
+@defer.inlineCallbacks
+def run_scenario(scenario_class, concurrency, options):
+    """Run one scenario against a fresh server and client."""
+    fake = FakeElasticsearch(
+        latency=options.latency, doc_size=options.doc_size,
+        total_hits=options.total_hits)
+    server = fake.listen()
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = max(concurrency, 2)
+    es = Elasticsearch(
+        server, discover=False, bulk_size=options.bulk_size, pool=pool,
+        **options.client_kwargs)
+
+    scenario = scenario_class(es, options)
+    try:
+        yield scenario.setup()
+        fake.requests = 0
+        start = time.time()
+        latencies = yield run_concurrently(
+            scenario.operation, options.requests, concurrency)
+        yield scenario.finish()
+        elapsed = time.time() - start
+    finally:
+        yield pool.closeCachedConnections()
+        yield fake.stop()
+
+    defer.returnValue({
+        'scenario': scenario.name,
+        'concurrency': concurrency,
+        'requests': options.requests,
+        'server_requests': fake.requests,
+        'latency': options.latency,
+        'doc_size': options.doc_size,
+        'seconds': elapsed,
+        'ops_per_sec': options.requests / elapsed,
+        'items_per_sec': options.requests * scenario.items / elapsed,
+        'latency_ms': dict(
+            ('p{}'.format(p), percentile(latencies, p) * 1000)
+            for p in (50, 90, 99)),
+    })
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark txes2 against a fake Elasticsearch.')
+    parser.add_argument(
+        '--scenario', action='append', choices=sorted(SCENARIOS),
+        help='scenario to run, may be repeated (default: all)')
+    parser.add_argument(
+        '--concurrency', default='1,10,50',
+        help='comma separated concurrency levels (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='operations per run (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='server latency in seconds (default: 0)')
+    parser.add_argument('--doc-size', type=int, default=200,
+                        help='document size in bytes (default: %(default)s)')
+    parser.add_argument('--page-size', type=int, default=50,
+                        help='hits per page and ids per mget '
+                             '(default: %(default)s)')
+    parser.add_argument('--total-hits', type=int, default=1000,
+                        help='hits returned by each scan '
+                             '(default: %(default)s)')
+    parser.add_argument('--bulk-size', type=int, default=400,
+                        help='documents per bulk request '
+                             '(default: %(default)s)')
+    parser.add_argument('--codec', default='json',
+                        help='client codec (default: %(default)s)')
+    parser.add_argument('--compression', action='store_true',
+                        help='gzip request and response bodies')
+    options = parser.parse_args(argv)
+    options.concurrency = [int(c) for c in options.concurrency.split(',')]
+    options.client_kwargs = {
+        'codec': options.codec, 'compression': options.compression}
+    return options
+
+
+@defer.inlineCallbacks
+def run(options, output=sys.stdout):
+    """Run the selected scenarios, writing one JSON line per result."""
+    results = []
+    tags = {'commit': git_commit(),
+            'python': platform.python_version()}
+    for name in options.scenario or sorted(SCENARIOS):
+        for concurrency in options.concurrency:
+            result = yield run_scenario(SCENARIOS[name], concurrency, options)
+            result.update(tags)
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+            results.append(result)
+    defer.returnValue(results)
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    task.react(lambda reactor: run(options))
@@ -0,0 +1,91 @@
+"""
+Microbenchmark of per-request path and URL building.
+
+Compares the current ``make_path`` and base URL handling against the
+original implementation, which quoted every component and rebuilt the
+whole URL on every attempt.
+
+Run with ``python -m benchmarks.urls``.
+"""
+
+import json
+import sys
+import timeit
+import urllib
+
+from urllib import quote
+
+from txes2.connection_http import _path_suffix, HTTPConnection
+from txes2.utils import make_path
+
+
+SERVER = '10.0.0.1:9200'
+PARAMS = {'size': 10}
+
+
+def legacy_make_path(components):
+    return '/{}'.format(
+        '/'.join([quote(str(c), '') for c in components if c]))
+
+
+def legacy_prepare_url(server, path, params):
+    if not path.startswith('/'):
+        path = '/' + path
+
+    url = server + path
+
+    if params:
+        url = url + '?' + urllib.urlencode(params)
+
+    if not url.startswith(('http:', 'https:')):
+        url = "http://" + url
+
+    return url.encode('utf-8')
+
+
+def legacy_request(attempts):
+    path = legacy_make_path(['my_index', 'my_doc', '_search'])
+    for _ in range(attempts):
+        url = legacy_prepare_url(SERVER, path, PARAMS)
+    return url
+
+
+def current_request(connection, attempts):
+    path = make_path(['my_index', 'my_doc', '_search'])
+    suffix = _path_suffix(path, PARAMS)
+    for _ in range(attempts):
+        url = connection.base_url(SERVER) + suffix
+    return url
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    return {'benchmark': name, 'number': number,
+            'usec_per_call': seconds / number * 1e6}
+
+
+def main(number=100000):
+    connection = HTTPConnection()
+    connection.connect(SERVER)
+
+    results = [
+        bench('make_path.legacy',
+              lambda: legacy_make_path(['my_index', 'my_doc', 1]), number),
+        bench('make_path', lambda: make_path(['my_index', 'my_doc', 1]),
+              number),
+    ]
+    for attempts in (1, 3):
+        results.extend([
+            bench('request_url.legacy.attempts_{}'.format(attempts),
+                  lambda: legacy_request(attempts), number),
+            bench('request_url.attempts_{}'.format(attempts),
+                  lambda: current_request(connection, attempts), number),
+        ])
+
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ setup(
     packages=['txes2'],
     include_package_data=True,
     zip_safe=False,
-    install_requires=['Twisted', 'anyjson', 'treq'],
+    install_requires=['Twisted', 'treq'],
+    extras_require={'ujson': ['ujson']},
     classifiers=[
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python',
@@ -0,0 +1,40 @@
+"""Fixtures shared by the tests of code built on the client."""
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock, Cooperator
+
+from txes2.elasticsearch import Elasticsearch
+
+
+class FakeClientMixin(object):
+
+    """
+    A client answered by ``_execute`` instead of a server, and a clock.
+
+    ``setUp`` creates ``self.es``, whose requests are handed to
+    ``self._execute(method, path, body=None, params=None, **kwargs)``,
+    ``self.clock`` and ``self.cooperate``, a cooperator running one step
+    of each task per second of ``self.clock`` (see :meth:`_run_steps`).
+    Unless overridden, ``_execute`` answers every request with ``{}``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.es = self._client()
+        self.cooperate = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda step: self.clock.callLater(1, step)).cooperate
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        return succeed({})
+
+    def _client(self, server='localhost:9200', execute=None, **kwargs):
+        """Return a client answered by ``execute`` or ``self._execute``."""
+        es = Elasticsearch(server, discover=False, persistent=False, **kwargs)
+        es.connection.execute = execute or self._execute
+        return es
+
+    def _run_steps(self):
+        """Advance the clock until nothing is scheduled on it."""
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
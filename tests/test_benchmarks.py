@@ -0,0 +1,82 @@
+import io
+import json
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web.client import HTTPConnectionPool
+
+from benchmarks import faults, scenarios
+from txes2.elasticsearch import Elasticsearch
+from txes2.retry import RetryPolicy
+
+
+class ScenariosTest(unittest.TestCase):
+
+    def test_run_every_scenario(self):
+        options = scenarios.parse_args([
+            '--requests', '4', '--concurrency', '1,2', '--total-hits', '20',
+            '--page-size', '10', '--bulk-size', '3'])
+        output = io.BytesIO()
+        d = scenarios.run(options, output)
+
+        def check(results):
+            lines = [json.loads(l) for l in output.getvalue().splitlines()]
+            self.assertEqual(lines, results)
+            self.assertEqual(
+                [(r['scenario'], r['concurrency']) for r in results],
+                [(name, c) for name in sorted(scenarios.SCENARIOS)
+                 for c in (1, 2)])
+            by_name = dict((r['scenario'], r) for r in results)
+            self.assertEqual(by_name['bulk_index']['server_requests'], 2)
+            self.assertEqual(by_name['scan']['server_requests'], 16)
+            self.assertEqual(by_name['search']['server_requests'], 4)
+
+        d.addCallback(check)
+        return d
+
+
+class FakeClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = faults.FakeCluster(2)
+        pool = HTTPConnectionPool(reactor)
+        self.es = Elasticsearch(
+            self.cluster.start(), discover=False, timeout=1, pool=pool,
+            selector='round_robin', half_open_ratio=1,
+            retry_policy=RetryPolicy(backoff=0))
+        self.addCleanup(self.cluster.stop)
+        self.addCleanup(pool.closeCachedConnections)
+
+    @defer.inlineCallbacks
+    def check_failover(self, mode, **kwargs):
+        yield self.cluster.fail(0, mode, **kwargs)
+        for _ in range(4):
+            result = yield self.es.search({'size': 1}, cache_ttl=0)
+            self.assertEqual(len(result['hits']['hits']), 1)
+        self.assertEqual(
+            list(self.es.connection.servers), [self.cluster.servers[1]])
+
+    def test_refuse(self):
+        return self.check_failover('refuse')
+
+    def test_error(self):
+        return self.check_failover('error', status=503)
+
+    def test_drop(self):
+        return self.check_failover('drop')
+
+    def test_hang(self):
+        self.es.connection.servers.timeout = 0.2
+        return self.check_failover('hang')
+
+    @defer.inlineCallbacks
+    def test_heal(self):
+        yield self.cluster.fail(0, 'refuse')
+        yield self.es.search({}, cache_ttl=0)
+        self.cluster.heal(0)
+        self.es.connection.servers.revive(self.cluster.servers[0])
+        self.cluster.nodes[0].requests = 0
+        for _ in range(4):
+            yield self.es.search({}, cache_ttl=0)
+        self.assertTrue(self.cluster.nodes[0].requests > 0)
+        self.assertTrue(self.cluster.nodes[0].rejoined_at is not None)
@@ -0,0 +1,604 @@
+"""Tests for the bulk module."""
+
+import json
+import zlib
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txes2.bulk import (
+    AdaptiveBulkSizer, BulkBodyProducer, BulkBuffer, BulkItemError,
+    BulkProcessor, BulkResult, encode_bulk_action, expand_action,
+    make_bulk_action, MISSING_ITEM, send_bulk)
+from txes2.serializers import JSONCodec, RawJSON
+from txes2.metrics import Metrics
+from txes2.retry import RetryPolicy
+
+from .helpers import FakeClientMixin
+
+
+class BulkBufferTest(FakeClientMixin, TestCase):
+
+    """Tests for BulkBuffer and BulkBodyProducer."""
+
+    def test_encode_bulk_action(self):
+        self.assertEquals(
+            encode_bulk_action(JSONCodec(), {'delete': {'_id': 1}}),
+            ['{"delete":{"_id":1}}', '\n'])
+        chunks = encode_bulk_action(
+            JSONCodec(), {'index': {}}, {'name': u'caf\xe9'})
+        self.assertEquals(len(chunks), 4)
+        self.assertTrue(all(isinstance(c, bytes) for c in chunks))
+
+    def test_encode_bulk_action_strips_newlines_from_sources(self):
+        source = RawJSON(b'{\n  "text": "a\\nb",\n  "n": 1\n}\n')
+        chunks = encode_bulk_action(JSONCodec(), {'index': {}}, source)
+        self.assertEquals(chunks[2], b'{  "text": "a\\nb",  "n": 1}')
+        self.assertEquals(json.loads(chunks[2]), {'text': 'a\nb', 'n': 1})
+        self.assertEquals(b''.join(chunks).count(b'\n'), 2)
+
+    def test_encode_bulk_action_passes_serialized_sources_through(self):
+        source = '{"name":"raw"}'
+        chunks = encode_bulk_action(JSONCodec(), {'index': {}}, source)
+        self.assertTrue(chunks[2] is source)
+        self.assertEquals(
+            encode_bulk_action(JSONCodec(), {'index': {}}, u'{"n":1}')[2],
+            b'{"n":1}')
+
+    def test_take_respects_limits(self):
+        buf = BulkBuffer()
+        for i in range(4):
+            buf.append(i, ['x' * 10, '\n'])
+        self.assertEquals(buf.size, 44)
+
+        self.assertEquals([a for a, _ in buf.take(max_actions=3)], [0, 1, 2])
+        self.assertEquals(buf.size, 11)
+        self.assertEquals(len(buf), 1)
+
+        buf.append(4, ['y' * 50])
+        self.assertEquals([a for a, _ in buf.take(max_bytes=20)], [3])
+        self.assertEquals([a for a, _ in buf.take(max_bytes=20)], [4])
+        self.assertEquals(buf.size, 0)
+
+    def test_producer_writes_chunks_without_joining(self):
+        chunks = ['a' * 10, 'b' * 10, 'c']
+        producer = BulkBodyProducer(chunks, self.cooperate)
+        producer.write_size = 15
+        self.assertEquals(producer.length, 21)
+
+        consumer = StringTransport()
+        d = producer.startProducing(consumer)
+        self._run_steps()
+        self.assertEquals(consumer.value(), ''.join(chunks))
+        self.assertTrue(self.successResultOf(d) is None)
+
+        # Producing again, as a retry does, starts from the beginning.
+        consumer = StringTransport()
+        producer.startProducing(consumer)
+        self._run_steps()
+        self.assertEquals(consumer.value(), ''.join(chunks))
+
+    def test_producer_can_be_paused(self):
+        producer = BulkBodyProducer(['a' * 10, 'b' * 10], self.cooperate)
+        producer.write_size = 10
+        consumer = StringTransport()
+        producer.startProducing(consumer)
+        self.clock.advance(1)
+        self.assertEquals(consumer.value(), 'a' * 10)
+
+        producer.pauseProducing()
+        self.assertEquals(consumer.value(), 'a' * 10)
+        producer.resumeProducing()
+        self._run_steps()
+        self.assertEquals(consumer.value(), 'a' * 10 + 'b' * 10)
+
+    def test_producer_gzip(self):
+        producer = BulkBodyProducer(['{"a":1}\n'] * 100).gzip()
+        body = ''.join(producer.chunks)
+        self.assertEquals(producer.length, len(body))
+        self.assertEquals(
+            zlib.decompress(body, 16 + zlib.MAX_WBITS), '{"a":1}\n' * 100)
+
+
+class BulkProcessorTest(FakeClientMixin, TestCase):
+
+    """Tests for the BulkProcessor class."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.requests = []
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        d = Deferred()
+        self.requests.append((path, ''.join(body.chunks), d))
+        return d
+
+    def _processor(self, **kwargs):
+        kwargs.setdefault('clock', self.clock)
+        return self.es.bulk_processor(**kwargs)
+
+    def _actions(self, body):
+        return [json.loads(line) for line in body.splitlines()][::2]
+
+    def test_make_bulk_action(self):
+        self.assertEquals(
+            make_bulk_action('index', 'idx', 'doc', id=1, routing='r'),
+            {'index': {'_index': 'idx', '_type': 'doc', '_id': 1,
+                       '_routing': 'r'}})
+        self.assertEquals(
+            make_bulk_action('delete', 'idx', 'doc'),
+            {'delete': {'_index': 'idx', '_type': 'doc'}})
+
+    def test_bulk_processor_factory(self):
+        processor = self.es.bulk_processor(max_actions=10)
+        self.assertTrue(isinstance(processor, BulkProcessor))
+        self.assertTrue(processor.es is self.es)
+        self.assertEquals(processor.max_actions, 10)
+
+    def test_flushes_on_max_actions(self):
+        processor = self._processor(max_actions=2)
+        processor.index({'n': 1}, 'idx', 'doc', id=1)
+        self.assertEquals(self.requests, [])
+
+        processor.index({'n': 2}, 'idx', 'doc', id=2)
+        self.assertEquals(len(self.requests), 1)
+        path, body, _ = self.requests[0]
+        self.assertEquals(path, '/_bulk')
+        self.assertEquals(
+            [a['index']['_id'] for a in self._actions(body)], [1, 2])
+        self.assertTrue(body.endswith('\n'))
+        self.assertEquals(processor.size, 0)
+
+    def test_flushes_on_max_bytes(self):
+        processor = self._processor(max_bytes=100)
+        processor.index({'body': 'x' * 40}, 'idx', 'doc')
+        self.assertEquals(self.requests, [])
+        processor.index({'body': 'x' * 40}, 'idx', 'doc')
+        self.assertEquals(len(self.requests), 1)
+
+    def test_flushes_on_interval(self):
+        processor = self._processor(flush_interval=2)
+        processor.delete('idx', 'doc', 1)
+        self.clock.advance(1.5)
+        self.assertEquals(self.requests, [])
+        self.clock.advance(0.5)
+        self.assertEquals(len(self.requests), 1)
+        self.assertEquals(self.requests[0][1], json.dumps(
+            {'delete': {'_index': 'idx', '_type': 'doc', '_id': 1}},
+            separators=(',', ':')) + '\n')
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_limits_requests_in_flight_and_applies_backpressure(self):
+        processor = self._processor(max_actions=1, max_concurrent_requests=1)
+        first = processor.index({}, 'idx', 'doc', id=1)
+        self.assertEquals(len(self.requests), 1)
+        self.assertTrue(first.called)
+
+        second = processor.index({}, 'idx', 'doc', id=2)
+        self.assertEquals(len(self.requests), 1)
+        self.assertFalse(second.called)
+
+        self.requests[0][2].callback({'errors': False, 'items': []})
+        self.assertEquals(len(self.requests), 2)
+        self.assertTrue(second.called)
+
+    def test_batches_never_exceed_max_actions(self):
+        processor = self._processor(max_actions=2)
+        for i in range(5):
+            processor.index({}, 'idx', 'doc', id=i + 1)
+        self.requests[0][2].callback({})
+        self.assertEquals(
+            [len(self._actions(body)) for _, body, _ in self.requests],
+            [2, 2])
+        self.assertEquals(len(processor.buffer), 1)
+
+    def test_flush_waits_for_requests_in_flight(self):
+        responses = []
+        processor = self._processor(
+            max_concurrent_requests=2, on_response=responses.append)
+        processor.index({}, 'idx', 'doc')
+        d = processor.flush()
+        self.assertEquals(len(self.requests), 1)
+        self.assertFalse(d.called)
+
+        self.requests[0][2].callback(
+            {'errors': False, 'items': [{'index': {'status': 201}}]})
+        self.assertTrue(d.called)
+        self.assertEquals(responses[0].success, 1)
+        self.assertTrue(self.successResultOf(processor.flush()) is None)
+
+    def test_failed_request_is_reported(self):
+        responses = []
+        processor = self._processor(
+            max_actions=1, on_response=responses.append)
+        processor.index({}, 'idx', 'doc')
+        self.requests[0][2].errback(ValueError('boom'))
+        self.assertTrue(responses[0].check(ValueError))
+        self.assertEquals(processor.in_flight, 0)
+
+    def test_invalidates_cache(self):
+        invalidated = []
+
+        def invalidate(result, indexes):
+            invalidated.append(indexes)
+            return result
+
+        self.es._invalidate = invalidate
+        self.es.connection.execute = lambda *args, **kwargs: succeed({})
+        processor = self._processor(max_actions=2)
+        processor.index({}, 'idx1', 'doc')
+        processor.delete('idx2', 'doc', 1)
+        self.assertEquals(invalidated, [set(['idx1', 'idx2'])])
+
+
+class AdaptiveBulkSizerTest(FakeClientMixin, TestCase):
+
+    """Tests for the AdaptiveBulkSizer class."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.metrics = Metrics()
+        self.sizer = AdaptiveBulkSizer(
+            actions=100, target_latency=1, min_actions=10, max_actions=300,
+            increment=100, max_concurrency=3, metrics=self.metrics,
+            clock=self.clock)
+
+    def _batch(self, latency, result=None):
+        token = self.sizer.started()
+        self.clock.advance(latency)
+        return self.sizer.finished(result or BulkResult(), token)
+
+    def test_grows_size_then_concurrency_while_fast(self):
+        for _ in range(4):
+            self._batch(0.5)
+        self.assertEquals(self.sizer.actions, 300)
+        self.assertEquals(self.sizer.concurrency, 3)
+        self.assertEquals(self.metrics.snapshot()['gauges'],
+                          {'bulk_actions': 300, 'bulk_concurrency': 3})
+
+    def test_backs_off_once_per_window(self):
+        for _ in range(4):
+            self._batch(0.5)
+        slow = [self.sizer.started() for _ in range(3)]
+        self.clock.advance(2)
+        for token in slow:
+            self.sizer.finished(BulkResult(), token)
+        self.assertEquals(self.sizer.actions, 150)
+        self.assertEquals(self.sizer.concurrency, 1)
+        self.assertEquals(self.metrics.counters['bulk_backoffs'], 1)
+
+        for _ in range(5):
+            self._batch(2)
+        self.assertEquals(self.sizer.actions, 10)
+
+    def test_backs_off_on_rejections(self):
+        result = BulkResult()
+        result.failed.append(BulkItemError({'index': {}}, 429, 'rejected'))
+        self._batch(0.1, result)
+        self.assertEquals(self.sizer.actions, 50)
+
+        result = BulkResult()
+        result.retried = 1
+        self._batch(0.1, result)
+        self.assertEquals(self.sizer.actions, 25)
+
+        failure = self._batch(0.1, Failure(ValueError('down')))
+        self.assertTrue(failure.check(ValueError))
+        self.assertEquals(self.sizer.actions, 12)
+        self.assertEquals(self.metrics.counters['bulk_backoffs'], 3)
+        failure.trap(ValueError)
+
+    def test_bulk_processor_follows_the_sizer(self):
+        requests = []
+
+        def execute(*args, **kwargs):
+            requests.append(Deferred())
+            return requests[-1]
+
+        es = self._client(execute=execute)
+        sizer = AdaptiveBulkSizer(
+            actions=2, increment=2, max_actions=4, clock=self.clock)
+        processor = es.bulk_processor(sizer=sizer, clock=self.clock)
+        self.assertEquals(processor.max_actions, 2)
+        self.assertEquals(es.stats()['gauges']['bulk_actions'], 2)
+
+        for i in range(6):
+            processor.index({}, 'idx', 'doc', id=i + 1)
+        self.assertEquals(len(requests), 1)
+        requests[0].callback({'items': []})
+        self.assertEquals(processor.max_actions, 4)
+        self.assertEquals(len(requests), 2)
+        self.assertEquals(len(processor.buffer), 0)
+
+
+class SendBulkTest(FakeClientMixin, TestCase):
+
+    """Tests for send_bulk."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.es = self._client(
+            retry_policy=RetryPolicy(backoff=0, max_retries=2))
+        self.bodies = []
+        self.responses = []
+        self.entries = [
+            (make_bulk_action('index', 'idx', 'doc', id=i),
+             [str(i), '\n', '{}', '\n']) for i in range(1, 4)]
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        self.bodies.append(''.join(body.chunks))
+        return succeed(self.responses.pop(0))
+
+    def _item(self, status, error=None):
+        info = {'status': status}
+        if error:
+            info['error'] = error
+        return {'index': info}
+
+    def test_only_rejected_items_are_retried(self):
+        rejected = {'type': 'es_rejected_execution_exception',
+                    'reason': 'queue full'}
+        mapping = {'type': 'mapper_parsing_exception',
+                   'reason': 'failed to parse'}
+        self.responses = [
+            {'took': 3, 'errors': True, 'items': [
+                self._item(201), self._item(429, rejected),
+                self._item(400, mapping)]},
+            {'took': 1, 'errors': False, 'items': [self._item(201)]},
+        ]
+
+        result = self.successResultOf(send_bulk(self.es, self.entries))
+        self.assertEquals(self.bodies, ['1\n{}\n2\n{}\n3\n{}\n', '2\n{}\n'])
+        self.assertEquals(result.success, 2)
+        self.assertEquals(result.retried, 1)
+        self.assertEquals(result.took, 4)
+        self.assertTrue(result.errors)
+        self.assertEquals(len(result.failed), 1)
+        failed = result.failed[0]
+        self.assertEquals(failed.action, self.entries[2][0])
+        self.assertEquals(failed.status, 400)
+        self.assertEquals(failed.reason, 'failed to parse')
+
+    def test_rejected_items_fail_once_retries_are_exhausted(self):
+        self.responses = [
+            {'items': [self._item(201), self._item(503, 'unavailable'),
+                       self._item(201)]},
+            {'items': [self._item(503, 'unavailable')]},
+            {'items': [self._item(503, 'unavailable')]},
+        ]
+
+        result = self.successResultOf(send_bulk(self.es, self.entries))
+        self.assertEquals(len(self.bodies), 3)
+        self.assertEquals(result.success, 2)
+        self.assertEquals(result.retried, 2)
+        self.assertEquals(
+            [(f.status, f.reason) for f in result.failed],
+            [(503, 'unavailable')])
+
+    def test_actions_without_items_fail(self):
+        self.responses = [{'items': [self._item(201)]}]
+
+        result = self.successResultOf(send_bulk(self.es, self.entries))
+        self.assertEquals(result.success, 1)
+        self.assertEquals(
+            [(f.action, f.status, f.error) for f in result.failed],
+            [(self.entries[1][0], None, MISSING_ITEM),
+             (self.entries[2][0], None, MISSING_ITEM)])
+
+    def test_empty_response_fails_every_action(self):
+        self.responses = [None]
+        outcomes = []
+
+        result = self.successResultOf(send_bulk(
+            self.es, self.entries,
+            on_item=lambda action, ok, item: outcomes.append(ok)))
+        self.assertEquals(result.success, 0)
+        self.assertEquals(len(result.failed), 3)
+        self.assertEquals(outcomes, [False] * 3)
+
+    def test_retries_spend_the_retry_budget(self):
+        self.es.connection.retry_policy.tokens = 1
+        self.responses = [
+            {'items': [self._item(429, 'rejected'), self._item(201),
+                       self._item(429, 'rejected')]},
+            {'items': [self._item(429, 'rejected'), self._item(201)]},
+        ]
+
+        result = self.successResultOf(send_bulk(self.es, self.entries))
+        self.assertEquals(self.bodies, ['1\n{}\n2\n{}\n3\n{}\n',
+                                        '1\n{}\n3\n{}\n'])
+        self.assertEquals(result.success, 2)
+        self.assertEquals(result.retried, 2)
+        self.assertEquals(
+            [(f.action, f.status) for f in result.failed],
+            [(self.entries[0][0], 429)])
+        self.assertEquals(self.es.connection.retry_policy.tokens, 0)
+
+
+class StreamingBulkTest(FakeClientMixin, TestCase):
+
+    """Tests for streaming_bulk."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.requests = []
+        self.pulled = []
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        d = Deferred()
+        lines = ''.join(body.chunks).splitlines()
+        self.requests.append(([json.loads(l) for l in lines], d))
+        return d
+
+    def _respond(self, i, *statuses):
+        self.requests[i][1].callback({'items': [
+            {'index': {'status': s, 'error': 'failed'} if s >= 400
+             else {'status': s}} for s in statuses]})
+
+    def _docs(self, count):
+        for i in range(count):
+            self.pulled.append(i)
+            yield {'_id': i, 'n': i}
+
+    def test_expand_action(self):
+        self.assertEquals(
+            expand_action({'_id': 1, 'n': 1}, 'idx', 'doc'),
+            ({'index': {'_index': 'idx', '_type': 'doc', '_id': 1}},
+             {'n': 1}))
+        self.assertEquals(
+            expand_action({'_op_type': 'create', '_index': 'other',
+                           '_source': {'n': 1}, 'ignored': True}, 'idx'),
+            ({'create': {'_index': 'other', '_type': None}}, {'n': 1}))
+        self.assertEquals(
+            expand_action({'_op_type': 'delete', '_id': 2}, 'idx', 'doc'),
+            ({'delete': {'_index': 'idx', '_type': 'doc', '_id': 2}}, None))
+        action = ({'index': {}}, {'n': 1})
+        self.assertTrue(expand_action(action) is action)
+
+    def test_reads_only_as_fast_as_batches_complete(self):
+        items = []
+        d = self.es.streaming_bulk(
+            self._docs(5), 'idx', 'doc', chunk_size=2,
+            max_concurrent_requests=1, cooperate=self.cooperate,
+            on_item=lambda action, ok, item: items.append(
+                (action['index']['_id'], ok)))
+        self._run_steps()
+        self.assertEquals(len(self.requests), 1)
+        self.assertEquals(self.pulled, [0, 1, 2, 3])
+        self.assertEquals(
+            self.requests[0][0],
+            [{'index': {'_index': 'idx', '_type': 'doc', '_id': 0}},
+             {'n': 0},
+             {'index': {'_index': 'idx', '_type': 'doc', '_id': 1}},
+             {'n': 1}])
+
+        self._respond(0, 201, 400)
+        self._run_steps()
+        self.assertEquals(len(self.requests), 2)
+        self.assertEquals(self.pulled, [0, 1, 2, 3, 4])
+        self.assertEquals(items, [(0, True), (1, False)])
+
+        self._respond(1, 201, 201)
+        self._run_steps()
+        self._respond(2, 201)
+        self._run_steps()
+        result = self.successResultOf(d)
+        self.assertEquals(result.success, 4)
+        self.assertEquals(len(result.failed), 1)
+        self.assertEquals(len(items), 5)
+
+    def test_stops_reading_when_a_batch_fails(self):
+        d = self.es.streaming_bulk(
+            self._docs(10), 'idx', 'doc', chunk_size=2,
+            max_concurrent_requests=2, cooperate=self.cooperate)
+        self._run_steps()
+        self.assertEquals(len(self.requests), 2)
+
+        self.requests[0][1].errback(ValueError('down'))
+        self._run_steps()
+        self.assertFalse(d.called)
+        self._respond(1, 201, 201)
+        self._run_steps()
+        self.failureResultOf(d, ValueError)
+        self.assertEquals(len(self.requests), 2)
+        self.assertTrue(len(self.pulled) < 10)
+
+    def test_sizer_chooses_batch_size_and_concurrency(self):
+        # Every step of the cooperator takes a second of the clock.
+        sizer = AdaptiveBulkSizer(
+            actions=2, increment=1, max_actions=3, target_latency=60,
+            clock=self.clock)
+        d = self.es.streaming_bulk(
+            self._docs(10), 'idx', 'doc', sizer=sizer,
+            cooperate=self.cooperate)
+        self._run_steps()
+        self.assertEquals(len(self.requests), 1)
+
+        self._respond(0, 201, 201)
+        self._run_steps()
+        self.assertEquals(sizer.actions, 3)
+        self.assertEquals(len(self.requests), 2)
+
+        self._respond(1, 201, 201)
+        self._run_steps()
+        self.assertEquals(sizer.concurrency, 2)
+        self.assertEquals(
+            [len(actions) // 2 for actions, _ in self.requests], [2, 2, 3, 3])
+
+        self._respond(2, 201, 201, 201)
+        self._respond(3, 201, 201, 201)
+        self._run_steps()
+        self.assertEquals(self.successResultOf(d).success, 10)
+
+
+class ReindexTest(FakeClientMixin, TestCase):
+
+    """Tests for reindex."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.source = self._client('source:9200', self._read)
+        self.target = self._client('target:9200', self._write)
+        self.reads = []
+        self.writes = []
+        self.pages = [[1, 2], [3, 4], [5]]
+
+    def _read(self, method, path, body=None, params=None, **kwargs):
+        self.reads.append((method, path))
+        if method == 'DELETE':
+            return succeed({})
+        page = self.pages.pop(0) if self.pages else []
+        return succeed({'_scroll_id': 's', 'hits': {'total': 5, 'hits': [
+            {'_index': 'src', '_type': 'doc', '_id': i, '_source': {'n': i}}
+            for i in page]}})
+
+    def _write(self, method, path, body=None, params=None, **kwargs):
+        lines = [json.loads(l) for l in ''.join(body.chunks).splitlines()]
+        d = Deferred()
+        self.writes.append((lines, d))
+        return d
+
+    def _respond(self, i, error=False):
+        lines, d = self.writes[i]
+        d.callback({'items': [
+            {'index': {'status': 400, 'error': 'bad'} if error else
+             {'status': 201}} for _ in lines[::2]]})
+
+    def test_copies_hits_while_reading_ahead(self):
+        progress = []
+        d = self.source.reindex_client_side(
+            {'query': {'match_all': {}}}, 'src', 'dst', max_actions=2,
+            max_concurrent_requests=1, target_client=self.target,
+            transform=lambda doc: None if doc['_id'] == 4 else doc,
+            on_progress=lambda p: progress.append(p.result.success),
+            clock=self.clock)
+        self.assertEquals(len(self.writes), 1)
+        self.assertEquals(self.writes[0][0][:2], [
+            {'index': {'_index': 'dst', '_type': 'doc', '_id': 1}},
+            {'n': 1}])
+        # Every page is read while the first batch is in flight.
+        self.assertEquals(len(self.reads), 4)
+
+        self._respond(0)
+        self.assertEquals(len(self.writes), 2)
+        self.assertNoResult(d)
+        self._respond(1, error=True)
+        result = self.successResultOf(d)
+        self.assertEquals(progress, [2, 2])
+        self.assertEquals(result.total, 5)
+        self.assertEquals(result.read, 5)
+        self.assertEquals(result.skipped, 1)
+        self.assertEquals(result.result.success, 2)
+        self.assertEquals(len(result.result.failed), 2)
+        self.assertEquals(self.reads[-1][0], 'DELETE')
+
+    def test_stops_when_a_bulk_request_fails(self):
+        d = self.source.reindex_client_side(
+            {}, 'src', 'dst', target_client=self.target, max_actions=1,
+            max_concurrent_requests=1, prefetch=1, clock=self.clock)
+        self.writes[0][1].errback(ValueError('down'))
+        self.failureResultOf(d, ValueError)
+        self.assertEquals(len(self.writes), 2)
+        self.assertEquals(self.reads[-1][0], 'DELETE')
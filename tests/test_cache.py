@@ -0,0 +1,87 @@
+"""Tests for the cache module."""
+
+from twisted.trial.unittest import TestCase
+
+from txes2.cache import ResponseCache
+
+
+class ResponseCacheTest(TestCase):
+
+    """Tests for the ResponseCache class."""
+
+    def setUp(self):
+        self.now = 100
+        self.cache = ResponseCache(
+            max_entries=2, ttl=10, index_ttls={'logs-*': 1},
+            clock=lambda: self.now)
+
+    def test_get_returns_copy(self):
+        self.cache.put('k', ['idx'], {'hits': [1]})
+        result = self.cache.get('k')
+        result['hits'].append(2)
+        self.assertEquals(self.cache.get('k'), {'hits': [1]})
+        self.assertEquals(self.cache.hits, 2)
+
+    def test_entries_expire(self):
+        self.cache.put('k', ['idx'], {'a': 1})
+        self.cache.put('logs', ['logs-2016'], {'a': 1})
+        self.now = 105
+        self.assertTrue(self.cache.get('logs') is None)
+        self.assertEquals(self.cache.get('k'), {'a': 1})
+        self.now = 110
+        self.assertTrue(self.cache.get('k') is None)
+        self.assertEquals(self.cache.size, 0)
+
+    def test_per_call_ttl(self):
+        self.cache.put('k', ['idx'], {'a': 1}, ttl=100)
+        self.now = 150
+        self.assertEquals(self.cache.get('k'), {'a': 1})
+
+    def test_lru_eviction(self):
+        self.cache.put('a', ['idx'], 1)
+        self.cache.put('b', ['idx'], 2)
+        self.cache.get('a')
+        self.cache.put('c', ['idx'], 3)
+        self.assertEquals(len(self.cache), 2)
+        self.assertTrue(self.cache.get('b') is None)
+        self.assertEquals(self.cache.get('a'), 1)
+
+    def test_max_bytes(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put('a', ['idx'], 'aaaa')
+        cache.put('b', ['idx'], 'bbbb')
+        self.assertEquals(len(cache), 1)
+        cache.put('c', ['idx'], 'c' * 20)
+        self.assertTrue(cache.get('c') is None)
+
+    def test_invalidate(self):
+        self.cache.max_entries = 10
+        self.cache.put('a', ['idx'], 1)
+        self.cache.put('b', ['other'], 2)
+        self.cache.put('c', ['_all'], 3)
+        self.cache.put('d', ['id*'], 4)
+        self.cache.invalidate('idx')
+        self.assertEquals(len(self.cache), 1)
+        self.assertEquals(self.cache.get('b'), 2)
+
+        self.cache.invalidate('_all')
+        self.assertEquals(len(self.cache), 0)
+
+    def test_results_read_before_an_invalidation_are_not_stored(self):
+        self.cache.max_entries = 10
+        generation = self.cache.generation()
+        self.cache.invalidate('idx')
+        self.cache.put('a', ['idx'], 1, generation=generation)
+        self.cache.put('b', ['id*'], 2, generation=generation)
+        self.cache.put('c', ['other'], 3, generation=generation)
+        self.assertEquals(self.cache.get('a'), None)
+        self.assertEquals(self.cache.get('b'), None)
+        self.assertEquals(self.cache.get('c'), 3)
+
+        self.cache.put('a', ['idx'], 1, generation=self.cache.generation())
+        self.assertEquals(self.cache.get('a'), 1)
+
+        generation = self.cache.generation()
+        self.cache.invalidate('_all')
+        self.cache.put('c', ['other'], 3, generation=generation)
+        self.assertEquals(self.cache.get('c'), None)
@@ -1,13 +1,26 @@
 """Tests for the HTTPConnection module."""
 
+import json
+import zlib
+
 from mock import patch, Mock
 
-from twisted.internet.defer import succeed, inlineCallbacks
+from twisted.internet.defer import (
+    CancelledError, Deferred, succeed, inlineCallbacks)
 from twisted.trial.unittest import TestCase
-from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.error import ConnectionRefusedError, ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    ResponseDone, ResponseFailed, ResponseNeverReceived)
+
+from twisted.web.http_headers import Headers
 
-from txes2.connection_http import _prepare_url, HTTPConnection
-from txes2.exceptions import ElasticSearchException
+from txes2.bulk import BulkBodyProducer
+from txes2.connection_http import (
+    _gzip, _prepare_url, HealthChecker, HTTPConnection)
+from txes2.exceptions import ElasticSearchException, RequestException
+from txes2.retry import RetryPolicy
 
 
 @patch('txes2.connection_http.treq')
@@ -18,7 +31,8 @@ class HTTPConnectionTest(TestCase):
     def setUp(self):
         """Setup connection mocks."""
         self.conn = HTTPConnection()
-        self.conn.connect('s1', pool=Mock())
+        self.conn.connect(
+            's1', pool=Mock(), retry_policy=RetryPolicy(backoff=0))
         self.conn.add_server('s2')
 
     def test_prepare_url(self, _):
@@ -30,17 +44,221 @@ class HTTPConnectionTest(TestCase):
             'https://s1:443', 'index/doc/_search', {'size': 5})
         self.assertTrue(result == 'https://s1:443/index/doc/_search?size=5')
 
+    def test_base_urls_are_precomputed(self, _):
+        self.conn.add_server('https://s3:443/')
+        self.assertEquals(self.conn.base_urls, {
+            's1': 'http://s1', 's2': 'http://s2',
+            'https://s3:443/': 'https://s3:443'})
+
     @inlineCallbacks
     def test_execute(self, treq_mock):
         response_mock = Mock(code=200)
-        response_mock.json.return_value = succeed({'_id': 123})
+        response_mock.content.return_value = succeed(b'{"_id": 123}')
 
         treq_mock.request.return_value = succeed(response_mock)
 
-        yield self.conn.execute(
+        result = yield self.conn.execute(
             'GET', 'index/doc/_search', body={'query': {'term': 'something'}})
 
-        assert response_mock.json.called
+        self.assertEquals(result, {'_id': 123})
+        self.assertEquals(
+            treq_mock.request.call_args[1]['data'],
+            '{"query":{"term":"something"}}')
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_records_latency(self, treq_mock):
+        response_mock = Mock(code=200)
+        response_mock.content.return_value = succeed(b'{}')
+        treq_mock.request.return_value = succeed(response_mock)
+
+        selector = self.conn.servers.selector
+        yield self.conn.execute('GET', 'index/doc/_search')
+
+        self.assertEquals(len(selector.latency), 1)
+        self.assertEquals(sum(selector.in_flight.values()), 0)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_records_metrics(self, treq_mock):
+        response_mock = Mock(code=200)
+        response_mock.content.return_value = succeed(b'{"took": 5}')
+        treq_mock.request.return_value = succeed(response_mock)
+
+        hook = Mock()
+        self.conn.metrics.add_hook('response', hook)
+        yield self.conn.execute('GET', 'index/_search', body={'a': 1})
+
+        info = hook.call_args[0][0]
+        self.assertEquals(info['bytes_in'], 11)
+        self.assertEquals(info['path'], '/index/_search')
+
+        stats = self.conn.stats()
+        self.assertEquals(stats['counters']['requests'], 1)
+        self.assertEquals(stats['counters']['bytes_out'], 7)
+        self.assertEquals(stats['endpoints']['_search']['count'], 1)
+        self.assertEquals(stats['pool']['in_flight'], 0)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_records_retries(self, treq_mock):
+        treq_mock.request.side_effect = ConnectionRefusedError()
+        self.conn.servers.mark_dead = Mock()
+
+        yield self.assertFailure(
+            self.conn.execute('GET', 'index/doc/_search'),
+            ConnectionRefusedError)
+
+        counters = self.conn.stats()['counters']
+        self.assertEquals(counters['retries'], 3)
+        self.assertEquals(counters['errors'], 4)
+        self.assertEquals(counters['nodes_marked_dead'], 4)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_streams_response_body(self, treq_mock):
+        def deliver_body(protocol):
+            for chunk in (b'{"hits": {"hi', b'ts": [1, 2', b']}}'):
+                protocol.dataReceived(chunk)
+            protocol.connectionLost(Failure(ResponseDone()))
+
+        response_mock = Mock(code=200)
+        response_mock.deliverBody.side_effect = deliver_body
+        treq_mock.request.return_value = succeed(response_mock)
+
+        result = yield self.conn.execute(
+            'GET', 'index/doc/_search', stream=True)
+
+        self.assertEquals(result, {'hits': {'hits': [1, 2]}})
+        self.assertFalse(response_mock.content.called)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_streaming_reports_invalid_elements(self, treq_mock):
+        def deliver_body(protocol):
+            for chunk in (b'{"hits": {"hits": [{"a": x}, ', b'{"b": 1}]}}'):
+                protocol.dataReceived(chunk)
+            protocol.connectionLost(Failure(ResponseDone()))
+
+        response_mock = Mock(code=200)
+        response_mock.deliverBody.side_effect = deliver_body
+        treq_mock.request.return_value = succeed(response_mock)
+
+        yield self.assertFailure(
+            self.conn.execute('GET', 'index/doc/_search', stream=True),
+            ValueError)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_streaming_retries_on_body_failure(self, treq_mock):
+        def deliver_body(protocol):
+            protocol.dataReceived(b'{"hits": ')
+            protocol.connectionLost(
+                Failure(ResponseFailed([Failure(ConnectionLost())])))
+
+        response_mock = Mock(code=200)
+        response_mock.deliverBody.side_effect = deliver_body
+        treq_mock.request.side_effect = lambda *a, **kw: succeed(
+            response_mock)
+
+        self.conn.servers.mark_dead = Mock()
+
+        yield self.assertFailure(
+            self.conn.execute('GET', 'index/doc/_search', stream=True),
+            ResponseFailed)
+
+        self.assertEquals(self.conn.servers.mark_dead.call_count, 4)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_compresses_large_bodies(self, treq_mock):
+        response_mock = Mock(code=200)
+        response_mock.headers = Headers({b'Content-Encoding': [b'gzip']})
+        response_mock.content.return_value = succeed(_gzip(b'{"_id": 1}'))
+        treq_mock.request.return_value = succeed(response_mock)
+
+        self.conn.compression = True
+        self.conn.compression_threshold = 10
+
+        body = {'query': {'match_all': {}}}
+        result = yield self.conn.execute('GET', 'index/_search', body=body)
+
+        self.assertEquals(result, {'_id': 1})
+        kwargs = treq_mock.request.call_args[1]
+        self.assertEquals(kwargs['headers'][b'Content-Encoding'], [b'gzip'])
+        self.assertEquals(kwargs['headers'][b'Accept-Encoding'], [b'gzip'])
+        self.assertEquals(
+            json.loads(zlib.decompress(kwargs['data'], 16 + zlib.MAX_WBITS)),
+            body)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_skips_compression_below_threshold(self, treq_mock):
+        response_mock = Mock(code=200)
+        response_mock.headers = Headers()
+        response_mock.content.return_value = succeed(b'{"_id": 1}')
+        treq_mock.request.return_value = succeed(response_mock)
+
+        self.conn.compression = True
+
+        yield self.conn.execute('GET', 'index/_search', body={'a': 1})
+
+        kwargs = treq_mock.request.call_args[1]
+        self.assertEquals(kwargs['data'], '{"a":1}')
+        self.assertTrue(b'Content-Encoding' not in kwargs['headers'])
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_sends_body_producers(self, treq_mock):
+        response_mock = Mock(code=200)
+        response_mock.headers = Headers()
+        response_mock.content.side_effect = lambda: succeed(b'{"items": []}')
+        treq_mock.request.side_effect = lambda *a, **kw: succeed(response_mock)
+
+        producer = BulkBodyProducer([b'{"index":{}}', b'\n', b'{}', b'\n'])
+        yield self.conn.execute('POST', '_bulk', body=producer)
+        self.assertTrue(treq_mock.request.call_args[1]['data'] is producer)
+
+        self.conn.compression = True
+        self.conn.compression_threshold = 10
+        yield self.conn.execute('POST', '_bulk', body=producer)
+        kwargs = treq_mock.request.call_args[1]
+        self.assertEquals(kwargs['headers'][b'Content-Encoding'], [b'gzip'])
+        self.assertEquals(
+            zlib.decompress(b''.join(kwargs['data'].chunks),
+                            16 + zlib.MAX_WBITS),
+            b'{"index":{}}\n{}\n')
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_streams_gzipped_response(self, treq_mock):
+        compressed = _gzip(b'{"hits": {"hits": [1, 2]}}')
+
+        def deliver_body(protocol):
+            for i in range(0, len(compressed), 5):
+                protocol.dataReceived(compressed[i:i + 5])
+            protocol.connectionLost(Failure(ResponseDone()))
+
+        response_mock = Mock(code=200)
+        response_mock.headers = Headers({b'Content-Encoding': [b'gzip']})
+        response_mock.deliverBody.side_effect = deliver_body
+        treq_mock.request.return_value = succeed(response_mock)
+
+        self.conn.compression = True
+
+        result = yield self.conn.execute(
+            'GET', 'index/doc/_search', stream=True)
+        self.assertEquals(result, {'hits': {'hits': [1, 2]}})
 
         self.conn.close()
 
@@ -71,12 +289,35 @@ class HTTPConnectionTest(TestCase):
     @inlineCallbacks
     def test_execute_doesnt_retry_on_client_error(self, treq_mock):
         """When ES returns a client-exception, we shouldn't retry."""
+        response_mock = Mock(code=400)
+        response_mock.content.return_value = succeed(json.dumps({
+            u'status': 400,
+            u'error': {u'type': u'parsing_exception'}}))
+
+        treq_mock.request.return_value = succeed(response_mock)
+
+        self.conn.servers.mark_dead = Mock()
+
+        yield self.assertFailure(
+            self.conn.execute('GET', 'index/doc/_search'),
+            RequestException)
+
+        # Ensure no retries
+        self.assertEquals(treq_mock.request.call_count, 1)
+        self.assertEquals(self.conn.servers.mark_dead.call_count, 0)
+
+        self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_retries_rejected_execution(self, treq_mock):
+        """Retry 429 rejections without marking the node dead."""
         response_mock = Mock(code=429)
-        response_mock.json.return_value = succeed({
+        response_mock.content.side_effect = lambda: succeed(json.dumps({
             u'status': 429,
-            u'error': u'ReduceSearchPhaseException[Failed to execute phase [fetch], [reduce] ; shardFailures {[2A-6X8MDRP-gZ6M_752d-A][tmp][0]: EsRejectedExecutionException[rejected execution (queue capacity 0) on org.elasticsearch.search.action.SearchServiceTransportAction$23@24084605]}]; nested: EsRejectedExecutionException[rejected execution (queue capacity 0) on org.elasticsearch.action.search.type.TransportSearchQueryThenFetchAction$AsyncAction$2@42658745]'})   # noqa
+            u'error': u'ReduceSearchPhaseException[Failed to execute phase [fetch], [reduce] ; shardFailures {[2A-6X8MDRP-gZ6M_752d-A][tmp][0]: EsRejectedExecutionException[rejected execution (queue capacity 0) on org.elasticsearch.search.action.SearchServiceTransportAction$23@24084605]}]; nested: EsRejectedExecutionException[rejected execution (queue capacity 0) on org.elasticsearch.action.search.type.TransportSearchQueryThenFetchAction$AsyncAction$2@42658745]'}))   # noqa
 
-        treq_mock.request.return_value = succeed(response_mock)
+        treq_mock.request.side_effect = lambda *a, **kw: succeed(
+            response_mock)
 
         self.conn.servers.mark_dead = Mock()
 
@@ -84,7 +325,223 @@ class HTTPConnectionTest(TestCase):
             self.conn.execute('GET', 'index/doc/_search'),
             ElasticSearchException)
 
-        # Ensure no retries
+        self.assertEquals(treq_mock.request.call_count, 4)
         self.assertEquals(self.conn.servers.mark_dead.call_count, 0)
 
         self.conn.close()
+
+    @inlineCallbacks
+    def test_execute_stops_retrying_when_budget_spent(self, treq_mock):
+        treq_mock.request.side_effect = ConnectionRefusedError()
+        self.conn.retry_policy = RetryPolicy(backoff=0, budget_burst=2)
+        self.conn.servers.mark_dead = Mock()
+
+        yield self.assertFailure(
+            self.conn.execute('GET', 'index/doc/_search'),
+            ConnectionRefusedError)
+
+        self.assertEquals(treq_mock.request.call_count, 3)
+
+        self.conn.close()
+
+    def test_execute_backs_off_between_retries(self, treq_mock):
+        clock = Clock()
+        treq_mock.request.side_effect = ConnectionRefusedError()
+        self.conn.retry_policy = RetryPolicy(
+            max_retries=1, backoff=1, clock=clock)
+        self.conn.retry_policy.delay = lambda attempt: 1
+        self.conn.servers.mark_dead = Mock()
+
+        d = self.conn.execute('GET', 'index/doc/_search')
+        self.assertEquals(treq_mock.request.call_count, 1)
+
+        clock.advance(1)
+        self.assertEquals(treq_mock.request.call_count, 2)
+
+        return self.assertFailure(d, ConnectionRefusedError)
+
+
+@patch('txes2.connection_http.treq')
+class HedgingTest(TestCase):
+
+    """Tests for hedged reads."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.conn = HTTPConnection()
+        self.conn.connect(
+            ['s1', 's2'], pool=Mock(), selector='round_robin',
+            retry_policy=RetryPolicy(backoff=0), clock=self.clock,
+            hedge_percentile=95, hedge_delay=0.5)
+        self.requests = {}
+
+    def _request(self, method, url, **kwargs):
+        d = Deferred()
+        self.requests[url.split('/')[2]] = d
+        return d
+
+    def _respond(self, server, body):
+        response = Mock(code=200)
+        response.content.return_value = succeed(body)
+        self.requests[server].callback(response)
+
+    def test_fast_response_is_not_hedged(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+
+        d = self.conn.execute('GET', 'index/_search', hedge=True)
+        self._respond('s1', b'{"node": 1}')
+        self.clock.advance(1)
+
+        self.assertEquals(self.successResultOf(d), {'node': 1})
+        self.assertEquals(list(self.requests), ['s1'])
+
+    def test_slow_response_is_hedged(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+
+        d = self.conn.execute('GET', 'index/_search', hedge=True)
+        self.clock.advance(0.5)
+        self.assertEquals(sorted(self.requests), ['s1', 's2'])
+
+        self._respond('s2', b'{"node": 2}')
+
+        self.assertEquals(self.successResultOf(d), {'node': 2})
+        self.assertTrue(self.requests['s1'].called)
+        self.assertTrue('s1' in self.conn.servers)
+
+    def test_cancelled_loser_is_not_a_failure(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+        selector = self.conn.servers.selector = Mock(
+            wraps=self.conn.servers.selector)
+
+        d = self.conn.execute('GET', 'index/_search', hedge=True)
+        self.clock.advance(0.5)
+        self._respond('s2', b'{"node": 2}')
+        self.successResultOf(d)
+
+        counters = self.conn.metrics.counters
+        self.assertEquals(counters['errors'], 0)
+        self.assertEquals(counters['cancelled'], 1)
+        self.assertEquals(self.conn.metrics.in_flight, 0)
+        selector.cancel.assert_called_once_with('s1')
+        self.assertTrue(
+            all(call[0][0] != 's1' for call in selector.finish.call_args_list))
+
+    def test_cancelled_loser_stays_half_open(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+        self.conn.servers.half_open.add('s1')
+        self.conn.servers.half_open_ratio = 1
+
+        d = self.conn.execute('GET', 'index/_search', hedge=True)
+        self.clock.advance(0.5)
+        self.assertEquals(sorted(self.requests), ['s1', 's2'])
+        self._respond('s2', b'{"node": 2}')
+
+        self.assertEquals(self.successResultOf(d), {'node': 2})
+        self.assertEquals(self.conn.servers.half_open, set(['s1']))
+
+    def test_wrapped_cancellation_does_not_kill_the_loser(self, treq_mock):
+        def request(method, url, **kwargs):
+            def cancel(d):
+                d.errback(ResponseNeverReceived([Failure(CancelledError())]))
+            d = self.requests[url.split('/')[2]] = Deferred(cancel)
+            return d
+        treq_mock.request.side_effect = request
+
+        d = self.conn.execute('GET', 'index/_search', hedge=True)
+        self.clock.advance(0.5)
+        self._respond('s2', b'{"node": 2}')
+
+        self.assertEquals(self.successResultOf(d), {'node': 2})
+        self.assertTrue('s1' in self.conn.servers)
+        self.assertEquals(self.conn.metrics.counters['errors'], 0)
+
+    def test_hung_node_times_out_and_is_marked_dead(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+        self.conn.connect(
+            ['s1', 's2'], timeout=1, pool=Mock(), selector='round_robin',
+            retry_policy=RetryPolicy(backoff=0), clock=self.clock)
+        self.assertEquals(self.conn.servers.timeout, 1)
+
+        d = self.conn.execute('GET', 'index/_search')
+        self.clock.advance(1)
+        self.assertEquals(list(self.conn.servers), ['s2'])
+        self.assertEquals(self.conn.metrics.counters['errors'], 1)
+
+        self._respond('s2', b'{"node": 2}')
+        self.assertEquals(self.successResultOf(d), {'node': 2})
+
+    def test_only_hedged_latencies_are_tracked(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+
+        self.conn.execute('POST', '_bulk')
+        self._respond('s1', b'{}')
+        self.assertEquals(len(self.conn._latencies), 0)
+
+        self.conn.execute('GET', 'index/_search', hedge=True)
+        self._respond('s2', b'{}')
+        self.assertEquals(len(self.conn._latencies), 1)
+
+    def test_failure_waits_for_hedge(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+
+        d = self.conn.execute('GET', 'index/_search', hedge=True)
+        self.clock.advance(0.5)
+        self.requests['s1'].errback(ValueError('bad body'))
+        self.assertNoResult(d)
+
+        self._respond('s2', b'{"node": 2}')
+        self.assertEquals(self.successResultOf(d), {'node': 2})
+
+    def test_writes_are_never_hedged(self, treq_mock):
+        treq_mock.request.side_effect = self._request
+
+        self.conn.execute('POST', 'index/doc')
+        self.clock.advance(1)
+
+        self.assertEquals(list(self.requests), ['s1'])
+
+    def test_hedge_delay_tracks_latency_percentile(self, treq_mock):
+        self.assertEquals(self.conn._hedge_delay(), 0.5)
+        self.conn._latencies.extend(i / 100.0 for i in range(100))
+        self.assertEquals(self.conn._hedge_delay(), 0.95)
+
+
+@patch('txes2.connection_http.treq')
+class HealthCheckerTest(TestCase):
+
+    """Tests for the HealthChecker."""
+
+    def setUp(self):
+        self.conn = HTTPConnection()
+        self.conn.connect(['s1', 's2'], retry_time=0, pool=Mock())
+        self.conn.servers.health_checking = True
+        self.checker = HealthChecker(self.conn)
+
+    @inlineCallbacks
+    def test_check_revives_responding_nodes(self, treq_mock):
+        treq_mock.request.return_value = succeed(Mock(code=200))
+        self.conn.servers.mark_dead('s2')
+
+        yield self.checker.check()
+
+        self.assertTrue('s2' in self.conn.servers)
+        self.assertEquals(treq_mock.request.call_args[0],
+                          ('HEAD', 'http://s2/'))
+
+    @inlineCallbacks
+    def test_check_reschedules_failing_nodes(self, treq_mock):
+        treq_mock.request.side_effect = ConnectionRefusedError()
+        self.conn.servers.mark_dead('s2')
+
+        yield self.checker.check()
+
+        self.assertTrue('s2' not in self.conn.servers)
+        self.assertEquals(len(self.conn.servers.dead), 1)
+
+    def test_connect_starts_checker(self, treq_mock):
+        conn = HTTPConnection()
+        conn.connect('s1', health_check_interval=30)
+        self.assertTrue(conn.servers.health_checking)
+        self.assertTrue(conn.health_checker._loop.running)
+        conn.close()
+        self.assertFalse(conn.health_checker._loop.running)
@@ -5,8 +5,9 @@ import os
 from mock import Mock
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
 
+from txes2.cache import ResponseCache
 from txes2.elasticsearch import ElasticSearch
 from txes2.exceptions import ElasticSearchException
 from txes2.exceptions import InvalidQuery
@@ -248,8 +249,8 @@ class ElasticSearchTest(TestCase):
             doc=doc, doc_type=settings.DOC_TYPE,
             index=settings.INDEX, bulk=True)
 
-        self.assertFalse(result['errors'])
-        self.assertTrue(len(result['items']) == 2)
+        self.assertFalse(result.errors)
+        self.assertEquals(result.success, 2)
 
     @inlineCallbacks
     def test_mget(self):
@@ -295,6 +296,80 @@ class ElasticSearchTest(TestCase):
 
         self.assertTrue(result['_source']['tags'] == ['tag1', 'tag2'])
 
+    def _slice_cluster(self, pages=2):
+        """Serve ``pages`` pages of two hits for every slice."""
+        requests = []
+
+        def execute(method, path, body=None, params=None, **kwargs):
+            requests.append((method, path, body))
+            if method == 'DELETE':
+                return succeed({})
+            if path.endswith('/scroll'):
+                slice_id, page = body['scroll_id'].split('-')
+                page = int(page) + 1
+            else:
+                slice_id, page = body['slice']['id'], 0
+            hits = [] if page >= pages else [
+                {'_id': '{}-{}-{}'.format(slice_id, page, i)}
+                for i in range(2)]
+            return succeed({'_scroll_id': '{}-{}'.format(slice_id, page),
+                            'hits': {'hits': hits}})
+
+        self.es.connection.execute = execute
+        return requests
+
+    def test_sliced_scan(self):
+        requests = self._slice_cluster()
+        hits = []
+        d = self.es.sliced_scan(
+            {'query': {'match_all': {}}},
+            lambda hit, slice_id: hits.append((slice_id, hit['_id'])),
+            settings.INDEX, slices=3, max_concurrent_slices=2)
+        self.assertEquals(self.successResultOf(d), 12)
+        self.assertEquals(sorted(hits)[:4], [
+            (0, '0-0-0'), (0, '0-0-1'), (0, '0-1-0'), (0, '0-1-1')])
+        self.assertEquals(
+            [body['slice'] for method, path, body in requests
+             if path.endswith('_search')],
+            [{'id': i, 'max': 3} for i in range(3)])
+        self.assertEquals(
+            len([r for r in requests if r[0] == 'DELETE']), 3)
+
+    def test_sliced_scan_clears_every_slice_on_error(self):
+        requests = self._slice_cluster(pages=5)
+        waiting = []
+
+        def callback(hit, slice_id):
+            if slice_id == 1:
+                raise ValueError('boom')
+            waiting.append(Deferred())
+            return waiting[-1]
+
+        d = self.es.sliced_scan(
+            {'query': {'match_all': {}}}, callback, settings.INDEX,
+            slices=3, max_concurrent_slices=2)
+        self.assertNoResult(d)
+        waiting[0].callback(None)
+        self.failureResultOf(d, ValueError)
+        deleted = [body['scroll_id'] for method, _, body in requests
+                   if method == 'DELETE']
+        self.assertEquals(sorted(deleted), [['0-1'], ['1-1']])
+        self.assertFalse([r for r in requests if r[2].get('slice') == {
+            'id': 2, 'max': 3}])
+
+    def test_partial_update_with_serialized_doc(self):
+        bodies = []
+
+        def execute(method, path, body=None, params=None, **kwargs):
+            bodies.append(body)
+            return succeed({})
+
+        self.es.connection.execute = execute
+        self.es.partial_update(
+            settings.INDEX, settings.DOC_TYPE, 1, doc='{"name":"raw"}')
+        self.es.index('{"name":"raw"}', settings.INDEX, settings.DOC_TYPE, 1)
+        self.assertEquals(bodies, ['{"doc":{"name":"raw"}}', '{"name":"raw"}'])
+
     @inlineCallbacks
     def test_partial_update_failure_cases(self):
         self._mock = {'_source': {'tags': ['tag1', 'tag2']}}
@@ -422,3 +497,122 @@ class ElasticSearchTest(TestCase):
         data = {'index': {'refresh_interval': '10s'}}
         result = yield self.es.update_settings(settings.INDEX, data)
         self.assertTrue(result['acknowledged'])
+
+
+class CoalesceReadsTest(TestCase):
+
+    """Tests for coalescing identical reads."""
+
+    def setUp(self):
+        self.es = ElasticSearch(
+            settings.URL, discover=False, discovery_interval=False,
+            coalesce_reads=True)
+        self.requests = []
+        self.es.connection.execute = Mock()
+        self.es.connection.execute.side_effect = self._execute
+
+    def _execute(self, *args, **kwargs):
+        self.requests.append(Deferred())
+        return self.requests[-1]
+
+    def test_identical_reads_share_request(self):
+        d1 = self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        d2 = self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        self.es.get(settings.INDEX, settings.DOC_TYPE, 2)
+        self.assertEquals(len(self.requests), 2)
+
+        self.requests[0].callback({'_id': 1})
+        r1 = self.successResultOf(d1)
+        r2 = self.successResultOf(d2)
+        self.assertEquals(r1, {'_id': 1})
+        self.assertEquals(r1, r2)
+        self.assertFalse(r1 is r2)
+
+    def test_writes_are_not_coalesced(self):
+        self.es.index({'a': 1}, settings.INDEX, settings.DOC_TYPE, id=1)
+        self.es.index({'a': 1}, settings.INDEX, settings.DOC_TYPE, id=1)
+        self.assertEquals(len(self.requests), 2)
+
+    def test_searches_are_coalesced(self):
+        query = {'query': {'match_all': {}}}
+        self.es.search(query, settings.INDEX)
+        self.es.search(query, settings.INDEX)
+        self.es.count(query, settings.INDEX)
+        self.es.count(query, settings.INDEX)
+        self.assertEquals(len(self.requests), 2)
+
+    def test_scrolls_are_not_coalesced(self):
+        query = {'query': {'match_all': {}}}
+        self.es.scroll(query, settings.INDEX)
+        self.es.scroll(query, settings.INDEX)
+        self.assertEquals(len(self.requests), 2)
+
+
+class ResponseCacheTest(TestCase):
+
+    """Tests for the client-side response cache."""
+
+    def setUp(self):
+        self.es = ElasticSearch(
+            settings.URL, discover=False, discovery_interval=False,
+            cache=ResponseCache())
+        self.es.connection.execute = Mock()
+        self.es.connection.execute.side_effect = (
+            lambda *args, **kwargs: {'hits': {'hits': []}})
+
+    @inlineCallbacks
+    def test_search_is_cached(self):
+        query = {'query': {'match_all': {}}}
+        yield self.es.search(query, settings.INDEX)
+        result = yield self.es.search(query, settings.INDEX)
+        self.assertEquals(result, {'hits': {'hits': []}})
+        self.assertEquals(self.es.connection.execute.call_count, 1)
+
+        yield self.es.search(query, settings.INDEX, cache_ttl=0)
+        self.assertEquals(self.es.connection.execute.call_count, 2)
+
+    @inlineCallbacks
+    def test_scroll_is_not_cached(self):
+        query = {'query': {'match_all': {}}}
+        yield self.es.search(query, settings.INDEX, scroll='1m')
+        yield self.es.search(query, settings.INDEX, scroll='1m')
+        self.assertEquals(self.es.connection.execute.call_count, 2)
+
+    @inlineCallbacks
+    def test_writes_invalidate_index(self):
+        yield self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        yield self.es.count({}, 'other')
+        self.assertEquals(len(self.es.cache), 2)
+
+        yield self.es.index({'a': 1}, settings.INDEX, settings.DOC_TYPE, id=1)
+        self.assertEquals(len(self.es.cache), 1)
+
+        yield self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        yield self.es.partial_update(
+            settings.INDEX, settings.DOC_TYPE, 1, doc={'a': 2})
+        self.assertEquals(len(self.es.cache), 1)
+
+    def test_read_racing_a_write_is_not_cached(self):
+        requests = []
+
+        def execute(method, path, body=None, params=None, **kwargs):
+            requests.append(Deferred())
+            return requests[-1]
+
+        self.es.connection.execute = execute
+        old = self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        self.es.index({'v': 2}, settings.INDEX, settings.DOC_TYPE, id=1)
+        requests[1].callback({'created': False})
+        requests[0].callback({'_source': {'v': 1}})
+        self.assertEquals(self.successResultOf(old), {'_source': {'v': 1}})
+
+        self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        self.assertEquals(len(requests), 3)
+
+    @inlineCallbacks
+    def test_bulk_invalidates_index(self):
+        yield self.es.get(settings.INDEX, settings.DOC_TYPE, 1)
+        self.es.bulk_size = 1
+        yield self.es.delete(
+            settings.INDEX, settings.DOC_TYPE, 1, bulk=True)
+        self.assertEquals(len(self.es.cache), 0)
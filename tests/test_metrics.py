@@ -0,0 +1,54 @@
+"""Tests for the metrics module."""
+
+from mock import Mock
+
+from twisted.trial.unittest import TestCase
+
+from txes2.metrics import endpoint_name, Histogram, Metrics
+
+
+class MetricsTest(TestCase):
+
+    """Tests for the metrics module."""
+
+    def test_endpoint_name(self):
+        self.assertEquals(endpoint_name('/idx/doc/_search?size=1'), '_search')
+        self.assertEquals(endpoint_name('/_search/scroll'), '_search')
+        self.assertEquals(endpoint_name('/_bulk'), '_bulk')
+        self.assertEquals(endpoint_name('/idx/doc/1'), '_doc')
+        self.assertEquals(endpoint_name('/'), '/')
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2, float('inf')))
+        for value in (0.5, 0.5, 1.5, 3):
+            histogram.observe(value)
+        self.assertEquals(histogram.counts, [2, 1, 1])
+        self.assertEquals(histogram.percentile(50), 1)
+        self.assertEquals(histogram.percentile(75), 2)
+        self.assertEquals(histogram.snapshot()['count'], 4)
+        self.assertTrue(Histogram().percentile(50) is None)
+
+    def test_hooks(self):
+        metrics = Metrics()
+        hook = Mock()
+        metrics.add_hook('response', hook)
+        metrics.attempt_started()
+        metrics.response('GET', '/idx/_search', 's1', 200, 10, 0.1, 0.2, 0.3)
+
+        info = hook.call_args[0][0]
+        self.assertEquals(info['server'], 's1')
+        self.assertAlmostEqual(info['total'], 0.6)
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot['counters']['bytes_in'], 10)
+        self.assertEquals(snapshot['endpoints']['_search']['count'], 1)
+        self.assertEquals(snapshot['nodes']['s1']['count'], 1)
+        self.assertEquals(snapshot['in_flight'], 0)
+
+        self.assertRaises(ValueError, metrics.add_hook, 'nope', hook)
+
+    def test_failing_hook_is_logged(self):
+        metrics = Metrics()
+        metrics.add_hook('retry', Mock(side_effect=ValueError()))
+        metrics.retry('GET', '/', 0, None)
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEquals(metrics.counters['retries'], 1)
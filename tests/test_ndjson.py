@@ -0,0 +1,110 @@
+"""Tests for the ndjson module."""
+
+import gzip
+import json
+
+from twisted.internet.defer import succeed
+from twisted.trial.unittest import TestCase
+
+from txes2.ndjson import (
+    bulk_batches, bulk_entries, export_ndjson, import_ndjson, parse_args)
+
+from .helpers import FakeClientMixin
+
+
+DATA = (
+    b'{"index":{"_index":"idx","_type":"doc","_id":1}}\n{"n":1}\n'
+    b'{"delete":{"_index":"idx","_type":"doc","_id":2}}\n'
+    b'\n'
+    b'{"create":{"_index":"idx","_type":"doc","_id":3}}\n{"n":3}')
+
+
+class NDJSONTest(FakeClientMixin, TestCase):
+
+    """Tests for NDJSON export and import."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.requests = []
+        self.pages = [[1, 2], [3]]
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        if path == '/_bulk':
+            data = ''.join(body.chunks)
+            self.requests.append(data)
+            return succeed({'items': [
+                {'index': {'status': 201}}
+                for line in data.splitlines() if '_index' in line]})
+        if method == 'DELETE':
+            return succeed({})
+        page = self.pages.pop(0) if self.pages else []
+        return succeed({'_scroll_id': 's', 'hits': {'hits': [
+            {'_index': 'idx', '_type': 'doc', '_id': i, '_source': {'n': i}}
+            for i in page]}})
+
+    def _import(self, path, **kwargs):
+        d = import_ndjson(self.es, path, cooperate=self.cooperate, **kwargs)
+        self._run_steps()
+        return self.successResultOf(d)
+
+    def test_bulk_entries_slice_the_data(self):
+        entries = list(bulk_entries(DATA))
+        self.assertEquals([action for action, _ in entries], [None] * 3)
+        self.assertEquals(
+            b''.join(chunks[0] for _, chunks in entries),
+            DATA.replace(b'\n\n', b'\n') + b'\n')
+
+        entries = list(bulk_entries(DATA, index='other'))
+        self.assertEquals(entries[1][0], {'delete': {
+            '_index': 'other', '_type': 'doc', '_id': 2}})
+        self.assertTrue(entries[2][1][0].endswith(b'}\n{"n":3}\n'))
+
+    def test_bulk_batches(self):
+        entries = list(bulk_entries(DATA))
+        self.assertEquals(
+            [len(batch) for batch in bulk_batches(entries, max_actions=2)],
+            [2, 1])
+        self.assertEquals(
+            [len(batch) for batch in bulk_batches(entries, max_bytes=110)],
+            [2, 1])
+
+    def test_export_then_import(self):
+        path = self.mktemp()
+        count = self.successResultOf(export_ndjson(self.es, path))
+        self.assertEquals(count, 3)
+        with open(path, 'rb') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEquals(lines[:2], [
+            {'index': {'_index': 'idx', '_type': 'doc', '_id': 1}},
+            {'n': 1}])
+        self.assertEquals(len(lines), 6)
+
+        result = self._import(path, max_actions=2)
+        self.assertEquals(result.success, 3)
+        self.assertEquals(len(self.requests), 2)
+        with open(path, 'rb') as f:
+            self.assertEquals(''.join(self.requests), f.read())
+
+    def test_gzip_export_and_import_into_another_index(self):
+        path = self.mktemp() + '.gz'
+        self.successResultOf(export_ndjson(self.es, path))
+        with gzip.open(path) as f:
+            self.assertEquals(len(f.readlines()), 6)
+
+        result = self._import(path, index='copy')
+        self.assertEquals(result.success, 3)
+        self.assertEquals(json.loads(self.requests[0].splitlines()[0]),
+                          {'index': {'_index': 'copy', '_type': 'doc',
+                                     '_id': 1}})
+
+    def test_import_empty_file(self):
+        path = self.mktemp()
+        open(path, 'wb').close()
+        self.assertEquals(self._import(path).success, 0)
+
+    def test_parse_args(self):
+        options = parse_args(['--server', 'es:9200', 'import', 'in.ndjson',
+                              '--index', 'copy'])
+        self.assertEquals(options.command, 'import')
+        self.assertEquals(options.server, ['es:9200'])
+        self.assertEquals(options.index, 'copy')
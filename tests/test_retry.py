@@ -0,0 +1,53 @@
+"""Tests for the retry module."""
+
+from twisted.internet.error import ConnectionRefusedError
+from twisted.trial.unittest import TestCase
+
+from txes2.exceptions import ElasticSearchException
+from txes2.retry import is_rejected_execution, RetryPolicy
+
+
+class RetryPolicyTest(TestCase):
+
+    """Tests for the RetryPolicy class."""
+
+    def test_node_failures_are_retryable(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable(ConnectionRefusedError()))
+        self.assertTrue(
+            policy.is_retryable(ElasticSearchException('', 503)))
+        self.assertFalse(
+            policy.is_retryable(ElasticSearchException('', 400)))
+
+    def test_rejected_execution(self):
+        error = ElasticSearchException(
+            'es_rejected_execution_exception', 429,
+            {'error': {'type': 'es_rejected_execution_exception'}})
+        self.assertTrue(is_rejected_execution(error))
+        self.assertTrue(RetryPolicy().is_retryable(error))
+        self.assertFalse(RetryPolicy().is_node_failure(error))
+        self.assertFalse(
+            RetryPolicy(retry_rejected=False).is_retryable(error))
+
+    def test_other_429_is_not_rejection(self):
+        error = ElasticSearchException('circuit_breaking_exception', 429, {})
+        self.assertFalse(is_rejected_execution(error))
+
+    def test_delay_is_bounded(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.5)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.delay(attempt) <= 0.5)
+
+    def test_budget(self):
+        policy = RetryPolicy(budget_ratio=0.5, budget_burst=1)
+        self.assertTrue(policy.acquire_retry())
+        self.assertFalse(policy.acquire_retry())
+
+        policy.record_request()
+        policy.record_request()
+        self.assertTrue(policy.acquire_retry())
+        self.assertFalse(policy.acquire_retry())
+
+    def test_budget_disabled(self):
+        policy = RetryPolicy(budget_ratio=None, budget_burst=0)
+        self.assertTrue(policy.acquire_retry())
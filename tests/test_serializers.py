@@ -0,0 +1,94 @@
+"""Tests for the serializers module."""
+
+import itertools
+import json
+
+from mock import Mock
+
+from twisted.trial.unittest import TestCase
+
+from txes2.serializers import (
+    get_codec, JSONCodec, RawCodec, RawJSON, UJSONCodec)
+
+
+class SerializersTest(TestCase):
+
+    """Tests for the serializers module."""
+
+    def test_get_codec_defaults_to_json(self):
+        self.assertTrue(isinstance(get_codec(), JSONCodec))
+
+    def test_get_codec_by_name(self):
+        self.assertTrue(isinstance(get_codec('raw'), RawCodec))
+        self.assertRaises(ValueError, get_codec, 'yaml')
+
+    def test_get_codec_returns_instances_untouched(self):
+        codec = RawCodec()
+        self.assertTrue(get_codec(codec) is codec)
+
+    def test_json_codec_round_trip(self):
+        codec = JSONCodec()
+        data = codec.encode({'a': [1, 2]})
+        self.assertEquals(data, '{"a":[1,2]}')
+        self.assertEquals(codec.decode(data), {'a': [1, 2]})
+
+    def test_ujson_codec_uses_module(self):
+        module = Mock()
+        module.dumps.return_value = '{}'
+        codec = UJSONCodec(module)
+        self.assertEquals(codec.encode({}), '{}')
+        module.dumps.assert_called_once_with({})
+
+    def test_codecs_pass_raw_json_through(self):
+        data = RawJSON('{"a":1}')
+        self.assertTrue(JSONCodec().encode(data) is data)
+        module = Mock()
+        self.assertTrue(UJSONCodec(module).encode(data) is data)
+        self.assertFalse(module.dumps.called)
+
+    def test_raw_codec_passes_bytes_through(self):
+        codec = RawCodec()
+        self.assertEquals(codec.encode('{"a":1}'), '{"a":1}')
+        self.assertEquals(codec.encode({'a': 1}), '{"a":1}')
+        self.assertEquals(codec.decode('{"a":1}'), {'a': 1})
+        decoder = codec.decoder()
+        decoder.feed('{"a":1}')
+        self.assertEquals(decoder.close(), {'a': 1})
+
+    def test_streaming_decoder(self):
+        decoder = JSONCodec().decoder()
+        decoder.feed(b'{"a"')
+        decoder.feed(b': 1}')
+        self.assertEquals(decoder.close(), {'a': 1})
+        self.assertTrue(decoder.close() is None)
+
+    def _feed(self, codec, data, size):
+        decoder = codec.decoder()
+        held = 0
+        for i in range(0, len(data), size):
+            decoder.feed(data[i:i + size])
+            held = max(held, len(decoder._buf))
+        return decoder.close(), held
+
+    def test_streaming_decoder_decodes_hits_as_they_arrive(self):
+        doc = {'took': 2, 'hits': {'total': 100, 'hits': [
+            {'_id': str(i), '_source': {'text': u'a "[{,}]" \\ \xe9\n'}}
+            for i in range(100)]}, 'items': [{'index': {'status': 201}}],
+            'aggregations': {'top': {'hits': {'hits': [1, [2]]}}}}
+        data = json.dumps(doc)
+        codecs = [JSONCodec(), UJSONCodec(json)]
+        for codec, size in itertools.product(codecs, (1, 7, 64, 1024)):
+            result, held = self._feed(codec, data, size)
+            self.assertEquals(result, doc)
+            self.assertTrue(held < 200 + size, (codec, size, held))
+
+    def test_streaming_decoder_waits_for_complete_values(self):
+        result, _ = self._feed(
+            JSONCodec(), b'{"items": [12, 345, "a\\"b"] }', 1)
+        self.assertEquals(result, {'items': [12, 345, 'a"b']})
+
+    def test_streaming_decoder_rejects_incomplete_documents(self):
+        decoder = JSONCodec().decoder()
+        decoder.feed(b'{"hits": {"hits": [{"_id": 1}, {"_id"')
+        self.assertRaises(ValueError, decoder.close)
+        self.assertTrue(decoder.close() is None)
@@ -0,0 +1,168 @@
+"""Tests for the spool module."""
+
+import os
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from txes2.bulk import encode_bulk_action, make_bulk_action
+from txes2.serializers import JSONCodec
+from txes2.spool import BulkSpool
+
+from .helpers import FakeClientMixin
+
+
+def _entry(i, size=0):
+    action = make_bulk_action('index', 'idx', 'doc', id=i)
+    return action, encode_bulk_action(
+        JSONCodec(), action, {'n': i, 'pad': 'x' * size})
+
+
+class BulkSpoolTest(TestCase):
+
+    """Tests for the BulkSpool class."""
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def _spool(self, **kwargs):
+        spool = BulkSpool(self.path, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def _ids(self, entries):
+        return [action['index']['_id'] for action, _ in entries]
+
+    def test_take_returns_appended_entries(self):
+        spool = self._spool()
+        for i in range(1, 4):
+            spool.append(*_entry(i))
+        self.assertEquals(len(spool), 3)
+
+        entries = spool.take(max_actions=2)
+        self.assertEquals(self._ids(entries), [1, 2])
+        self.assertEquals(entries[0][1], [''.join(_entry(1)[1])])
+        self.assertEquals(len(spool), 1)
+        self.assertEquals(self._ids(spool.take()), [3])
+        self.assertEquals(spool.size, 0)
+
+    def test_uncommitted_entries_are_replayed_on_reopen(self):
+        spool = BulkSpool(self.path)
+        for i in range(1, 4):
+            spool.append(*_entry(i))
+        spool.take(max_actions=1)
+        spool.commit(spool.position)
+        spool.take()
+        spool.close()
+
+        spool = self._spool()
+        self.assertEquals(len(spool), 2)
+        self.assertEquals(self._ids(spool.take()), [2, 3])
+
+    def test_rewind(self):
+        spool = self._spool()
+        for i in range(1, 4):
+            spool.append(*_entry(i))
+        spool.take(max_actions=1)
+        spool.commit(spool.position)
+        spool.take()
+        self.assertEquals(len(spool), 0)
+
+        spool.rewind()
+        self.assertEquals(len(spool), 2)
+        self.assertEquals(self._ids(spool.take()), [2, 3])
+
+    def test_segments_roll_over_and_are_deleted_once_committed(self):
+        spool = self._spool(segment_size=256)
+        for i in range(1, 6):
+            spool.append(*_entry(i, size=100))
+        self.assertTrue(len(spool.segments) > 2)
+        self.assertEquals(self._ids(spool.take()), [1, 2, 3, 4, 5])
+
+        spool.commit(spool.position)
+        self.assertEquals(len(spool.segments), 1)
+        self.assertEquals(
+            len([n for n in os.listdir(self.path) if n.endswith('.seg')]), 1)
+
+    def test_records_larger_than_a_segment(self):
+        spool = self._spool(segment_size=64)
+        spool.append(*_entry(1, size=200))
+        self.assertEquals(self._ids(spool.take()), [1])
+
+    def test_torn_record_is_dropped_on_reopen(self):
+        spool = BulkSpool(self.path)
+        spool.append(*_entry(1))
+        spool.append(*_entry(2))
+        segment = spool.segments[0]
+        # Corrupt the last byte of the second record, as a crash would.
+        segment.map[segment.end - 1] = b'?'
+        spool.close()
+
+        spool = self._spool()
+        self.assertEquals(len(spool), 1)
+        spool.append(*_entry(3))
+        self.assertEquals(self._ids(spool.take()), [1, 3])
+
+
+class SpooledBulkProcessorTest(FakeClientMixin, TestCase):
+
+    """Tests for a BulkProcessor with a spool."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.requests = []
+        self.spool = BulkSpool(self.mktemp())
+        self.addCleanup(self.spool.close)
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        d = Deferred()
+        self.requests.append((''.join(body.chunks).count('\n') // 2, d))
+        return d
+
+    def _processor(self):
+        return self.es.bulk_processor(
+            max_actions=2, spool=self.spool, retry_interval=10,
+            clock=self.clock, on_response=lambda result: None)
+
+    def _ok(self, i, count):
+        self.requests[i][1].callback(
+            {'items': [{'index': {'status': 201}}] * count})
+
+    def test_commits_answered_batches(self):
+        processor = self._processor()
+        for i in range(1, 5):
+            processor.index({'n': i}, 'idx', 'doc', id=i)
+        self.assertEquals(len(self.requests), 1)
+
+        self._ok(0, 2)
+        self.assertEquals(len(self.requests), 2)
+        self.assertTrue((0, 0) < self.spool.committed < self.spool.position)
+        self._ok(1, 2)
+        self.assertEquals(self.spool.committed, self.spool.position)
+        self.spool.rewind()
+        self.assertEquals(len(self.spool), 0)
+
+    def test_resends_unacknowledged_actions_after_an_outage(self):
+        processor = self._processor()
+        for i in range(1, 5):
+            processor.index({'n': i}, 'idx', 'doc', id=i)
+        self.requests[0][1].errback(IOError('cluster down'))
+        self.assertEquals(len(self.requests), 1)
+        self.assertEquals(len(self.spool), 4)
+
+        self.clock.advance(10)
+        self.assertEquals(len(self.requests), 2)
+        self._ok(1, 2)
+        self._ok(2, 2)
+        self.assertEquals(len(self.spool), 0)
+        self.assertEquals(self.spool.committed, self.spool.position)
+
+    def test_replays_spool_left_by_previous_process(self):
+        for i in range(1, 4):
+            self.spool.append(*_entry(i))
+        self._processor()
+        self.assertEquals(self.requests, [])
+        self.clock.advance(0)
+        self.assertEquals([count for count, _ in self.requests], [2])
+        self._ok(0, 2)
+        self.assertEquals([count for count, _ in self.requests], [2, 1])
@@ -1,18 +1,31 @@
 """Tests for the utils module."""
 
 import sys
-from mock import patch
+from mock import Mock, patch
 
+from twisted.internet.defer import Deferred, succeed
 from twisted.trial.unittest import TestCase
 
-from txes2.utils import ServerList
-from txes2.exceptions import NoServerAvailable
+from txes2.utils import (
+    get_selector, LatencySelector, make_path, request_key, RoundRobinSelector,
+    Scroller, SearchAfter, ServerList, SingleFlight)
+from txes2.exceptions import InvalidQuery, NoServerAvailable
+
+from .helpers import FakeClientMixin
 
 
 class UtilsTest(TestCase):
 
     """Tests for the util modules."""
 
+    def test_make_path_quotes_components(self):
+        self.assertEquals(make_path(['idx', 'doc', 'some/id']),
+                          '/idx/doc/some%2Fid')
+        self.assertEquals(make_path(['idx', None, 12, '_update']),
+                          '/idx/12/_update')
+        self.assertEquals(make_path(['idx', 'doc', 'some/id']),
+                          '/idx/doc/some%2Fid')
+
     def test_get_returns_exception_when_empty(self):
         s = ServerList([])
         self.assertRaises(NoServerAvailable, s.get)
@@ -35,3 +48,296 @@ class UtilsTest(TestCase):
         time_mock.time.return_value = 1
         s.get()
         self.assertTrue('srv2' not in s)
+
+    def test_round_robin_selector(self):
+        s = ServerList(['srv1', 'srv2'], selector='round_robin')
+        self.assertEquals([s.get() for _ in range(4)],
+                          ['srv1', 'srv2', 'srv1', 'srv2'])
+
+    def test_unknown_selector(self):
+        self.assertRaises(ValueError, get_selector, 'fastest')
+
+    def test_latency_selector_prefers_fast_node(self):
+        s = ServerList(['slow', 'fast'])
+        self.assertTrue(isinstance(s.selector, LatencySelector))
+        s.finish_request('slow', 2.0)
+        s.finish_request('fast', 0.01)
+        self.assertEquals(set(s.get() for _ in range(20)), set(['fast']))
+
+    def test_latency_selector_accounts_for_in_flight(self):
+        selector = LatencySelector()
+        selector.finish('srv1', 0.1)
+        selector.finish('srv2', 0.15)
+        for _ in range(3):
+            selector.start('srv1')
+        self.assertEquals(selector.select(['srv1', 'srv2']), 'srv2')
+
+    def test_latency_selector_unsampled_node_in_flight(self):
+        selector = LatencySelector()
+        selector.finish('srv1', 0.1)
+        selector.finish('srv2', 0.3)
+        for _ in range(3):
+            selector.start('new')
+        self.assertEquals(selector.cost('new'), 0.8)
+        self.assertEquals(selector.select(['new', 'srv2']), 'srv2')
+
+        selector = LatencySelector()
+        selector.start('srv1')
+        self.assertEquals(selector.select(['srv1', 'srv2']), 'srv2')
+
+    def test_latency_selector_cancel_keeps_latency(self):
+        selector = LatencySelector()
+        selector.finish('srv1', 0.5)
+        selector.start('srv1')
+        selector.cancel('srv1')
+        self.assertEquals(selector.in_flight['srv1'], 0)
+        self.assertEquals(selector.latency['srv1'], 0.5)
+
+    def test_latency_selector_penalises_failures(self):
+        selector = LatencySelector(decay=1.0, failure_penalty=5)
+        selector.start('srv1')
+        selector.finish('srv1', 0.1, failed=True)
+        self.assertEquals(selector.latency['srv1'], 5)
+        self.assertEquals(selector.in_flight['srv1'], 0)
+
+    def test_mark_dead_forgets_latency(self):
+        s = ServerList(['srv1', 'srv2'])
+        s.finish_request('srv2', 3.0)
+        s.mark_dead('srv2')
+        self.assertTrue('srv2' not in s.selector.latency)
+
+    def test_revive_forgets_latency_recorded_while_dead(self):
+        s = ServerList(['srv1', 'srv2'])
+        s.start_request('srv2')
+        s.mark_dead('srv2')
+        s.finish_request('srv2', 0.1, failed=True)
+        s.finish_request('srv1', 0.1)
+        s.revive('srv2')
+        self.assertTrue('srv2' not in s.selector.latency)
+        self.assertEquals(s.selector.cost('srv2'), s.selector.cost('srv1'))
+
+    def test_round_robin_selector_instance(self):
+        selector = RoundRobinSelector()
+        self.assertTrue(get_selector(selector) is selector)
+
+    @patch('txes2.utils.time')
+    def test_dead_servers_ordered_by_retry_time(self, time_mock):
+        s = ServerList(['srv1', 'srv2', 'srv3'], retry_time=10)
+        time_mock.time.return_value = 5
+        s.mark_dead('srv2')
+        time_mock.time.return_value = 1
+        s.mark_dead('srv3')
+        time_mock.time.return_value = 12
+        self.assertEquals(s.pop_due(), ['srv3'])
+        self.assertEquals(s.dead, [(15, 'srv2')])
+
+    @patch('txes2.utils.time')
+    def test_revived_server_is_half_open(self, time_mock):
+        s = ServerList(['srv1', 'srv2'], retry_time=0, half_open_ratio=0)
+        time_mock.time.return_value = 1
+        s.mark_dead('srv2')
+        self.assertEquals(set(s.get() for _ in range(20)), set(['srv1']))
+        self.assertTrue('srv2' in s.half_open)
+
+        s.finish_request('srv2', 0.01)
+        self.assertFalse(s.half_open)
+
+    @patch('txes2.utils.time')
+    def test_health_checking_stops_passive_revival(self, time_mock):
+        s = ServerList(['srv1', 'srv2'], retry_time=0, health_checking=True)
+        time_mock.time.return_value = 1
+        s.mark_dead('srv2')
+        time_mock.time.return_value = 2
+        s.get()
+        self.assertTrue('srv2' not in s)
+
+        s.revive('srv2')
+        self.assertTrue('srv2' in s)
+        self.assertTrue('srv2' in s.half_open)
+
+    def test_request_key_is_canonical(self):
+        self.assertEquals(
+            request_key('GET', '/_search', {'a': 1, 'b': 2}, {'x': 1, 'y': 2}),
+            request_key('GET', '/_search', {'b': 2, 'a': 1}, {'y': 2, 'x': 1}))
+        self.assertNotEquals(
+            request_key('GET', '/_search', {'a': 1}),
+            request_key('GET', '/_search', {'a': 2}))
+
+    def test_single_flight_shares_request(self):
+        calls = []
+
+        def request():
+            calls.append(Deferred())
+            return calls[-1]
+
+        flight = SingleFlight()
+        d1 = flight.call('key', request)
+        d2 = flight.call('key', request)
+        self.assertEquals(len(calls), 1)
+
+        calls[0].callback({'hits': []})
+        r1 = self.successResultOf(d1)
+        r2 = self.successResultOf(d2)
+        self.assertEquals(r1, r2)
+        self.assertFalse(r1 is r2)
+        self.assertFalse(flight.in_flight)
+
+        flight.call('key', request)
+        self.assertEquals(len(calls), 2)
+
+    def test_single_flight_shares_failures(self):
+        d = Deferred()
+        flight = SingleFlight()
+        d1 = flight.call('key', lambda: d)
+        d2 = flight.call('key', lambda: d)
+        d.errback(ValueError())
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+
+class HitIteratorTest(TestCase):
+
+    """Tests for the HitIterator class."""
+
+    def setUp(self):
+        self.requests = []
+
+    def _send_request(self, method, path, body=None, **kwargs):
+        d = Deferred()
+        self.requests.append((method, body, d))
+        return d
+
+    def _page(self, *ids):
+        return {'_scroll_id': 'sid',
+                'hits': {'hits': [{'_id': i} for i in ids]}}
+
+    def _scroller(self, *ids):
+        es = Mock(_send_request=self._send_request)
+        return Scroller(self._page(*ids), '1m', es)
+
+    def _ids(self, hits, count):
+        return [self.successResultOf(hits.next())['_id']
+                for _ in range(count)]
+
+    def test_prefetches_pages_while_hits_are_consumed(self):
+        hits = self._scroller(1, 2).hits(prefetch=2)
+        self.assertEquals(len(self.requests), 1)
+        self.requests[0][2].callback(self._page(3))
+        self.assertEquals(len(self.requests), 2)
+        self.requests[1][2].callback(self._page(4))
+        self.assertEquals(len(self.requests), 2)
+
+        self.assertEquals(self._ids(hits, 3), [1, 2, 3])
+        self.assertEquals(len(self.requests), 3)
+        self.assertEquals(self._ids(hits, 1), [4])
+
+        d = hits.next()
+        self.assertNoResult(d)
+        self.requests[2][2].callback(self._page())
+        self.assertEquals(self.requests[3][:2],
+                          ('DELETE', {'scroll_id': ['sid']}))
+        self.assertNoResult(d)
+        self.requests[3][2].callback({})
+        self.assertTrue(self.successResultOf(d) is None)
+        self.assertTrue(hits.closed)
+
+    def test_each_deletes_the_scroll_when_the_callback_fails(self):
+        hits = self._scroller(1, 2).hits()
+        seen = []
+
+        def callback(hit):
+            seen.append(hit['_id'])
+            if len(seen) == 2:
+                raise ValueError('boom')
+
+        d = hits.each(callback)
+        self.assertNoResult(d)
+        self.assertEquals(seen, [1, 2])
+        self.requests[0][2].callback(self._page(3))
+        self.assertEquals(self.requests[1][0], 'DELETE')
+        self.requests[1][2].callback({})
+        self.failureResultOf(d, ValueError)
+
+    def test_failed_page_is_raised_after_cleanup(self):
+        hits = self._scroller(1).hits()
+        self.assertEquals(self._ids(hits, 1), [1])
+        d = hits.next()
+        self.requests[0][2].errback(ValueError('down'))
+        self.assertEquals(self.requests[1][0], 'DELETE')
+        self.requests[1][2].callback({})
+        self.failureResultOf(d, ValueError)
+
+    def test_each_counts_hits(self):
+        hits = self._scroller(1, 2).hits()
+        d = hits.each(lambda hit: None)
+        self.requests[0][2].callback(self._page())
+        self.requests[1][2].callback({})
+        self.assertEquals(self.successResultOf(d), 2)
+
+
+class SearchAfterTest(FakeClientMixin, TestCase):
+
+    """Tests for the SearchAfter class."""
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+        self.requests = []
+        self.docs = range(5)
+
+    def _execute(self, method, path, body=None, params=None, **kwargs):
+        self.requests.append((method, path, body, params))
+        if path.endswith('/_pit'):
+            return succeed({'id': 'pit1'})
+        if method == 'DELETE':
+            return succeed({})
+        after = (body.get('search_after') or [-1])[0]
+        docs = [d for d in self.docs if d > after][:body['size']]
+        return succeed({
+            'pit_id': 'pit2' if 'pit' in body else None,
+            'hits': {'hits': [{'_id': d, 'sort': [d, str(d)]}
+                              for d in docs]}})
+
+    def _ids(self, paginator):
+        ids = []
+        self.successResultOf(paginator.hits().each(
+            lambda hit: ids.append(hit['_id'])))
+        return ids
+
+    def test_pages_with_search_after_and_a_tiebreaker(self):
+        paginator = self.successResultOf(self.es.search_after(
+            {'sort': [{'n': 'asc'}]}, 'idx', page_size=2))
+        self.assertEquals(self._ids(paginator), [0, 1, 2, 3, 4])
+        self.assertEquals(self.requests[0][1], '/idx/_search')
+        self.assertEquals(self.requests[0][2]['sort'], [{'n': 'asc'}, '_id'])
+        self.assertEquals(
+            [body.get('search_after') for _, _, body, _ in self.requests],
+            [None, [1, '1'], [3, '3'], [4, '4']])
+
+    def test_resumes_from_a_cursor(self):
+        paginator = self.successResultOf(self.es.search_after(
+            {}, 'idx', page_size=2))
+        cursor = paginator.cursor_after(paginator.results['hits']['hits'][0])
+        self.assertEquals(paginator.cursor, SearchAfter.encode_cursor(
+            [1, '1']))
+
+        resumed = self.successResultOf(self.es.search_after(
+            {}, 'idx', page_size=2, cursor=cursor))
+        self.assertEquals(self._ids(resumed), [1, 2, 3, 4])
+        self.assertRaises(
+            InvalidQuery, SearchAfter, self.es, {}, cursor='not a cursor')
+
+    def test_point_in_time(self):
+        paginator = self.successResultOf(self.es.search_after(
+            {}, 'idx', page_size=3, keep_alive='1m'))
+        self.assertEquals(self.requests[0][:2], ('POST', '/idx/_pit'))
+        self.assertEquals(self.requests[0][3], {'keep_alive': '1m'})
+        self.assertEquals(self.requests[1][1], '/_search')
+        self.assertEquals(self.requests[1][2]['pit'],
+                          {'id': 'pit1', 'keep_alive': '1m'})
+        self.assertEquals(self.requests[1][2]['sort'], ['_shard_doc'])
+
+        self.assertEquals(self._ids(paginator), [0, 1, 2, 3, 4])
+        self.assertEquals(self.requests[2][2]['pit']['id'], 'pit2')
+        self.assertEquals(self.requests[-1][:3],
+                          ('DELETE', '/_pit', {'id': 'pit2'}))
+        self.assertTrue(paginator.pit_id is None)
@@ -0,0 +1,874 @@
+"""Batching of bulk actions."""
+
+import collections
+import itertools
+import zlib
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure, log
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implementer
+
+
+#: Item statuses that are re-sent on their own after a backoff.
+RETRY_STATUSES = (429, 503)
+
+#: Error reported for an action the bulk response has no item for.
+MISSING_ITEM = {'type': 'missing_item',
+                'reason': 'no item for the action in the bulk response'}
+
+
+class BulkItemError(collections.namedtuple(
+        'BulkItemError', 'action status error')):
+
+    """A bulk action ES failed, with the error it reported."""
+
+    @property
+    def reason(self):
+        if isinstance(self.error, dict):
+            return self.error.get('reason') or self.error.get('type')
+        return self.error
+
+
+class BulkResult(object):
+
+    """
+    Summary of the outcome of bulk actions.
+
+    :ivar int success: actions that succeeded.
+    :ivar list failed: a :class:`BulkItemError` per failed action.
+    :ivar int retried: times actions were re-sent after ES rejected them.
+    :ivar int took: milliseconds ES reported spending, over every request.
+    """
+
+    def __init__(self):
+        self.success = 0
+        self.failed = []
+        self.retried = 0
+        self.took = 0
+
+    @property
+    def errors(self):
+        return bool(self.failed)
+
+    def merge(self, other):
+        """Add the outcome summarized by ``other`` to this result."""
+        self.success += other.success
+        self.failed.extend(other.failed)
+        self.retried += other.retried
+        self.took += other.took
+
+    def __repr__(self):
+        return '<BulkResult success={} failed={} retried={}>'.format(
+            self.success, len(self.failed), self.retried)
+
+
+def encode_bulk_action(codec, action, source=None):
+    """
+    Return the chunks of the bulk lines for ``action`` and ``source``.
+
+    A ``source`` that is a string is taken to be serialized JSON already
+    and is sent as it is, less any newline: each bulk line must be a
+    single line, and outside of strings, where JSON escapes them, newlines
+    are only whitespace between tokens.
+    """
+    chunks = [codec.encode(action), '\n']
+    if isinstance(source, basestring):
+        if '\n' in source:
+            source = source.replace('\n', '')
+        chunks.extend([source, '\n'])
+    elif source is not None:
+        chunks.extend([codec.encode(source), '\n'])
+    return [c.encode('utf-8') if isinstance(c, unicode) else c
+            for c in chunks]
+
+
+class BulkBuffer(object):
+
+    """
+    Encoded bulk actions, kept as the chunks they were encoded to.
+
+    ``size`` is the running total of their length in bytes. The chunks are
+    sent by a :class:`BulkBodyProducer` as they are, never joined.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def append(self, action, chunks):
+        self.entries.append((action, chunks))
+        self.size += sum(len(c) for c in chunks)
+
+    def take(self, max_actions=None, max_bytes=None):
+        """
+        Remove and return the oldest ``(action, chunks)`` entries.
+
+        Takes at least one entry and as many more as fit in
+        ``max_actions`` and ``max_bytes``.
+        """
+        count, size = 0, 0
+        for _, chunks in self.entries:
+            length = sum(len(c) for c in chunks)
+            if count and (
+                    (max_actions is not None and count >= max_actions) or
+                    (max_bytes is not None and size + length > max_bytes)):
+                break
+            count += 1
+            size += length
+
+        taken, self.entries = self.entries[:count], self.entries[count:]
+        self.size -= size
+        return taken
+
+
+@implementer(IBodyProducer)
+class BulkBodyProducer(object):
+
+    """
+    Stream a list of chunks as a request body.
+
+    Chunks are written as they are, honouring the consumer's flow
+    control. Every call to ``startProducing`` starts from the first chunk,
+    so a request can be retried with the same producer.
+    """
+
+    #: Bytes written per iteration of the cooperator.
+    write_size = 64 * 1024
+
+    def __init__(self, chunks, cooperate=task.cooperate):
+        self.chunks = chunks
+        self.length = sum(len(c) for c in chunks)
+        self._cooperate = cooperate
+        self._task = None
+
+    def gzip(self, level=6):
+        """Return a producer of the gzip compressed body."""
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        chunks = [compressor.compress(c) for c in self.chunks]
+        chunks.append(compressor.flush())
+        return BulkBodyProducer([c for c in chunks if c], self._cooperate)
+
+    def _write_loop(self, consumer):
+        written = 0
+        for chunk in self.chunks:
+            consumer.write(chunk)
+            written += len(chunk)
+            if written >= self.write_size:
+                written = 0
+                yield None
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._write_loop(consumer))
+        d = self._task.whenDone()
+
+        def stopped(reason):
+            reason.trap(task.TaskStopped)
+            return defer.Deferred()
+
+        d.addCallbacks(lambda _: None, stopped)
+        return d
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        try:
+            self._task.stop()
+        except task.TaskFinished:
+            pass
+
+
+def _action_index(action):
+    if action is None:
+        return '_all'
+    return list(action.values())[0].get('_index')
+
+
+def _entry_action(es, entry):
+    """Return the action of an entry, decoding it if it was passed as None."""
+    action, chunks = entry
+    if action is None:
+        data = b''.join(chunks)
+        action = es.codec.decode(data[:data.index(b'\n')])
+    return action
+
+
+@defer.inlineCallbacks
+def send_bulk(es, entries, on_item=None):
+    """
+    Send ``(action, chunks)`` entries as a bulk request.
+
+    An action may be None when its chunks hold its encoded lines; it is
+    then only decoded to report it.
+
+    Each item of the response is matched to its action. Actions rejected
+    with a status in :data:`RETRY_STATUSES` are sent again, on their own,
+    after the backoff of the connection's retry policy and up to its
+    ``max_retries``. Every request sending them again spends a retry from
+    the policy's budget; once it is spent, they are reported as failed.
+    Actions the response has no item for, as when it is empty, are
+    reported as failed with :data:`MISSING_ITEM`. Returns a Deferred
+    firing with a :class:`BulkResult`.
+
+    :param on_item: called as ``on_item(action, ok, item)`` with the final
+                    outcome of every action, ``item`` being what ES
+                    reported for it.
+    """
+    policy = es.connection.retry_policy
+    result = BulkResult()
+
+    def report(entry, info):
+        if 'error' not in info:
+            result.success += 1
+        else:
+            result.failed.append(BulkItemError(
+                _entry_action(es, entry), info.get('status'), info['error']))
+        if on_item is not None:
+            on_item(_entry_action(es, entry), 'error' not in info, info)
+
+    for attempt in itertools.count():
+        body = BulkBodyProducer(
+            [c for _, chunks in entries for c in chunks])
+        response = yield es._send_request(
+            'POST', '/_bulk', body=body, stream=True)
+        response = response or {}
+        result.took += response.get('took') or 0
+
+        items = response.get('items') or []
+        rejected = []
+        for i, entry in enumerate(entries):
+            if i < len(items):
+                info = list(items[i].values())[0]
+            else:
+                info = {'status': None, 'error': MISSING_ITEM}
+            if ('error' in info and
+                    info.get('status') in RETRY_STATUSES and
+                    attempt < policy.max_retries):
+                rejected.append((entry, info))
+            else:
+                report(entry, info)
+
+        if rejected and not policy.acquire_retry():
+            for entry, info in rejected:
+                report(entry, info)
+            rejected = []
+        if not rejected:
+            break
+        result.retried += len(rejected)
+        entries = [entry for entry, _ in rejected]
+        yield policy.sleep(attempt)
+
+    defer.returnValue(result)
+
+
+class AdaptiveBulkSizer(object):
+
+    """
+    Tune the size and concurrency of bulk requests to the cluster's load.
+
+    An additive increase, multiplicative decrease controller: every batch
+    answered within ``target_latency`` seconds without rejections grows
+    the batch size by ``increment`` actions and, once it reaches
+    ``max_actions``, the concurrency by one request. A slower batch, a
+    batch ES rejected items of with a 429 or a request that failed
+    outright multiplies both by ``backoff``. Batches sent before a backoff
+    are not counted again, so a burst of slow responses backs off once.
+
+    Give it to a :class:`BulkProcessor` or to :func:`streaming_bulk` as
+    ``sizer``. The current values are published as the ``bulk_actions``
+    and ``bulk_concurrency`` gauges of ``metrics``, and backoffs are
+    counted as ``bulk_backoffs``. It defaults to the metrics of the client
+    it is used with.
+
+    :param int actions: initial actions per bulk request.
+    :param int concurrency: initial bulk requests in flight.
+    :param float target_latency: seconds a bulk request may take.
+    :param int min_actions: smallest batch size backoffs go down to.
+    :param int max_actions: largest batch size.
+    :param int increment: actions added after a fast batch.
+    :param int min_concurrency: fewest bulk requests in flight.
+    :param int max_concurrency: most bulk requests in flight.
+    :param float backoff: factor applied after a slow or rejected batch.
+    :param metrics: a :class:`txes2.metrics.Metrics` to publish to.
+    """
+
+    def __init__(self, actions=500, concurrency=1, target_latency=1.0,
+                 min_actions=50, max_actions=10000, increment=100,
+                 min_concurrency=1, max_concurrency=4, backoff=0.5,
+                 metrics=None, clock=None):
+        self.actions = actions
+        self.concurrency = concurrency
+        self.target_latency = target_latency
+        self.min_actions = min_actions
+        self.max_actions = max_actions
+        self.increment = increment
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.backoff = backoff
+        self.metrics = metrics
+        self.clock = clock or reactor
+        self.epoch = 0
+        self._publish()
+
+    def bind(self, es):
+        """Publish to the metrics of ``es`` unless given metrics."""
+        if self.metrics is None:
+            self.metrics = getattr(es.connection, 'metrics', None)
+            self._publish()
+
+    def _publish(self):
+        if self.metrics is not None:
+            self.metrics.gauges['bulk_actions'] = self.actions
+            self.metrics.gauges['bulk_concurrency'] = self.concurrency
+
+    def started(self):
+        """Return the token to give to :meth:`finished` for a batch."""
+        return self.clock.seconds(), self.epoch
+
+    def finished(self, result, token):
+        """Adjust to the outcome of a batch, passing ``result`` through."""
+        start, epoch = token
+        if isinstance(result, failure.Failure):
+            congested = True
+        else:
+            congested = bool(result.retried) or any(
+                error.status == 429 for error in result.failed)
+        self.observe(self.clock.seconds() - start, congested, epoch)
+        return result
+
+    def observe(self, latency, congested=False, epoch=None):
+        """
+        Adjust to a batch that took ``latency`` seconds.
+
+        :param bool congested: whether ES rejected the batch.
+        :param int epoch: :attr:`epoch` when the batch was sent; batches
+                          sent before the last backoff are ignored.
+        """
+        if epoch is not None and epoch != self.epoch:
+            return
+        if congested or latency > self.target_latency:
+            self.actions = max(
+                self.min_actions, int(self.actions * self.backoff))
+            self.concurrency = max(
+                self.min_concurrency, int(self.concurrency * self.backoff))
+            self.epoch += 1
+            if self.metrics is not None:
+                self.metrics.counters['bulk_backoffs'] += 1
+        elif self.actions < self.max_actions:
+            self.actions = min(
+                self.max_actions, self.actions + self.increment)
+        else:
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1)
+        self._publish()
+
+
+def make_bulk_action(op_type, index, doc_type, id=None, parent=None,
+                     version=None, routing=None):
+    """Build the action line of a bulk ``op_type`` request."""
+    meta = {'_index': index, '_type': doc_type}
+    if parent:
+        meta['_parent'] = parent
+    if version:
+        meta['_version'] = version
+    if id:
+        meta['_id'] = id
+    if routing:
+        meta['_routing'] = routing
+    return {op_type: meta}
+
+
+_META_FIELDS = ('_index', '_type', '_id', '_parent', '_version', '_routing')
+
+
+def expand_action(data, index=None, doc_type=None):
+    """
+    Split an item of a ``streaming_bulk`` iterable into action and source.
+
+    ``data`` is either an ``(action, source)`` tuple, as taken by
+    :meth:`BulkProcessor.add`, or a document dict whose ``_op_type``
+    (default ``'index'``), ``_index``, ``_type``, ``_id``, ``_parent``,
+    ``_version`` and ``_routing`` keys give the action. Its source is
+    either its ``_source`` key or every other key.
+    """
+    if isinstance(data, tuple):
+        return data
+
+    data = dict(data)
+    op_type = data.pop('_op_type', 'index')
+    meta = {'_index': index, '_type': doc_type}
+    for field in _META_FIELDS:
+        if field in data:
+            meta[field] = data.pop(field)
+
+    if op_type == 'delete':
+        source = None
+    else:
+        source = data.pop('_source', data)
+    return {op_type: meta}, source
+
+
+def streaming_bulk(es, actions, index=None, doc_type=None, chunk_size=500,
+                   max_bytes=5 * 1024 * 1024, max_concurrent_requests=2,
+                   on_item=None, sizer=None, cooperate=task.cooperate):
+    """
+    Index every action of an iterable, pulling them as they are needed.
+
+    Actions are read from ``actions`` by a cooperative task, so the reactor
+    keeps serving other work, and sent in batches of ``chunk_size`` actions
+    or ``max_bytes`` bytes. Reading pauses while ``max_concurrent_requests``
+    batches are in flight, so a lazy iterable such as a database cursor is
+    only read as fast as ES indexes it.
+
+    Returns a Deferred firing with a :class:`BulkResult` of every action.
+    If a batch cannot be sent at all, no more actions are read and the
+    Deferred fails once the batches in flight complete.
+
+    :param actions: iterable of items understood by :func:`expand_action`.
+    :param str index: default index of the actions.
+    :param str doc_type: default type of the actions.
+    :param on_item: called as ``on_item(action, ok, item)`` once the batch
+                    of each action completes.
+    :param sizer: an :class:`AdaptiveBulkSizer` choosing the batch size
+                  and concurrency instead of ``chunk_size`` and
+                  ``max_concurrent_requests``.
+    """
+    if sizer is not None:
+        sizer.bind(es)
+
+    def batches():
+        buf = BulkBuffer()
+        for data in actions:
+            action, source = expand_action(data, index, doc_type)
+            buf.append(action, encode_bulk_action(es.codec, action, source))
+            size = chunk_size if sizer is None else sizer.actions
+            if len(buf) >= size or buf.size >= max_bytes:
+                yield buf.entries
+                buf = BulkBuffer()
+            else:
+                yield None
+
+        if buf:
+            yield buf.entries
+
+    return send_batches(
+        es, batches(), max_concurrent_requests, on_item, sizer, cooperate)
+
+
+def send_batches(es, batches, max_concurrent_requests=2, on_item=None,
+                 sizer=None, cooperate=task.cooperate):
+    """
+    Send every batch of ``(action, chunks)`` entries an iterable yields.
+
+    Batches are pulled by a cooperative task, one at a time while fewer
+    than ``max_concurrent_requests`` (or the concurrency of ``sizer``)
+    are in flight. The iterable may yield None to hand control back to
+    the reactor between batches. This is the engine of
+    :func:`streaming_bulk`, see it for the result and error handling.
+    """
+    result = BulkResult()
+    in_flight = []
+    waiting = []
+    errors = []
+
+    def concurrency():
+        if sizer is not None:
+            return sizer.concurrency
+        return max_concurrent_requests
+
+    def sent(batch_result, d):
+        in_flight.remove(d)
+        if isinstance(batch_result, failure.Failure):
+            errors.append(batch_result)
+        else:
+            result.merge(batch_result)
+        if waiting and len(in_flight) < concurrency():
+            waiting.pop(0).callback(None)
+
+    def send(_, entries):
+        if errors:
+            return
+        d = send_bulk(es, entries, on_item)
+        if sizer is not None:
+            d.addBoth(sizer.finished, sizer.started())
+        d.addBoth(es._invalidate,
+                  set(_action_index(action) for action, _ in entries))
+        in_flight.append(d)
+        d.addBoth(sent, d)
+
+    def room():
+        """Fire once another batch may be sent."""
+        if len(in_flight) < concurrency():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        waiting.append(d)
+        return d
+
+    def work():
+        for entries in batches:
+            if errors:
+                break
+            if entries is None:
+                yield None
+            else:
+                yield room().addCallback(send, entries)
+        yield defer.DeferredList(list(in_flight))
+
+    def done(_):
+        if errors:
+            return errors[0]
+        return result
+
+    es.refreshed = False
+    return cooperate(work()).whenDone().addCallback(done)
+
+
+class BulkProcessor(object):
+
+    """
+    Buffer bulk actions and send them in batches.
+
+    A batch is sent as soon as ``max_actions`` actions or ``max_bytes``
+    bytes are buffered, or ``flush_interval`` seconds after the first
+    action was buffered, whichever comes first. At most
+    ``max_concurrent_requests`` bulk requests are in flight at once.
+
+    :meth:`add`, :meth:`index` and :meth:`delete` return a Deferred that
+    fires once the action is buffered and the buffer has room again, so
+    producers that wait on it are slowed down to the rate ES accepts
+    documents at.
+
+    :param es: the :class:`txes2.Elasticsearch` client to send with.
+    :param int max_actions: actions per bulk request.
+    :param int max_bytes: bytes per bulk request.
+    :param float flush_interval: longest time in seconds an action is
+                                 buffered for, or None to only flush when
+                                 the buffer is full.
+    :param int max_concurrent_requests: bulk requests allowed in flight.
+    :param on_response: called with the :class:`BulkResult` of every
+                        batch, or with the Failure of a batch that could
+                        not be sent. Failures and failed actions are
+                        logged when not set.
+    :param spool: a :class:`txes2.spool.BulkSpool` to buffer actions in
+                  instead of memory. Actions are then only dropped from
+                  the spool once ES has answered for them. When a batch
+                  cannot be sent, sending stops and resumes from the last
+                  acknowledged action ``retry_interval`` seconds later.
+                  Actions left in the spool by a previous process are
+                  sent straight away. :meth:`add` never waits as the disk
+                  absorbs the backlog.
+    :param float retry_interval: seconds between attempts to drain a spool
+                                 while the cluster is unavailable.
+    :param sizer: an :class:`AdaptiveBulkSizer` adjusting ``max_actions``
+                  and ``max_concurrent_requests`` after every batch.
+                  ``max_bytes`` still caps the size of a request.
+    """
+
+    def __init__(self, es, max_actions=500, max_bytes=5 * 1024 * 1024,
+                 flush_interval=1.0, max_concurrent_requests=1,
+                 on_response=None, spool=None, retry_interval=5,
+                 sizer=None, clock=None):
+        self.es = es
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_concurrent_requests = max_concurrent_requests
+        self.sizer = sizer
+        if sizer is not None:
+            sizer.bind(es)
+            self.max_actions = sizer.actions
+            self.max_concurrent_requests = sizer.concurrency
+        self.on_response = on_response
+        self.clock = clock or reactor
+        self.buffer = BulkBuffer() if spool is None else spool
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.in_flight = 0
+        self._draining = False
+        self._timer = None
+        self._waiting = []
+        self._idle = []
+        self._outage = False
+        self._batches = []
+        if spool is not None and len(spool):
+            self._draining = True
+            self.clock.callLater(0, self._pump)
+
+    def add(self, action, source=None):
+        """
+        Buffer a bulk ``action`` and, except for deletes, its ``source``.
+
+        :param dict action: the action line, e.g. ``{'index': {...}}``.
+        :param source: the document, or a string of serialized JSON sent
+                       as it is once newlines are stripped (see
+                       :func:`encode_bulk_action`).
+        """
+        self.es.refreshed = False
+        self.buffer.append(
+            action, encode_bulk_action(self.es.codec, action, source))
+        self._pump()
+
+        if self.spool is not None or not self._full():
+            return defer.succeed(None)
+        waiter = defer.Deferred()
+        self._waiting.append(waiter)
+        return waiter
+
+    def index(self, doc, index, doc_type, id=None, parent=None,
+              force_insert=False, version=None, routing=None):
+        """
+        Buffer the indexing of ``doc``.
+
+        A string ``doc`` is serialized JSON, as for :meth:`add`.
+        """
+        action = make_bulk_action(
+            'create' if force_insert else 'index', index, doc_type, id,
+            parent, version, routing)
+        return self.add(action, doc)
+
+    def delete(self, index, doc_type, id, parent=None, version=None,
+               routing=None):
+        """Buffer the deletion of a document."""
+        return self.add(make_bulk_action(
+            'delete', index, doc_type, id, parent, version, routing))
+
+    def flush(self):
+        """
+        Send every buffered action.
+
+        Returns a Deferred firing once the buffer is empty and no bulk
+        request is in flight.
+        """
+        d = defer.Deferred()
+        self._idle.append(d)
+        self._draining = True
+        self._pump()
+        return d
+
+    @property
+    def size(self):
+        """Bytes buffered."""
+        return self.buffer.size
+
+    def _full(self):
+        return (len(self.buffer) >= self.max_actions or
+                self.size >= self.max_bytes)
+
+    def _pump(self):
+        """Send what can be sent, and wake up whoever can go on."""
+        while (self.buffer and not self._outage and
+               self.in_flight < self.max_concurrent_requests and
+               (self._draining or self._full())):
+            self._send()
+
+        if not self.buffer:
+            self._draining = False
+        elif (self._timer is None and self.flush_interval is not None and
+                not self._outage):
+            self._timer = self.clock.callLater(
+                self.flush_interval, self._flush_timer)
+
+        while self._waiting and not self._full():
+            self._waiting.pop(0).callback(None)
+
+        if not self.buffer and not self.in_flight:
+            idle, self._idle = self._idle, []
+            for d in idle:
+                d.callback(None)
+
+    def _flush_timer(self):
+        self._timer = None
+        self._draining = True
+        self._pump()
+
+    def _send(self):
+        """Send the oldest buffered actions as one bulk request."""
+        batch = self.buffer.take(self.max_actions, self.max_bytes)
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        marker = None
+        if self.spool is not None:
+            marker = [self.spool.position, False]
+            self._batches.append(marker)
+
+        self.in_flight += 1
+        d = send_bulk(self.es, batch)
+        if self.sizer is not None:
+            d.addBoth(self.sizer.finished, self.sizer.started())
+        d.addBoth(self.es._invalidate,
+                  set(_action_index(action) for action, _ in batch))
+        d.addBoth(self._sent, marker)
+
+    def _sent(self, result, marker=None):
+        self.in_flight -= 1
+        if self.sizer is not None:
+            self.max_actions = self.sizer.actions
+            self.max_concurrent_requests = self.sizer.concurrency
+        if marker is not None:
+            self._spooled(result, marker)
+
+        if self.on_response is not None:
+            try:
+                self.on_response(result)
+            except Exception:
+                log.err(None, 'Error in bulk on_response')
+        elif isinstance(result, failure.Failure):
+            log.err(result, 'Bulk request failed')
+        elif result.errors:
+            log.msg('{} bulk actions failed, first error: {}'.format(
+                len(result.failed), result.failed[0].reason))
+        self._pump()
+
+    def _spooled(self, result, marker):
+        """Commit the spool up to the oldest batch still unanswered."""
+        if isinstance(result, failure.Failure):
+            self._outage = True
+        else:
+            marker[1] = True
+            position = None
+            while self._batches and self._batches[0][1]:
+                position = self._batches.pop(0)[0]
+            if position is not None:
+                self.spool.commit(position)
+
+        if self._outage and not self.in_flight:
+            # Resend everything unacknowledged once the cluster is back.
+            self._batches = []
+            self.spool.rewind()
+            self.clock.callLater(self.retry_interval, self._resume)
+
+    def _resume(self):
+        self._outage = False
+        self._draining = True
+        self._pump()
+
+
+class ReindexProgress(object):
+
+    """
+    Progress of a :func:`reindex`.
+
+    :ivar int total: hits the source query matched, when ES reported it.
+    :ivar int read: hits read from the source.
+    :ivar int skipped: hits the transform dropped.
+    :ivar result: :class:`BulkResult` of the actions sent to the target.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.started = self.clock.seconds()
+        self.total = None
+        self.read = 0
+        self.skipped = 0
+        self.result = BulkResult()
+
+    @property
+    def elapsed(self):
+        return self.clock.seconds() - self.started
+
+    @property
+    def docs_per_sec(self):
+        """Actions indexed per second, failed ones included."""
+        done = self.result.success + len(self.result.failed)
+        return done / self.elapsed if self.elapsed else None
+
+    def snapshot(self):
+        return {
+            'total': self.total, 'read': self.read, 'skipped': self.skipped,
+            'success': self.result.success,
+            'failed': len(self.result.failed),
+            'retried': self.result.retried, 'elapsed': self.elapsed,
+            'docs_per_sec': self.docs_per_sec,
+        }
+
+    def __repr__(self):
+        return '<ReindexProgress read={} success={} failed={}>'.format(
+            self.read, self.result.success, len(self.result.failed))
+
+
+@defer.inlineCallbacks
+def reindex(es, source_query, source_index, target_index, transform=None,
+            target_client=None, doc_type=None, target_doc_type=None,
+            scroll_timeout='10m', prefetch=2, on_progress=None, clock=None,
+            **kwargs):
+    """
+    Copy the hits of a scan into another index, possibly on another cluster.
+
+    Hits are read with a prefetching :class:`txes2.utils.HitIterator` and
+    indexed by a :class:`BulkProcessor` on ``target_client``, so reading
+    the next pages overlaps with the bulk requests in flight, and reading
+    waits while the processor is full. Items the target rejects with a
+    429 or 503 are retried (see :func:`send_bulk`).
+
+    Returns a Deferred firing with the :class:`ReindexProgress` once every
+    action is answered. If a bulk request fails outright, reading stops,
+    the scroll is cleared and the Deferred fails with that error.
+
+    :param transform: called with each document as a dict of its
+                      ``_index``, ``_type``, ``_id`` and ``_source``,
+                      returns an item understood by :func:`expand_action`
+                      or None to skip the document.
+    :param target_client: the :class:`txes2.Elasticsearch` to index with,
+                          defaults to ``es``.
+    :param str target_doc_type: type of the copies, defaults to the type of
+                                each hit.
+    :param int prefetch: pages read ahead of the bulk requests.
+    :param on_progress: called with the :class:`ReindexProgress` after
+                        every bulk request.
+    :param kwargs: passed to the :class:`BulkProcessor`, e.g.
+                   ``max_actions`` and ``max_concurrent_requests``.
+    """
+    target = target_client or es
+    progress = ReindexProgress(clock)
+    errors = []
+
+    def on_response(result):
+        if isinstance(result, failure.Failure):
+            errors.append(result)
+        else:
+            progress.result.merge(result)
+        if on_progress is not None:
+            on_progress(progress)
+
+    kwargs.setdefault('flush_interval', None)
+    kwargs.setdefault('max_concurrent_requests', 2)
+    processor = target.bulk_processor(on_response=on_response, **kwargs)
+
+    def copy(hit):
+        if errors:
+            errors[0].raiseException()
+        progress.read += 1
+        doc = {'_index': target_index,
+               '_type': target_doc_type or hit.get('_type'),
+               '_id': hit['_id'], '_source': hit.get('_source', {})}
+        if transform is not None:
+            doc = transform(doc)
+            if doc is None:
+                progress.skipped += 1
+                return
+        return processor.add(*expand_action(doc))
+
+    scroller = yield es.scan(
+        source_query, source_index, doc_type, scroll_timeout)
+    if scroller.results:
+        total = scroller.results['hits'].get('total')
+        progress.total = total.get('value') if isinstance(
+            total, dict) else total
+    yield scroller.hits(prefetch).each(copy)
+    yield processor.flush()
+    if errors:
+        errors[0].raiseException()
+    defer.returnValue(progress)
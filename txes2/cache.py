@@ -0,0 +1,145 @@
+"""Client-side cache of read responses."""
+
+import collections
+import fnmatch
+import time
+
+from . import serializers
+
+
+_Entry = collections.namedtuple('_Entry', 'expires indexes data')
+
+
+class ResponseCache(object):
+
+    """
+    A TTL and LRU bounded cache of responses, keyed by normalized request.
+
+    Responses are stored serialized, which keeps the memory accounting exact
+    and hands every hit a fresh copy that callers are free to mutate. The
+    least recently used entries are evicted once either ``max_entries`` or
+    ``max_bytes`` is exceeded.
+
+    Every invalidation bumps a generation counter and records it for the
+    invalidated index. A response is only stored if none of the indexes
+    it was read from was invalidated after the :meth:`generation` taken
+    when its request started, so a read racing a write cannot put the
+    old document back in the cache.
+
+    :param int max_entries: maximum number of cached responses.
+    :param int max_bytes: maximum total size of the cached responses.
+    :param float ttl: default lifetime of an entry in seconds.
+    :param dict index_ttls: lifetimes for specific indexes (or index
+                            patterns such as ``'logs-*'``), overriding
+                            ``ttl``.
+    :param codec: codec used to store responses, defaults to the codec of
+                  the client the cache is attached to.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=5,
+                 index_ttls=None, codec=None, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_ttls = index_ttls or {}
+        self.codec = codec
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._invalidated = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl_for(self, indexes):
+        """Return the shortest TTL configured for any of ``indexes``."""
+        ttls = [ttl for pattern, ttl in self.index_ttls.items()
+                for index in indexes if fnmatch.fnmatchcase(index, pattern)]
+        return min(ttls) if ttls else self.ttl
+
+    def get(self, key):
+        """Return a copy of the cached response for ``key`` or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry.expires <= self.clock():
+            if entry is not None:
+                self.size -= len(entry.data)
+            self.misses += 1
+            return None
+
+        self._entries[key] = entry
+        self.hits += 1
+        return self._codec.decode(entry.data)
+
+    def generation(self):
+        """Return the current generation, to pass to :meth:`put`."""
+        return self._generation
+
+    def _stale(self, indexes, generation):
+        for index, invalidated in self._invalidated.items():
+            if invalidated <= generation:
+                continue
+            for pattern in indexes:
+                if (index == '_all' or pattern == '_all' or
+                        fnmatch.fnmatchcase(index, pattern)):
+                    return True
+        return False
+
+    def put(self, key, indexes, result, ttl=None, generation=None):
+        """
+        Cache ``result`` for the indexes it was read from.
+
+        :param int generation: the :meth:`generation` when the request was
+                               sent; the result is dropped if any of
+                               ``indexes`` was invalidated since.
+        """
+        if generation is not None and self._stale(indexes, generation):
+            return
+        if ttl is None:
+            ttl = self.ttl_for(indexes)
+        if ttl <= 0:
+            return
+
+        data = self._codec.encode(result)
+        if len(data) > self.max_bytes:
+            return
+
+        self._discard(key)
+        self._entries[key] = _Entry(self.clock() + ttl, tuple(indexes), data)
+        self.size += len(data)
+
+        while (len(self._entries) > self.max_entries or
+               self.size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= len(entry.data)
+
+    def invalidate(self, index):
+        """Drop every entry that may contain documents from ``index``."""
+        self._generation += 1
+        self._invalidated[index] = self._generation
+        if index == '_all':
+            self.clear()
+            return
+
+        for key, entry in self._entries.items():
+            for pattern in entry.indexes:
+                if pattern == '_all' or fnmatch.fnmatchcase(index, pattern):
+                    self._discard(key)
+                    break
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    @property
+    def _codec(self):
+        if self.codec is None:
+            self.codec = serializers.JSONCodec()
+        return self.codec
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.data)
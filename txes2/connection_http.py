@@ -1,93 +1,506 @@
+import collections
+import time
 import urllib
+import zlib
 
-from twisted.internet import defer
-from twisted.internet.error import ConnectError
-from twisted.web.client import ResponseFailed, RequestTransmissionFailed
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    HTTPConnectionPool, ResponseDone, ResponseFailed)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.iweb import IBodyProducer
 import treq
-import anyjson
 
-from . import exceptions, utils
+from . import exceptions, metrics, retry, serializers, utils
 
 
-def _prepare_url(server, path, params):
-    """Prepare Elasticsearch connection URL."""
+def _base_url(server):
+    """Return the scheme and host part of URLs for ``server``."""
+    if not server.startswith(('http:', 'https:')):
+        server = 'http://' + server
+    return server.rstrip('/').encode('utf-8')
+
+
+def _path_suffix(path, params):
+    """Return the path and query string part of a URL."""
     if not path.startswith('/'):
         path = '/' + path
 
-    url = server + path
-
     if params:
-        url = url + '?' + urllib.urlencode(params)
+        path = path + '?' + urllib.urlencode(params)
+
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path
+
+
+def _prepare_url(server, path, params):
+    """Prepare Elasticsearch connection URL."""
+    return _base_url(server) + _path_suffix(path, params)
+
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _gzip(data, level=6):
+    """Compress ``data`` into a gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _is_cancelled(error):
+    """Return True if ``error`` comes from cancelling the request."""
+    if isinstance(error, defer.CancelledError):
+        return True
+    reasons = getattr(error, 'reasons', None)
+    return isinstance(error, ResponseFailed) and bool(reasons) and all(
+        reason.check(defer.CancelledError) for reason in reasons)
+
+
+def _add_timeout(d, timeout, clock):
+    """
+    Cancel ``d`` after ``timeout`` seconds and fail it with a TimeoutError.
+
+    Unlike ``Deferred.addTimeout``, the TimeoutError replaces whatever
+    failure the cancellation causes, such as the ``ResponseNeverReceived``
+    an agent raises for a request cancelled in flight.
+    """
+    timed_out = []
+
+    def expire():
+        timed_out.append(True)
+        d.cancel()
+
+    def done(result):
+        if timer.active():
+            timer.cancel()
+        if timed_out and isinstance(result, Failure):
+            raise defer.TimeoutError(timeout, 'Deferred')
+        return result
+
+    timer = clock.callLater(timeout, expire)
+    return d.addBoth(done)
+
 
-    if not url.startswith(('http:', 'https:')):
-        url = "http://" + url
+def _is_gzipped(response):
+    encodings = response.headers.getRawHeaders(b'content-encoding') or []
+    return b'gzip' in encodings
+
+
+class _GzipDecoder(object):
+
+    """Decompress a gzip body chunk by chunk before decoding it."""
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+
+    def feed(self, data):
+        self.decoder.feed(self._decompressor.decompress(data))
+
+    def close(self):
+        self.decoder.feed(self._decompressor.flush())
+        return self.decoder.close()
+
+
+class _JSONBodyReceiver(protocol.Protocol):
+
+    """Feed a response body into a decoder as it arrives."""
+
+    def __init__(self, finished, decoder):
+        self.finished = finished
+        self.decoder = decoder
+        self.length = 0
+        self.error = None
+
+    def dataReceived(self, data):
+        self.length += len(data)
+        if self.error is not None:
+            return
+        try:
+            self.decoder.feed(data)
+        except Exception:
+            self.error = Failure()
+
+    def connectionLost(self, reason):
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+            return
+        if self.error is not None:
+            self.finished.errback(self.error)
+            return
+
+        try:
+            result = self.decoder.close()
+        except Exception:
+            self.finished.errback()
+        else:
+            self.finished.callback((result, self.length))
+
+
+def _stream_json(response, decoder):
+    """
+    Feed the body of ``response`` into ``decoder`` as it is received.
+
+    Returns a Deferred firing with the decoded body and its length. The
+    decoders of :mod:`txes2.serializers` parse the body as it arrives (see
+    :class:`txes2.serializers.StreamingDecoder`).
+    """
+    finished = defer.Deferred()
+    response.deliverBody(_JSONBodyReceiver(finished, decoder))
+    return finished
+
+
+class HealthChecker(object):
+
+    """
+    Periodically probe dead nodes and revive the ones that respond.
+
+    Every ``interval`` seconds, each dead node whose retry time has passed
+    is sent a cheap request to ``path``. Nodes answering with a non-5xx
+    status go back into rotation half-open; the rest are parked for another
+    ``retry_time`` seconds.
+    """
+
+    def __init__(self, connection, interval=5, path='/', timeout=2):
+        self.connection = connection
+        self.interval = interval
+        self.path = path
+        self.timeout = timeout
+        self._loop = task.LoopingCall(self.check)
 
-    return url.encode('utf-8')
+    def start(self):
+        self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def check(self):
+        servers = self.connection.servers
+        return defer.DeferredList(
+            [self.probe(server) for server in servers.pop_due()])
+
+    def probe(self, server):
+        """Probe a single node, returning a Deferred firing with the result."""
+        servers = self.connection.servers
+
+        def cb(response):
+            if response.code >= 500:
+                servers.reschedule(server)
+                return False
+            servers.revive(server)
+            return True
+
+        def eb(failure):
+            servers.reschedule(server)
+            return False
+
+        url = self.connection.base_url(server) + _path_suffix(self.path, None)
+        d = defer.maybeDeferred(
+            treq.request, 'HEAD', url, pool=self.connection.pool,
+            auth=self.connection.http_auth,
+            persistent=self.connection.persistent, timeout=self.timeout)
+        d.addCallbacks(cb, eb)
+        return d
 
 
 class HTTPConnection(object):
     def add_server(self, server):
         if server not in self.servers:
             self.servers.append(server)
+            self.base_url(server)
+
+    def base_url(self, server):
+        """Return the precomputed base URL for ``server``."""
+        try:
+            return self.base_urls[server]
+        except KeyError:
+            url = self.base_urls[server] = _base_url(server)
+            return url
 
     def connect(
         self, servers=None, timeout=None, retry_time=10, *args, **kwargs
     ):
         if isinstance(servers, (str, unicode)):
             servers = [servers]
-        self.servers = utils.ServerList(servers, retry_time=retry_time)
+        health_check_interval = kwargs.get('health_check_interval')
+        self.servers = utils.ServerList(
+            servers, retry_time=retry_time, selector=kwargs.get('selector'),
+            half_open_ratio=kwargs.get('half_open_ratio', 0.1),
+            timeout=timeout, health_checking=bool(health_check_interval))
         self.agents = {}
         self.timeout = timeout
+        self.base_urls = dict((s, _base_url(s)) for s in self.servers)
 
         self.persistent = kwargs.get('persistent', True)
         self.pool = kwargs.get('pool')
         self.http_auth = kwargs.get('http_auth')
-        self.max_retries = kwargs.get('max_retries', 3)
+        self.retry_policy = kwargs.get('retry_policy') or retry.RetryPolicy(
+            max_retries=kwargs.get('max_retries', 3))
+        self.streaming = kwargs.get('streaming', False)
+        self.codec = serializers.get_codec(kwargs.get('codec'))
+        self.metrics = kwargs.get('metrics') or metrics.Metrics()
+        self.compression = kwargs.get('compression', False)
+        self.compression_threshold = kwargs.get('compression_threshold', 1024)
+
+        self.clock = kwargs.get('clock', reactor)
+        self.hedge_percentile = kwargs.get('hedge_percentile')
+        self.hedge_delay = kwargs.get('hedge_delay', 0.05)
+        self.hedge_min_samples = kwargs.get('hedge_min_samples', 20)
+        self._latencies = collections.deque(
+            maxlen=kwargs.get('hedge_window', 200))
+
+        self.health_checker = None
+        if health_check_interval:
+            self.health_checker = HealthChecker(
+                self, interval=health_check_interval,
+                path=kwargs.get('health_check_path', '/'))
+            self.health_checker.start()
+
+    def pool_stats(self):
+        """Describe how busy the connection pool is."""
+        stats = {'in_flight': self.metrics.in_flight}
+        if isinstance(self.pool, HTTPConnectionPool):
+            stats['idle'] = sum(
+                len(c) for c in self.pool._connections.values())
+            stats['max_persistent_per_host'] = self.pool.maxPersistentPerHost
+        return stats
+
+    def stats(self):
+        """Return a snapshot of the connection's metrics."""
+        stats = self.metrics.snapshot()
+        stats['pool'] = self.pool_stats()
+        return stats
 
     def close(self):
         """Close up all persistent connections."""
+        if self.health_checker:
+            self.health_checker.stop()
         if self.pool:
             return self.pool.closeCachedConnections()
 
     @defer.inlineCallbacks
-    def execute(self, method, path, body=None, params=None):
-        """Execute a query against a server."""
+    def execute(
+        self, method, path, body=None, params=None, stream=None, hedge=False
+    ):
+        """
+        Execute a query against a server.
+
+        :param bool stream: decode the response body incrementally as it
+                            arrives rather than buffering it through
+                            ``treq`` first, so the hits and bulk items of
+                            large responses are never held as raw bytes
+                            all at once.
+                            Defaults to the connection's ``streaming``
+                            setting.
+        :param bool hedge: the request is an idempotent read that may be
+                           duplicated to a second node when hedging is
+                           enabled.
+        """
+        if stream is None:
+            stream = self.streaming
+
+        started = time.time()
         headers = {b'Content-Type': [b'application/json']}
-        if not isinstance(body, basestring):
-            body = anyjson.serialize(body)
+        producer = IBodyProducer.providedBy(body)
+        if body is not None and not (producer or isinstance(body, basestring)):
+            body = self.codec.encode(body)
+
+        if self.compression:
+            headers[b'Accept-Encoding'] = [b'gzip']
+            if producer:
+                # Only producers that know how to compress themselves are.
+                if (hasattr(body, 'gzip') and
+                        body.length >= self.compression_threshold):
+                    body = body.gzip()
+                    headers[b'Content-Encoding'] = [b'gzip']
+            elif body and len(body) >= self.compression_threshold:
+                if isinstance(body, unicode):
+                    body = body.encode('utf-8')
+                body = _gzip(body)
+                headers[b'Content-Encoding'] = [b'gzip']
 
-        for attempt in range(self.max_retries + 1):
-            server = self.servers.get()
-            timeout = self.servers.timeout
-            url = _prepare_url(server, path, params)
+        suffix = _path_suffix(path, params)
+        self.metrics.request_started(
+            method, suffix, time.time() - started,
+            body.length if producer else len(body or ''))
 
-            response = None  # Stop UnboundLocalError on uncaught exception
+        policy = self.retry_policy
+        policy.record_request()
+        request = (method, suffix, body, headers, stream)
+
+        for attempt in range(policy.max_retries + 1):
             try:
-                response = yield treq.request(
-                    method, url, data=body, pool=self.pool,
-                    auth=self.http_auth, persistent=self.persistent,
-                    timeout=timeout, headers=headers)
-                json_data = yield response.json()
-                exceptions.raise_exceptions(response.code, json_data)
-            except Exception as e:
-                retry = False
-
-                if isinstance(
-                    e, (
-                        ConnectError,
-                        ResponseFailed,
-                        RequestTransmissionFailed,
-                    )
-                ) or response and response.code in (503, 504):
-                    retry = True
-
-                if retry:
-                    self.servers.mark_dead(server)
-                    if attempt == self.max_retries:
-                        raise
-
-                    continue
+                if hedge and self.hedge_percentile:
+                    json_data = yield self._hedged_attempt(*request)
                 else:
+                    json_data = yield self._attempt(
+                        self.servers.get(), *request)
+            except Exception as e:
+                if (not policy.is_retryable(e) or
+                        attempt == policy.max_retries or
+                        not policy.acquire_retry()):
                     raise
+                self.metrics.retry(method, suffix, attempt, e)
             else:
                 defer.returnValue(json_data)
+
+            yield policy.sleep(attempt)
+
+    @defer.inlineCallbacks
+    def _attempt(self, server, method, suffix, body, headers, stream,
+                 hedged=False):
+        """
+        Send a single request to ``server`` and decode the response.
+
+        Only the latencies of ``hedged`` attempts feed the hedge delay, so
+        bulk requests and scrolls don't skew it. A cancelled attempt, such
+        as the loser of a hedged request, is neither a node failure nor an
+        error, and records nothing about the node. An attempt taking more
+        than the connection's ``timeout`` seconds, body included, fails
+        with a ``TimeoutError``.
+        """
+        url = self.base_url(server) + suffix
+
+        self.servers.start_request(server)
+        self.metrics.attempt_started()
+        started = time.time()
+
+        try:
+            d = self._request(method, url, body, headers, stream)
+            if self.servers.timeout:
+                _add_timeout(d, self.servers.timeout, self.clock)
+            response, json_data, length, headers_received = yield d
+            exceptions.raise_exceptions(response.code, json_data)
+        except Exception as e:
+            if _is_cancelled(e):
+                self.metrics.attempt_cancelled()
+                self.servers.cancel_request(server)
+                raise
+
+            node_failure = self.retry_policy.is_node_failure(e)
+            self.metrics.attempt_failed()
+            self.servers.finish_request(
+                server, time.time() - started, failed=node_failure)
+
+            if node_failure:
+                self.servers.mark_dead(server)
+                self.metrics.node_dead(server, e)
+            raise
+
+        finished = time.time()
+        latency = finished - started
+        self.servers.finish_request(server, latency)
+        if hedged:
+            self._latencies.append(latency)
+
+        wait = headers_received - started
+        server_time = None
+        if isinstance(json_data, dict) and 'took' in json_data:
+            server_time = min(json_data['took'] / 1000.0, wait)
+            wait -= server_time
+        self.metrics.response(
+            method, suffix, server, response.code, length, wait, server_time,
+            finished - headers_received)
+        defer.returnValue(json_data)
+
+    @defer.inlineCallbacks
+    def _request(self, method, url, body, headers, stream):
+        """
+        Send a request and read its response.
+
+        Returns a Deferred firing with the response, its decoded body, the
+        body's length and when the headers were received.
+        """
+        response = yield treq.request(
+            method, url, data=body, pool=self.pool, auth=self.http_auth,
+            persistent=self.persistent, headers=headers)
+        headers_received = time.time()
+        try:
+            json_data, length = yield self._read_body(response, stream)
+        except ValueError:
+            # Error pages from proxies and overloaded nodes are often
+            # not JSON; let the status code speak for them.
+            if response.code < 400:
+                raise
+            json_data, length = None, 0
+        defer.returnValue((response, json_data, length, headers_received))
+
+    def _read_body(self, response, stream):
+        """Return a Deferred firing with the decoded body and its length."""
+        gzipped = self.compression and _is_gzipped(response)
+        if stream:
+            decoder = self.codec.decoder()
+            if gzipped:
+                decoder = _GzipDecoder(decoder)
+            return _stream_json(response, decoder)
+
+        def decode(content):
+            length = len(content)
+            if gzipped:
+                content = zlib.decompress(content, _GZIP_WBITS)
+            return self.codec.decode(content), length
+
+        return response.content().addCallback(decode)
+
+    def _hedge_delay(self):
+        """Return the latency percentile after which a request is hedged."""
+        if len(self._latencies) < self.hedge_min_samples:
+            return self.hedge_delay
+        samples = sorted(self._latencies)
+        index = int(len(samples) * self.hedge_percentile / 100.0)
+        return samples[min(index, len(samples) - 1)]
+
+    def _hedged_attempt(self, *request):
+        """
+        Send a request, duplicating it to a second node if it is slow.
+
+        The first response wins and the other request is cancelled. A
+        failure is only reported once every request sent has failed.
+        """
+        attempts = []
+
+        def cancel(_):
+            if timer.active():
+                timer.cancel()
+            for d in list(attempts):
+                d.cancel()
+
+        finished = defer.Deferred(cancel)
+
+        def won(result, d):
+            attempts.remove(d)
+            if finished.called:
+                return
+            if timer.active():
+                timer.cancel()
+            finished.callback(result)
+            for other in list(attempts):
+                other.cancel()
+
+        def lost(failure, d):
+            attempts.remove(d)
+            if finished.called or attempts:
+                return
+            if timer.active():
+                timer.cancel()
+            finished.errback(failure)
+
+        def launch(server):
+            d = self._attempt(server, *request, hedged=True)
+            attempts.append(d)
+            d.addCallbacks(won, lost, callbackArgs=(d,), errbackArgs=(d,))
+
+        def hedge():
+            try:
+                server = self.servers.get(exclude=primary)
+            except exceptions.NoServerAvailable:
+                return
+            if server != primary:
+                launch(server)
+
+        primary = self.servers.get()
+        timer = self.clock.callLater(self._hedge_delay(), hedge)
+        launch(primary)
+        return finished
@@ -1,11 +1,17 @@
 """A PyES-like Elasticsearch client for Twisted."""
 
-import anyjson
 from twisted.internet import defer, reactor
+from twisted.python import failure
 
-from . import connection, exceptions
+from . import connection, exceptions, serializers
 
-from .utils import make_path, Scroller
+from .bulk import (
+    BulkBuffer, BulkProcessor, encode_bulk_action, make_bulk_action,
+    reindex, send_bulk, streaming_bulk)
+
+from .utils import (
+    make_path, path_indexes, request_key, Scroller, SearchAfter,
+    SingleFlight)
 
 
 class Elasticsearch(object):
@@ -13,7 +19,8 @@ class Elasticsearch(object):
 
     def __init__(self, servers='127.0.0.1:9200', timeout=30, bulk_size=400,
                  discover=True, retry_time=10, discovery_interval=300,
-                 default_indexes=None, autorefresh=False, *args, **kwargs):
+                 default_indexes=None, autorefresh=False, coalesce_reads=False,
+                 cache=None, *args, **kwargs):
         """
         Init.
 
@@ -33,11 +40,58 @@ class Elasticsearch(object):
         :param list default_indexes: list of indexes to use by default when
                                      querying ES.
         :param bool autorefresh: should we perform index autorefresh.
+        :param bool coalesce_reads: share a single request between identical
+                                    ``get``, ``mget``, ``search`` and
+                                    ``count`` requests in flight at the
+                                    same time. Each caller receives its
+                                    own copy of the response. Searches
+                                    opening a scroll are never shared.
+        :param ResponseCache cache: cache ``search``, ``get`` and ``count``
+                                    responses client-side (see
+                                    :mod:`txes2.cache`). Writes made
+                                    through this client invalidate the
+                                    indexes they touch.
         :param bool persistent: use persistent connection.
         :param tuple http_auth: optional http auth tuple in the form
                                `('username', 'password')`.
         :param HTTPConnectionPool pool: optionally pass in HTTPConnectionPool
                                         instance to use for connection pool.
+        :param bool streaming: decode every response body incrementally as
+                               it arrives (see ``HTTPConnection.execute``).
+                               Searches, scroll pages and bulk requests
+                               are always streamed.
+        :param codec: JSON codec used for every request and response, either
+                      a codec instance or one of ``'json'``, ``'ujson'`` or
+                      ``'raw'``, which sends string bodies untouched (see
+                      :mod:`txes2.serializers`). Responses are always
+                      decoded.
+        :param bool compression: gzip request bodies and ask ES for gzipped
+                                 responses.
+        :param int compression_threshold: smallest request body in bytes that
+                                          will be compressed (default 1024).
+        :param selector: node selection strategy, one of ``'latency'``
+                         (default), ``'random'`` or ``'round_robin'``, or a
+                         selector instance (see :mod:`txes2.utils`).
+        :param int health_check_interval: if set, probe dead nodes every this
+                                          many seconds and only revive them
+                                          once a probe succeeds.
+        :param str health_check_path: path requested by health probes.
+        :param int max_retries: retries allowed per request (default 3).
+        :param RetryPolicy retry_policy: policy controlling retries, backoff
+                                         and the retry budget (see
+                                         :mod:`txes2.retry`).
+        :param float hedge_percentile: enable hedged reads: when a ``get``,
+                                       ``mget``, ``search`` or ``count`` has
+                                       not answered within this percentile
+                                       of recent latencies, send a
+                                       duplicate to another node and use
+                                       whichever answers first.
+        :param float hedge_delay: hedging delay in seconds used until enough
+                                  latencies have been recorded.
+        :param Metrics metrics: collect request metrics into this object
+                                (see :meth:`stats`).
+        :param float half_open_ratio: share of traffic sent to a revived node
+                                      until a request to it succeeds.
         """
         if isinstance(servers, basestring):
             servers = [servers]
@@ -57,11 +111,17 @@ class Elasticsearch(object):
         self.refreshed = True
 
         self.info = {}
-        self.bulk_data = []
-
+        self.bulk_data = BulkBuffer()
+        self.single_flight = SingleFlight() if coalesce_reads else None
+        self.bulk_indexes = set()
+
+        self.codec = serializers.get_codec(kwargs.pop('codec', None))
+        self.cache = cache
+        if cache is not None and cache.codec is None:
+            cache.codec = self.codec
         self.connection = connection.connect(
             servers=servers, timeout=timeout, retry_time=retry_time,
-            *args, **kwargs)
+            codec=self.codec, *args, **kwargs)
         if discover:
             self._perform_discovery()
 
@@ -92,7 +152,8 @@ class Elasticsearch(object):
         return d
 
     def _send_query(
-        self, query_type, query, indexes=None, doc_types=None, **params
+        self, query_type, query, indexes=None, doc_types=None, options=None,
+        **params
     ):
         """Send query to ES."""
         def send_it(result=None):
@@ -104,7 +165,8 @@ class Elasticsearch(object):
                 dt = [dt]
             path = make_path(
                 [','.join(indices), ','.join(dt), query_type])
-            d = self._send_request('GET', path, body=query, params=params)
+            d = self._send_request(
+                'GET', path, body=query, params=params, **(options or {}))
             return d
 
         if self.autorefresh and not self.refreshed:
@@ -114,11 +176,51 @@ class Elasticsearch(object):
         else:
             return send_it()
 
-    def _send_request(self, method, path, body=None, params=None):
+    def _send_request(
+        self, method, path, body=None, params=None, cache=False,
+        cache_ttl=None, **kwargs
+    ):
+        path = str(path)
+        if not cache or self.cache is None or cache_ttl == 0:
+            return self._execute(method, path, body, params, **kwargs)
+
+        key = request_key(method, path, body, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return defer.succeed(cached)
+
+        generation = self.cache.generation()
+
+        def store(result):
+            self.cache.put(
+                key, path_indexes(path), result, cache_ttl, generation)
+            return result
+
+        d = self._execute(method, path, body, params, **kwargs)
+        d.addCallback(store)
+        return d
+
+    def _execute(self, method, path, body=None, params=None, coalesce=False,
+                 **kwargs):
+        if self.single_flight and coalesce:
+            key = request_key(method, path, body, params)
+            return self.single_flight.call(
+                key, self.connection.execute, method, path, body, params,
+                **kwargs)
+
         d = defer.maybeDeferred(self.connection.execute,
-                                method, str(path), body, params)
+                                method, path, body, params, **kwargs)
         return d
 
+    def _invalidate(self, result, indexes):
+        """Drop cached responses for ``indexes`` and pass ``result`` on."""
+        if self.cache is not None:
+            if isinstance(indexes, basestring):
+                indexes = [indexes]
+            for index in indexes:
+                self.cache.invalidate(index)
+        return result
+
     def _validate_indexes(self, indexes=None):
         indices = indexes or self.default_indexes
         if isinstance(indices, basestring):
@@ -140,6 +242,7 @@ class Elasticsearch(object):
     def delete_index(self, index):
         """Delete an index."""
         d = self._send_request('DELETE', index)
+        d.addBoth(self._invalidate, index)
         return d
 
     def get_indices(self, include_aliases=False):
@@ -304,6 +407,7 @@ class Elasticsearch(object):
             indices = self._validate_indexes(indexes)
             path = make_path([','.join(indices), '_refresh'])
             d = self._send_request('POST', path)
+            d.addBoth(self._invalidate, indices)
             d.addCallback(delay)
             return d
 
@@ -451,26 +555,23 @@ class Elasticsearch(object):
         self, doc, index, doc_type, id=None, parent=None,
         force_insert=None, bulk=False, version=None, **query_params
     ):
-        """Index a dict into an index."""
+        """
+        Index a dict into an index.
+
+        ``doc`` may also be a string of serialized JSON, or a
+        :class:`txes2.serializers.RawJSON`, which is sent without being
+        encoded again. With ``bulk`` it must fit on a single line, so its
+        newlines are stripped (see :func:`txes2.bulk.encode_bulk_action`).
+        """
         self.refreshed = False
 
         if bulk:
-            optype = 'index'
-            if force_insert:
-                optype = 'create'
-            cmd = {optype: {'_index': index, '_type': doc_type}}
-            if parent:
-                cmd[optype]['_parent'] = parent
-            if version:
-                cmd[optype]['_version'] = version
-            if id:
-                cmd[optype]['_id'] = id
-            if 'routing' in query_params:
-                cmd[optype]['_routing'] = query_params['routing']
-            data = '\n'.join([anyjson.serialize(cmd),
-                              anyjson.serialize(doc)])
-            data += '\n'
-            self.bulk_data.append(data)
+            cmd = make_bulk_action(
+                'create' if force_insert else 'index', index, doc_type, id,
+                parent, version, query_params.get('routing'))
+            self.bulk_data.append(
+                cmd, encode_bulk_action(self.codec, cmd, doc))
+            self.bulk_indexes.add(index)
             return self.flush_bulk()
 
         if force_insert:
@@ -491,6 +592,7 @@ class Elasticsearch(object):
         d = self._send_request(
             request_method, path, body=doc,
             params=query_params)
+        d.addBoth(self._invalidate, index)
         return d
 
     def flush_bulk(self, forced=False):
@@ -501,38 +603,93 @@ class Elasticsearch(object):
         return self.force_bulk()
 
     def force_bulk(self):
-        """Force executing of all bulk data."""
+        """
+        Force executing of all bulk data.
+
+        Returns a Deferred firing with a :class:`txes2.bulk.BulkResult`.
+        Actions ES rejected with a 429 or 503 are re-sent on their own
+        (see :func:`txes2.bulk.send_bulk`).
+        """
         if not self.bulk_data:
             return defer.succeed(None)
 
-        data = '\n'.join(self.bulk_data)
-        d = self._send_request('POST', '/_bulk', body=data)
-        self.bulk_data = []
+        d = send_bulk(self, self.bulk_data.entries)
+        d.addBoth(self._invalidate, self.bulk_indexes)
+        self.bulk_data = BulkBuffer()
+        self.bulk_indexes = set()
         return d
 
+    def bulk_processor(self, **kwargs):
+        """
+        Return a :class:`txes2.bulk.BulkProcessor` sending through this
+        client.
+
+        Unlike ``index(bulk=True)``, which flushes every ``bulk_size``
+        actions, a processor also flushes on size and on a timer, limits
+        the bulk requests in flight and slows producers down when ES falls
+        behind. Keyword arguments are passed to the processor.
+        """
+        return BulkProcessor(self, **kwargs)
+
+    def streaming_bulk(self, actions, index=None, doc_type=None, **kwargs):
+        """
+        Index every action of an iterable, reading it lazily.
+
+        Actions are batched and sent with bounded concurrency and the
+        iterable is only read as fast as ES accepts them, see
+        :func:`txes2.bulk.streaming_bulk` for the keyword arguments.
+        Returns a Deferred firing with a :class:`txes2.bulk.BulkResult`.
+        """
+        return streaming_bulk(
+            self, actions, index=index, doc_type=doc_type, **kwargs)
+
+    def reindex_client_side(self, source_query, source_index, target_index,
+                            transform=None, target_client=None, **kwargs):
+        """
+        Copy the hits of a query into another index through this client.
+
+        Hits are scanned from ``source_index`` and bulk indexed into
+        ``target_index``, on ``target_client`` when given, with reads and
+        writes overlapping. See :func:`txes2.bulk.reindex` for the keyword
+        arguments. Returns a Deferred firing with a
+        :class:`txes2.bulk.ReindexProgress`.
+        """
+        return reindex(
+            self, source_query, source_index, target_index,
+            transform=transform, target_client=target_client, **kwargs)
+
     def delete(self, index, doc_type, id, bulk=False, **query_params):
         """Delete a document based on its id."""
         if bulk:
-            cmd = {'delete': {'_index': index,
-                              '_type': doc_type,
-                              '_id': id}}
-            self.bulk_data.append(anyjson.serialize(cmd))
+            cmd = make_bulk_action('delete', index, doc_type, id)
+            self.bulk_data.append(cmd, encode_bulk_action(self.codec, cmd))
+            self.bulk_indexes.add(index)
             return self.flush_bulk()
 
         path = make_path([index, doc_type, id])
         d = self._send_request('DELETE', path, params=query_params)
+        d.addBoth(self._invalidate, index)
         return d
 
     def get(
-        self, index, doc_type, id, fields=None, routing=None, **query_params
+        self, index, doc_type, id, fields=None, routing=None, cache_ttl=None,
+        **query_params
     ):
-        """Get a typed document from an index based on its id."""
+        """
+        Get a typed document from an index based on its id.
+
+        :param float cache_ttl: seconds to cache the response for when the
+                                client has a cache, overriding its TTLs;
+                                0 bypasses the cache.
+        """
         path = make_path([index, doc_type, id])
         if fields:
             query_params['fields'] = ','.join(fields)
         if routing:
             query_params['routings'] = routing
-        d = self._send_request('GET', path, params=query_params)
+        d = self._send_request(
+            'GET', path, params=query_params, hedge=True, coalesce=True,
+            cache=True, cache_ttl=cache_ttl)
         return d
 
     def mget(self, ids, index=None, doc_type=None, **query_params):
@@ -571,13 +728,29 @@ class Elasticsearch(object):
                              '_id': value})
 
         d = self._send_request(
-            'GET', path='/_mget', body={'docs': body}, params=query_params)
+            'GET', path='/_mget', body={'docs': body}, params=query_params,
+            hedge=True, coalesce=True)
         return d
 
-    def search(self, query, indexes=None, doc_type=None, **params):
-        """Execute a search against one or more indices."""
+    def search(
+        self, query, indexes=None, doc_type=None, cache_ttl=None, **params
+    ):
+        """
+        Execute a search against one or more indices.
+
+        :param float cache_ttl: seconds to cache the response for when the
+                                client has a cache, overriding its TTLs;
+                                0 bypasses the cache.
+        """
         indices = self._validate_indexes(indexes)
-        d = self._send_query('_search', query, indices, doc_type, **params)
+        options = {'stream': True}
+        if 'scroll' not in params:
+            # Opening a scroll context is neither repeatable nor cacheable,
+            # and every caller needs a scroll context of its own.
+            options.update(hedge=True, coalesce=True, cache=True,
+                           cache_ttl=cache_ttl)
+        d = self._send_query(
+            '_search', query, indices, doc_type, options=options, **params)
         return d
 
     def scan(self, query, *args, **kwargs):
@@ -595,17 +768,110 @@ class Elasticsearch(object):
         self, query, indexes=None, doc_type=None,
         scroll_timeout='10m', **params
     ):
-        """Start a scroll eventually returning a Scroller."""
+        """
+        Start a scroll eventually returning a Scroller.
+
+        ``scroller.hits()`` iterates over every hit, fetching pages ahead
+        and clearing the scroll when done (see
+        :class:`txes2.utils.HitIterator`).
+        """
         d = self.search(
             query=query, indexes=indexes, doc_type=doc_type,
             scroll=scroll_timeout, **params)
         d.addCallback(lambda results: Scroller(results, scroll_timeout, self))
         return d
 
-    def count(self, query, indexes=None, doc_types=None, **params):
-        """Execute a query against one or more indices & get the hit count."""
+    def sliced_scan(
+        self, query, callback, indexes=None, doc_type=None, slices=2,
+        max_concurrent_slices=None, scroll_timeout='10m', prefetch=1,
+        **params
+    ):
+        """
+        Scan through an index with several sliced scrolls at once.
+
+        The scan is split into ``slices`` independent scrolls with the
+        ``slice`` parameter, so that shards are read in parallel across the
+        nodes. Every hit is passed to ``callback(hit, slice_id)``, which may
+        return a Deferred to slow its slice down. Dispatch on ``slice_id``
+        to handle each slice separately, or ignore it to consume a single
+        stream.
+
+        Returns a Deferred firing with the number of hits. If a slice or
+        the callback fails, the other slices are stopped, every scroll is
+        cleared and the Deferred fails with the first error.
+
+        :param int max_concurrent_slices: slices scrolled at the same time,
+                                          defaults to all of them. Other
+                                          slices are opened as these finish.
+        :param int prefetch: pages fetched ahead per slice.
+        """
+        semaphore = defer.DeferredSemaphore(max_concurrent_slices or slices)
+        running = []
+        errors = []
+
+        @defer.inlineCallbacks
+        def scan_slice(slice_id):
+            if errors:
+                defer.returnValue(0)
+            sliced = dict(query or {})
+            if slices > 1:
+                sliced['slice'] = {'id': slice_id, 'max': slices}
+            try:
+                scroller = yield self.scan(
+                    sliced, indexes, doc_type, scroll_timeout, **params)
+                hits = scroller.hits(prefetch)
+                if errors:
+                    yield hits.close()
+                    defer.returnValue(0)
+                running.append(hits)
+                try:
+                    count = yield hits.each(
+                        lambda hit: callback(hit, slice_id))
+                finally:
+                    running.remove(hits)
+            except Exception:
+                errors.append(failure.Failure())
+                for other in list(running):
+                    other.close()
+                raise
+            defer.returnValue(count)
+
+        def done(results):
+            if errors:
+                return errors[0]
+            return sum(count for _, count in results)
+
+        d = defer.DeferredList(
+            [semaphore.run(scan_slice, i) for i in range(slices)],
+            consumeErrors=True)
+        return d.addCallback(done)
+
+    def search_after(self, query, indexes=None, doc_type=None, **kwargs):
+        """
+        Start paginating a search with ``search_after``.
+
+        Returns a Deferred firing with a :class:`txes2.utils.SearchAfter`
+        once its first page is fetched; see it for the keyword arguments,
+        the point in time option and resuming from a cursor.
+        ``paginator.hits()`` iterates over every hit.
+        """
+        return SearchAfter(self, query, indexes, doc_type, **kwargs).start()
+
+    def count(
+        self, query, indexes=None, doc_types=None, cache_ttl=None, **params
+    ):
+        """
+        Execute a query against one or more indices & get the hit count.
+
+        :param float cache_ttl: seconds to cache the response for when the
+                                client has a cache, overriding its TTLs;
+                                0 bypasses the cache.
+        """
         indices = self._validate_indexes(indexes)
-        d = self._send_query('_count', query, indices, doc_types, **params)
+        options = {'hedge': True, 'coalesce': True, 'cache': True,
+                   'cache_ttl': cache_ttl}
+        d = self._send_query(
+            '_count', query, indices, doc_types, options=options, **params)
         return d
 
     def update_settings(self, index, settings):
@@ -618,7 +884,13 @@ class Elasticsearch(object):
         self, index, doc_type, id, doc=None, script=None, script_file=None,
         params=None, upsert=None, **query_params
     ):
-        """Partially update a document with a script."""
+        """
+        Partially update a document with a script.
+
+        ``doc`` may be serialized JSON already, as for :meth:`index`. It is
+        sent as the body of its own request, so it may span several lines;
+        only bulk actions need single-line sources.
+        """
         if doc is None and script is None and script_file is None:
             raise exceptions.InvalidQuery(
                 'script, script_file or doc cannot all be None')
@@ -633,13 +905,36 @@ class Elasticsearch(object):
                 cmd['params'] = params
             if upsert:
                 cmd['upsert'] = upsert
+        elif isinstance(doc, basestring):
+            if isinstance(doc, unicode):
+                doc = doc.encode('utf-8')
+            cmd = serializers.RawJSON(b'{"doc":' + doc + b'}')
         else:
             cmd = {'doc': doc}
 
         path = make_path([index, doc_type, id, '_update'])
         d = self._send_request('POST', path, cmd, params=query_params)
+        d.addBoth(self._invalidate, index)
         return d
 
+    def stats(self):
+        """
+        Return a snapshot of the client's metrics.
+
+        Includes request, response, retry and byte counters, latency
+        histograms per phase, endpoint and node, gauges such as the current
+        adaptive bulk size, connection pool usage and, when caching, the
+        cache hit rate. Register callbacks for individual
+        requests with ``es.connection.metrics.add_hook`` (see
+        :mod:`txes2.metrics`).
+        """
+        stats = self.connection.stats()
+        if self.cache is not None:
+            stats['cache'] = {
+                'entries': len(self.cache), 'bytes': self.cache.size,
+                'hits': self.cache.hits, 'misses': self.cache.misses}
+        return stats
+
     @property
     def servers(self):
         """Return a list of servers available for connections."""
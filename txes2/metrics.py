@@ -0,0 +1,179 @@
+"""Request instrumentation: hooks, counters and latency histograms."""
+
+import bisect
+import collections
+
+from twisted.python import log
+
+
+#: Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    float('inf'))
+
+#: Events hooks can be registered for.
+EVENTS = ('request_started', 'retry', 'node_dead', 'response')
+
+
+def endpoint_name(path):
+    """
+    Name the API endpoint ``path`` belongs to.
+
+    The first ``_``-prefixed component names the endpoint (``_search``,
+    ``_bulk``, ``_mget``...), paths without one address a document.
+    """
+    path = path.split('?', 1)[0]
+    for component in path.split('/'):
+        if component.startswith('_'):
+            return component
+    return '/' if path == '/' else '_doc'
+
+
+class Histogram(object):
+
+    """A fixed-bucket histogram of latencies."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, percentile):
+        """Return the upper bound of the bucket holding ``percentile``."""
+        if not self.count:
+            return None
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': collections.OrderedDict(
+                (str(bound), count)
+                for bound, count in zip(self.buckets, self.counts)),
+        }
+
+
+class Metrics(object):
+
+    """
+    Counters and latency histograms describing a connection's traffic.
+
+    Callbacks registered with :meth:`add_hook` are called with a dict
+    describing the event:
+
+    - ``request_started``: ``method``, ``path``, ``serialize`` (seconds
+      spent encoding and compressing the body) and ``bytes_out``.
+    - ``retry``: ``method``, ``path``, ``attempt`` and ``error``.
+    - ``node_dead``: ``server`` and ``error``.
+    - ``response``: ``method``, ``path``, ``server``, ``status``,
+      ``bytes_in`` and the per-phase timings ``wait`` (connecting, waiting
+      for a pooled connection and the request in flight, less
+      ``server_time``), ``server_time`` (the ``took`` ES reports, when
+      present), ``decode`` and ``total``.
+
+    ``gauges`` holds current values other components report, such as the
+    bulk sizes chosen by :class:`txes2.bulk.AdaptiveBulkSizer`.
+    """
+
+    def __init__(self):
+        self.hooks = collections.defaultdict(list)
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.endpoints = collections.defaultdict(Histogram)
+        self.nodes = collections.defaultdict(Histogram)
+        self.phases = collections.defaultdict(Histogram)
+        self.in_flight = 0
+
+    def add_hook(self, event, callback):
+        """Call ``callback(info)`` whenever ``event`` happens."""
+        if event not in EVENTS:
+            raise ValueError('Unknown event: {}'.format(event))
+        self.hooks[event].append(callback)
+
+    def remove_hook(self, event, callback):
+        self.hooks[event].remove(callback)
+
+    def _emit(self, event, info):
+        for callback in self.hooks.get(event, ()):
+            try:
+                callback(info)
+            except Exception:
+                log.err(None, 'Error in {} hook'.format(event))
+
+    def request_started(self, method, path, serialize, bytes_out):
+        self.counters['requests'] += 1
+        self.counters['bytes_out'] += bytes_out
+        self.phases['serialize'].observe(serialize)
+        self._emit('request_started', {
+            'method': method, 'path': path, 'serialize': serialize,
+            'bytes_out': bytes_out})
+
+    def retry(self, method, path, attempt, error):
+        self.counters['retries'] += 1
+        self._emit('retry', {
+            'method': method, 'path': path, 'attempt': attempt,
+            'error': error})
+
+    def node_dead(self, server, error):
+        self.counters['nodes_marked_dead'] += 1
+        self._emit('node_dead', {'server': server, 'error': error})
+
+    def attempt_started(self):
+        self.counters['attempts'] += 1
+        self.in_flight += 1
+
+    def attempt_failed(self):
+        self.counters['errors'] += 1
+        self.in_flight -= 1
+
+    def attempt_cancelled(self):
+        self.counters['cancelled'] += 1
+        self.in_flight -= 1
+
+    def response(self, method, path, server, status, bytes_in, wait,
+                 server_time, decode):
+        self.in_flight -= 1
+        total = wait + (server_time or 0) + decode
+        self.counters['responses'] += 1
+        self.counters['bytes_in'] += bytes_in
+        self.endpoints[endpoint_name(path)].observe(total)
+        self.nodes[server].observe(total)
+        self.phases['wait'].observe(wait)
+        self.phases['decode'].observe(decode)
+        if server_time is not None:
+            self.phases['server'].observe(server_time)
+        self._emit('response', {
+            'method': method, 'path': path, 'server': server,
+            'status': status, 'bytes_in': bytes_in, 'wait': wait,
+            'server_time': server_time, 'decode': decode, 'total': total})
+
+    def snapshot(self):
+        """Return a plain dict copy of every metric."""
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'in_flight': self.in_flight,
+            'phases': dict(
+                (k, h.snapshot()) for k, h in self.phases.items()),
+            'endpoints': dict(
+                (k, h.snapshot()) for k, h in self.endpoints.items()),
+            'nodes': dict(
+                (k, h.snapshot()) for k, h in self.nodes.items()),
+        }
@@ -0,0 +1,256 @@
+"""
+Export indexes to NDJSON files in the bulk format and import them back.
+
+An export holds an action line and a source line per document, as sent
+to ``_bulk``, so an import streams the file to ES as it is. Run with
+``python -m txes2.ndjson`` (see ``--help``).
+"""
+
+import argparse
+import gzip
+import json
+import mmap
+import shutil
+import sys
+import tempfile
+
+from twisted.internet import defer, task
+
+from . import serializers
+from .bulk import encode_bulk_action, make_bulk_action, send_batches
+from .elasticsearch import Elasticsearch
+
+
+def _open(output, compress=None):
+    """Return a file object for ``output`` and whether to close it."""
+    if not isinstance(output, basestring):
+        return output, False
+    if compress is None:
+        compress = output.endswith('.gz')
+    if compress:
+        return gzip.open(output, 'wb'), True
+    return open(output, 'wb'), True
+
+
+@defer.inlineCallbacks
+def export_ndjson(es, output, query=None, indexes=None, doc_type=None,
+                  scroll_timeout='10m', prefetch=1, compress=None):
+    """
+    Write every hit of a scan to ``output`` in the bulk format.
+
+    Hits are written one by one as the pages of the scroll arrive, so
+    only the pages being written and prefetched are held in memory.
+    Returns a Deferred firing with the number of documents written.
+
+    :param output: a path, gzip compressed when it ends with ``.gz`` or
+                   ``compress`` is True, or a file object opened in binary
+                   mode, which is left open.
+    :param dict query: the query to export, defaults to every document.
+    """
+    query = dict(query or {'query': {'match_all': {}}})
+    f, close = _open(output, compress)
+
+    def write(hit):
+        action = make_bulk_action(
+            'index', hit['_index'], hit.get('_type'), hit['_id'],
+            routing=hit.get('_routing'))
+        for chunk in encode_bulk_action(
+                es.codec, action, hit.get('_source', {})):
+            f.write(chunk)
+
+    try:
+        scroller = yield es.scan(query, indexes, doc_type, scroll_timeout)
+        count = yield scroller.hits(prefetch).each(write)
+    finally:
+        if close:
+            f.close()
+    defer.returnValue(count)
+
+
+def _op_type(data, start, end):
+    """Return the key of the action line between ``start`` and ``end``."""
+    quote = data.find(b'"', start, end)
+    return data[quote + 1:data.find(b'"', quote + 1, end)]
+
+
+def bulk_entries(data, codec=None, index=None, doc_type=None):
+    """
+    Yield an ``(action, chunks)`` entry per action of bulk formatted data.
+
+    ``data`` is a byte string or an mmap. Lines are located by searching
+    for newlines and each action is a single slice of ``data`` holding its
+    lines, without decoding them; the action is yielded as None (see
+    :func:`txes2.bulk.send_bulk`). Only when ``index`` or ``doc_type`` is
+    given are action lines decoded, with ``codec``, to replace them.
+    """
+    codec = codec or serializers.JSONCodec()
+    position, size = 0, len(data)
+    while position < size:
+        line_end = data.find(b'\n', position)
+        if line_end < 0:
+            line_end = size
+        if line_end == position:
+            position += 1
+            continue
+
+        end = line_end
+        if _op_type(data, position, line_end) != b'delete':
+            end = data.find(b'\n', line_end + 1)
+            if end < 0:
+                end = size
+        chunk = data[position:end + 1]
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n'
+
+        action = None
+        if index is not None or doc_type is not None:
+            action = codec.decode(chunk[:line_end - position])
+            meta = list(action.values())[0]
+            if index is not None:
+                meta['_index'] = index
+            if doc_type is not None:
+                meta['_type'] = doc_type
+            line = codec.encode(action)
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            chunk = line + chunk[line_end - position:]
+        yield action, [chunk]
+        position = end + 1
+
+
+def bulk_batches(entries, max_actions=1000, max_bytes=5 * 1024 * 1024):
+    """Group entries into batches of ``max_actions`` or ``max_bytes``."""
+    batch, size = [], 0
+    for entry in entries:
+        length = len(entry[1][0])
+        if batch and (len(batch) >= max_actions or
+                      size + length > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(entry)
+        size += length
+    if batch:
+        yield batch
+
+
+def _map(path):
+    """Memory-map ``path``, decompressing it first if gzip compressed."""
+    if path.endswith('.gz'):
+        f = tempfile.TemporaryFile()
+        with gzip.open(path, 'rb') as compressed:
+            shutil.copyfileobj(compressed, f)
+        f.flush()
+    else:
+        f = open(path, 'rb')
+    f.seek(0, 2)
+    if not f.tell():
+        return b'', f
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f
+
+
+def import_ndjson(es, path, index=None, doc_type=None, max_actions=1000,
+                  max_bytes=5 * 1024 * 1024, max_concurrent_requests=2,
+                  on_item=None, cooperate=task.cooperate):
+    """
+    Bulk index a file in the bulk format, as written by
+    :func:`export_ndjson`.
+
+    The file is memory-mapped and sent in batches of ``max_actions``
+    actions or ``max_bytes`` bytes, each action as the slice of the file
+    holding it (see :func:`bulk_entries`), with at most
+    ``max_concurrent_requests`` bulk requests in flight. A gzip
+    compressed file is decompressed to a temporary file first.
+
+    Returns a Deferred firing with a :class:`txes2.bulk.BulkResult`.
+
+    :param str index: index to import into instead of the file's.
+    :param str doc_type: type to import as instead of the file's.
+    """
+    data, f = _map(path)
+
+    def close(result):
+        if isinstance(data, mmap.mmap):
+            data.close()
+        f.close()
+        return result
+
+    entries = bulk_entries(data, es.codec, index, doc_type)
+    d = send_batches(
+        es, bulk_batches(entries, max_actions, max_bytes),
+        max_concurrent_requests, on_item, cooperate=cooperate)
+    return d.addBoth(close)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m txes2.ndjson',
+        description='Export an index to, or import it from, an NDJSON file '
+                    'in the bulk format.')
+    parser.add_argument('--server', action='append',
+                        help='ES server, may be repeated '
+                             '(default: 127.0.0.1:9200)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='request timeout (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+
+    export = commands.add_parser('export', help='write an index to a file')
+    export.add_argument('index', help='index (or indexes) to export')
+    export.add_argument('output', help='file to write, "-" for stdout; '
+                                       'gzip compressed if ending in .gz')
+    export.add_argument('--doc-type', help='type to export')
+    export.add_argument('--query', type=json.loads,
+                        help='query to export, as JSON')
+    export.add_argument('--scroll-timeout', default='10m',
+                        help='scroll timeout (default: %(default)s)')
+    export.add_argument('--prefetch', type=int, default=1,
+                        help='pages fetched ahead (default: %(default)s)')
+
+    load = commands.add_parser('import', help='bulk index a file')
+    load.add_argument('input', help='file to read')
+    load.add_argument('--index', help="index to import into instead of "
+                                      "the file's")
+    load.add_argument('--doc-type', help="type to import as instead of the "
+                                         "file's")
+    load.add_argument('--max-actions', type=int, default=1000,
+                      help='actions per request (default: %(default)s)')
+    load.add_argument('--max-bytes', type=int, default=5 * 1024 * 1024,
+                      help='bytes per request (default: %(default)s)')
+    load.add_argument('--concurrency', type=int, default=2,
+                      help='requests in flight (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+@defer.inlineCallbacks
+def run(options, output=sys.stderr):
+    """Run the command, writing a JSON summary line to ``output``."""
+    es = Elasticsearch(options.server or '127.0.0.1:9200', discover=False,
+                       timeout=options.timeout)
+    try:
+        if options.command == 'export':
+            target = options.output
+            if target == '-':
+                target = sys.stdout
+            count = yield export_ndjson(
+                es, target, options.query, options.index, options.doc_type,
+                options.scroll_timeout, options.prefetch)
+            summary = {'exported': count}
+        else:
+            result = yield import_ndjson(
+                es, options.input, options.index, options.doc_type,
+                options.max_actions, options.max_bytes, options.concurrency)
+            summary = {'success': result.success,
+                       'failed': len(result.failed),
+                       'retried': result.retried}
+    finally:
+        yield es.connection.close()
+    output.write(json.dumps(summary, sort_keys=True) + '\n')
+    defer.returnValue(summary)
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    task.react(lambda reactor: run(options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Retry policies for failed requests."""
+
+import random
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.error import ConnectError
+from twisted.web.client import ResponseFailed, RequestTransmissionFailed
+
+from . import exceptions
+
+
+def is_rejected_execution(error):
+    """Return True if ``error`` is an ES thread pool rejection (HTTP 429)."""
+    if not isinstance(error, exceptions.ElasticSearchException):
+        return False
+
+    if error.status != 429:
+        return False
+
+    info = '{} {}'.format(error, error.additional_info)
+    return ('es_rejected_execution_exception' in info or
+            'EsRejectedExecutionException' in info)
+
+
+class RetryPolicy(object):
+
+    """
+    Decide when and how soon failed requests are retried.
+
+    Retries are delayed with exponential backoff and full jitter, and are
+    limited by a client-wide budget: every request adds ``budget_ratio``
+    tokens (up to ``budget_burst``) and every retry spends one. Once the
+    budget is spent, failures are raised straight away instead of piling
+    more load onto an overloaded cluster.
+
+    :param int max_retries: retries allowed per request.
+    :param float backoff: base delay in seconds before the first retry.
+    :param float max_backoff: upper bound of any single delay in seconds.
+    :param float budget_ratio: retries allowed per request, or None to
+                               disable the budget.
+    :param int budget_burst: retries available before the ratio applies.
+    :param bool retry_rejected: retry ES thread pool rejections (429).
+    :param clock: ``IReactorTime`` used to schedule delays.
+    """
+
+    node_errors = (ConnectError, defer.TimeoutError, ResponseFailed,
+                   RequestTransmissionFailed)
+    node_statuses = (503, 504)
+
+    def __init__(self, max_retries=3, backoff=0.05, max_backoff=5.0,
+                 budget_ratio=0.2, budget_burst=10, retry_rejected=True,
+                 clock=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.retry_rejected = retry_rejected
+        self.tokens = budget_burst
+        self.clock = clock or reactor
+
+    def is_node_failure(self, error):
+        """Return True if the node that served the request looks down."""
+        if isinstance(error, self.node_errors):
+            return True
+        return getattr(error, 'status', None) in self.node_statuses
+
+    def is_retryable(self, error):
+        if self.is_node_failure(error):
+            return True
+        return self.retry_rejected and is_rejected_execution(error)
+
+    def record_request(self):
+        """Credit the retry budget for a new request."""
+        if self.budget_ratio is not None:
+            self.tokens = min(
+                self.budget_burst, self.tokens + self.budget_ratio)
+
+    def acquire_retry(self):
+        """Spend a retry from the budget, returning False if none are left."""
+        if self.budget_ratio is None:
+            return True
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number ``attempt + 1``."""
+        ceiling = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def sleep(self, attempt):
+        """Return a Deferred firing once the backoff for ``attempt`` ends."""
+        delay = self.delay(attempt)
+        if delay <= 0:
+            return defer.succeed(None)
+        return task.deferLater(self.clock, delay, lambda: None)
@@ -0,0 +1,300 @@
+"""Pluggable JSON codecs for encoding requests and decoding responses."""
+
+import json
+import re
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+class RawJSON(bytes):
+
+    """
+    JSON that is already serialized.
+
+    Codecs return it unchanged, so documents received as JSON (eg from a
+    message queue) can be indexed without being decoded and encoded
+    again. Plain byte strings given as documents are passed through as
+    well; wrapping them marks the intent.
+    """
+
+
+#: Arrays whose elements :class:`StreamingDecoder` decodes one by one: the
+#: hits of searches and scroll pages and the items of bulk responses.
+STREAMED_ARRAYS = (('hits', 'hits'), ('items',))
+
+_JSON_DECODER = json.JSONDecoder()
+_STRUCTURE = re.compile(br'[",\[\]{}]')
+_STRING_BODY = re.compile(br'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_WHITESPACE = re.compile(br'[ \t\n\r]*')
+
+
+class StreamingDecoder(object):
+
+    """
+    Decode a JSON body incrementally as its chunks are fed.
+
+    Each chunk is scanned for the structure of the document as it
+    arrives. The elements of the arrays at ``paths`` (object keys from the
+    top of the document) are decoded with the codec as soon as their bytes
+    are complete, and those bytes are dropped. Only the rest of the body
+    and the element being received are held as bytes, and the parsing is
+    spread over the chunks instead of being done in one pass at the end.
+    The rest of the body is decoded by :meth:`close`, which puts the
+    elements back in place.
+
+    When the codec has a ``raw_decode(data, index)`` method returning a
+    value decoded from ``data[index:]`` and where it ends, as
+    :class:`JSONCodec` does, complete elements are decoded with it
+    directly; the scan only walks the rest of the body and the elements
+    split across chunks.
+
+    :param codec: the codec decoding the elements and the rest of the body.
+    :param paths: the arrays to decode element by element, defaults to
+                  :data:`STREAMED_ARRAYS`.
+    """
+
+    def __init__(self, codec, paths=STREAMED_ARRAYS):
+        self.codec = codec
+        self._raw_decode = getattr(codec, 'raw_decode', None)
+        self.paths = frozenset(
+            tuple(key.encode('utf-8') for key in path) for path in paths)
+        self._reset()
+
+    def _reset(self):
+        self._buf = b''
+        self._pos = 0
+        # Start of the bytes not consumed yet, by the rest of the body or,
+        # in an array at one of ``paths``, by its current element.
+        self._mark = 0
+        self._rest = []
+        # A [kind, last key] pair per open object or array.
+        self._stack = []
+        self._in_string = False
+        self._expect_key = False
+        self._key_start = None
+        self._array = None
+        self._elements = {}
+
+    def feed(self, data):
+        self._buf += data
+        self._scan()
+
+        cut = self._mark
+        if self._array is None:
+            cut = self._pos if self._key_start is None else self._key_start
+            self._rest.append(self._buf[self._mark:cut])
+        self._buf = self._buf[cut:]
+        self._pos -= cut
+        self._mark = 0 if self._array is None else self._mark - cut
+        if self._key_start is not None:
+            self._key_start -= cut
+
+    def _scan(self):
+        buf, pos, stack = self._buf, self._pos, self._stack
+        tried = None
+        while True:
+            if (self._raw_decode is not None and pos != tried and
+                    self._in_array() and not buf[self._mark:pos].strip()):
+                tried = pos = _WHITESPACE.match(buf, pos).end()
+                if pos < len(buf) and buf[pos] not in b',]':
+                    try:
+                        value, end = self._raw_decode(buf, pos)
+                    except ValueError:
+                        # Incomplete, or invalid, which decoding the
+                        # element once scanned will report.
+                        end = None
+                    # A value ending the data may be a truncated number.
+                    if end is not None and end < len(buf):
+                        self._elements[self._array[0]].append(value)
+                        pos = self._mark = end
+                continue
+
+            if self._in_string:
+                pos = _STRING_BODY.match(buf, pos).end()
+                if pos >= len(buf) or buf[pos] != b'"':
+                    # The body ends within the string, maybe on a lone
+                    # backslash: wait for the rest.
+                    break
+                pos += 1
+                self._in_string = False
+                if self._key_start is not None:
+                    stack[-1][1] = buf[self._key_start + 1:pos - 1]
+                    self._key_start = None
+                continue
+
+            match = _STRUCTURE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            pos = match.end()
+            char = match.group()
+
+            if char == b'"':
+                self._in_string = True
+                if self._expect_key and self._array is None:
+                    self._key_start = pos - 1
+                self._expect_key = False
+            elif char == b'{':
+                stack.append([char, None])
+                self._expect_key = True
+            elif char == b'[':
+                path = self._path()
+                stack.append([char, None])
+                if path in self.paths:
+                    self._rest.append(buf[self._mark:pos])
+                    self._mark = pos
+                    self._array = path, len(stack)
+                    self._elements.setdefault(path, [])
+            elif char == b',':
+                self._expect_key = stack[-1][0] == b'{'
+                if self._in_array():
+                    self._element(buf[self._mark:pos - 1])
+                    self._mark = pos
+            else:
+                if char == b']' and self._in_array():
+                    self._element(buf[self._mark:pos - 1])
+                    self._mark = pos - 1
+                    self._array = None
+                stack.pop()
+        self._pos = pos
+
+    def _path(self):
+        """Return the keys leading to the current value, if all are keys."""
+        if all(kind == b'{' for kind, _ in self._stack):
+            return tuple(key for _, key in self._stack)
+
+    def _in_array(self):
+        """Return True if the scan is between elements of an array."""
+        return self._array is not None and len(self._stack) == self._array[1]
+
+    def _element(self, data):
+        if data.strip():
+            self._elements[self._array[0]].append(self.codec.decode(data))
+
+    def close(self):
+        incomplete = self._stack or self._in_string
+        self._rest.append(self._buf[self._mark:])
+        data = b''.join(self._rest)
+        elements = self._elements
+        self._reset()
+        if not data.strip():
+            return None
+        if incomplete:
+            raise ValueError('Incomplete JSON document')
+
+        result = self.codec.decode(data)
+        for path, values in elements.items():
+            target = result
+            for key in path[:-1]:
+                target = target[key.decode('utf-8')]
+            target[path[-1].decode('utf-8')] = values
+        return result
+
+
+class JSONCodec(object):
+
+    """Codec backed by the standard library ``json`` module."""
+
+    def __init__(self, **dumps_kwargs):
+        dumps_kwargs.setdefault('separators', (',', ':'))
+        self.dumps_kwargs = dumps_kwargs
+
+    def encode(self, obj):
+        if isinstance(obj, RawJSON):
+            return obj
+        return json.dumps(obj, **self.dumps_kwargs)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def raw_decode(self, data, index=0):
+        return _JSON_DECODER.raw_decode(data, index)
+
+    def decoder(self):
+        return StreamingDecoder(self)
+
+
+class UJSONCodec(JSONCodec):
+
+    """
+    Codec backed by ``ujson`` (or any module with the same interface).
+
+    :param module: an alternative module exposing ``dumps`` and ``loads``
+                   (eg ``orjson``), defaults to ``ujson``.
+    """
+
+    def __init__(self, module=None):
+        module = module or ujson
+        if module is None:
+            raise ImportError('ujson is required for UJSONCodec')
+        self.module = module
+
+    def encode(self, obj):
+        if isinstance(obj, RawJSON):
+            return obj
+        return self.module.dumps(obj)
+
+    def decode(self, data):
+        return self.module.loads(data)
+
+    # ujson can't decode a value at the start of a longer document.
+    raw_decode = None
+
+
+class RawCodec(object):
+
+    """
+    Codec that sends pre-serialized request bodies untouched.
+
+    Strings are sent as-is, anything else (eg bulk action metadata) is
+    encoded with ``encoder``. Responses are still decoded by ``encoder``,
+    as the client itself reads them (node discovery, bulk responses,
+    scrolls and the cache).
+
+    :param encoder: codec used to encode objects that are not already
+                    serialized and to decode responses, defaults to
+                    :class:`JSONCodec`.
+    """
+
+    def __init__(self, encoder=None):
+        self.encoder = encoder or JSONCodec()
+
+    def encode(self, obj):
+        if isinstance(obj, basestring):
+            return obj
+        return self.encoder.encode(obj)
+
+    def decode(self, data):
+        return self.encoder.decode(data)
+
+    def decoder(self):
+        return self.encoder.decoder()
+
+
+CODECS = {
+    'json': JSONCodec,
+    'ujson': UJSONCodec,
+    'raw': RawCodec,
+}
+
+
+def get_codec(codec=None):
+    """
+    Return a codec instance.
+
+    :param codec: a codec instance, one of the names in ``CODECS`` or None
+                  for the standard library codec.
+    """
+    if codec is None:
+        return JSONCodec()
+
+    if isinstance(codec, basestring):
+        try:
+            return CODECS[codec]()
+        except KeyError:
+            raise ValueError('Unknown codec: {}'.format(codec))
+
+    return codec
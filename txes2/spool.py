@@ -0,0 +1,229 @@
+"""Durable on-disk queue of bulk actions."""
+
+import mmap
+import os
+import struct
+import zlib
+
+from . import serializers
+
+
+#: Record header: payload length and CRC32 of the payload.
+_HEADER = struct.Struct('>II')
+
+
+def _crc(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+
+class _Segment(object):
+
+    """
+    A preallocated, memory-mapped file of records.
+
+    Each record is a header followed by its payload. The first invalid
+    header (zero filled space or a record torn by a crash) marks the end
+    of the segment.
+    """
+
+    def __init__(self, path, number, size):
+        self.path = path
+        self.number = number
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self.size = os.path.getsize(path)
+        self._file = open(path, 'r+b')
+        self.map = mmap.mmap(self._file.fileno(), self.size)
+        self.end = 0
+        while True:
+            record = self.read(self.end)
+            if record is None:
+                break
+            self.end = record[1]
+
+    def read(self, offset):
+        """Return the payload at ``offset`` and the next offset, or None."""
+        if offset + _HEADER.size > self.size:
+            return None
+        length, crc = _HEADER.unpack_from(self.map, offset)
+        start = offset + _HEADER.size
+        if not length or start + length > self.size:
+            return None
+        payload = self.map[start:start + length]
+        if _crc(payload) != crc:
+            return None
+        return payload, start + length
+
+    def write(self, payload):
+        """Append a record, returning False if it does not fit."""
+        end = self.end + _HEADER.size + len(payload)
+        if end > self.size:
+            return False
+        start = self.end + _HEADER.size
+        self.map[start:end] = payload
+        _HEADER.pack_into(self.map, self.end, len(payload), _crc(payload))
+        self.end = end
+        return True
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+
+class BulkSpool(object):
+
+    """
+    An append-only queue of bulk actions in memory-mapped segment files.
+
+    Actions are appended to the last segment and read back from the read
+    position. Once ES has accepted them, :meth:`commit` records the
+    position durably and deletes the segments before it. Reopening a spool
+    replays every action that was not committed, so actions survive both
+    cluster outages and restarts while the process only holds the batch
+    being sent in memory. Actions may be sent more than once around a
+    crash or an outage.
+
+    It has the interface of :class:`txes2.bulk.BulkBuffer`, so it can be
+    given to a :class:`txes2.bulk.BulkProcessor` as its ``spool``.
+
+    :param str path: directory holding the segment files.
+    :param int segment_size: size in bytes of each segment file.
+    :param codec: codec the actions were encoded with.
+    :param bool sync: flush every append to disk before returning.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, codec=None,
+                 sync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.codec = codec or serializers.JSONCodec()
+        self.sync = sync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.committed = self._read_commit()
+        numbers = sorted(int(name[:-4]) for name in os.listdir(path)
+                         if name.endswith('.seg'))
+        self.segments = []
+        for number in numbers:
+            if number < self.committed[0]:
+                os.remove(self._segment_path(number))
+            else:
+                self.segments.append(_Segment(
+                    self._segment_path(number), number, segment_size))
+        if not self.segments:
+            self._add_segment(self.committed[0])
+        self.rewind()
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '{:020d}.seg'.format(number))
+
+    def _commit_path(self):
+        return os.path.join(self.path, 'commit')
+
+    def _read_commit(self):
+        try:
+            with open(self._commit_path()) as f:
+                segment, offset = f.read().split()
+        except (IOError, ValueError):
+            return (0, 0)
+        return (int(segment), int(offset))
+
+    def _add_segment(self, number, size=0):
+        segment = _Segment(
+            self._segment_path(number), number,
+            max(self.segment_size, size))
+        self.segments.append(segment)
+        return segment
+
+    def __len__(self):
+        return self.count
+
+    def _records(self, position):
+        """Yield ``(payload, next_position)`` from ``position`` on."""
+        number, offset = position
+        for segment in self.segments:
+            if segment.number < number:
+                continue
+            if segment.number > number:
+                offset = 0
+            while offset < segment.end:
+                payload, offset = segment.read(offset)
+                yield payload, (segment.number, offset)
+
+    def append(self, action, chunks):
+        """Write a bulk action, already encoded to ``chunks``."""
+        payload = b''.join(chunks)
+        segment = self.segments[-1]
+        if not segment.write(payload):
+            segment = self._add_segment(
+                segment.number + 1, _HEADER.size + len(payload))
+            segment.write(payload)
+        if self.sync:
+            segment.flush()
+        self.count += 1
+        self.size += len(payload)
+
+    def take(self, max_actions=None, max_bytes=None):
+        """
+        Read the next ``(action, chunks)`` entries.
+
+        Takes at least one entry and as many more as fit in
+        ``max_actions`` and ``max_bytes``. They stay in the spool until
+        :meth:`commit` is called with the position they end at.
+        """
+        entries = []
+        size = 0
+        for payload, position in self._records(self.position):
+            if entries and (
+                    (max_actions is not None and
+                     len(entries) >= max_actions) or
+                    (max_bytes is not None and
+                     size + len(payload) > max_bytes)):
+                break
+            action = self.codec.decode(payload[:payload.index(b'\n')])
+            entries.append((action, [payload]))
+            size += len(payload)
+            self.position = position
+
+        self.count -= len(entries)
+        self.size -= size
+        return entries
+
+    def commit(self, position):
+        """Durably mark everything before ``position`` as sent."""
+        for segment in self.segments:
+            if segment.number <= position[0]:
+                segment.flush()
+
+        path = self._commit_path()
+        with open(path + '.tmp', 'w') as f:
+            f.write('{} {}\n'.format(*position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        self.committed = position
+
+        while (len(self.segments) > 1 and
+               self.segments[0].number < position[0]):
+            segment = self.segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    def rewind(self):
+        """Move the read position back to the last commit."""
+        self.position = self.committed
+        self.count, self.size = 0, 0
+        for payload, _ in self._records(self.position):
+            self.count += 1
+            self.size += len(payload)
+
+    def close(self):
+        for segment in self.segments:
+            segment.flush()
+            segment.close()
+        self.segments = []
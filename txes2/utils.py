@@ -1,15 +1,94 @@
+import base64
+import collections
+import copy
+import heapq
+import itertools
+import json
 import time
 import random
 
-from urllib import quote
+from urllib import quote, unquote
+
+from twisted.internet import defer
+from twisted.python import failure, log
 
 from . import exceptions
 
 
+_QUOTED_LIMIT = 10000
+_quoted = {}
+
+
+def quote_component(component):
+    """Quote a path component, memoizing index, type and endpoint names."""
+    if not isinstance(component, basestring):
+        return quote(str(component), '')
+
+    try:
+        return _quoted[component]
+    except KeyError:
+        pass
+
+    if len(_quoted) >= _QUOTED_LIMIT:
+        # Mostly unique document ids; start again so the hot names return.
+        _quoted.clear()
+    quoted = _quoted[component] = quote(str(component), '')
+    return quoted
+
+
 def make_path(components):
     """Build a path from a list of components."""
-    return '/{}'.format(
-        '/'.join([quote(str(c), '') for c in components if c]))
+    return '/' + '/'.join([quote_component(c) for c in components if c])
+
+
+def path_indexes(path):
+    """Return the indexes named by the first component of ``path``."""
+    return unquote(path.lstrip('/').split('/', 1)[0]).split(',')
+
+
+def request_key(method, path, body=None, params=None):
+    """Build a canonical, hashable key identifying a request."""
+    if body is not None and not isinstance(body, basestring):
+        body = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    if params:
+        params = tuple(sorted(params.items()))
+    return (method, path, body, params or None)
+
+
+class SingleFlight(object):
+
+    """
+    Share one in-flight Deferred between identical concurrent calls.
+
+    Every caller gets its own Deferred. Each one but the last receives a
+    deep copy of the result, so callers can mutate what they are given.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+
+    def call(self, key, f, *args, **kwargs):
+        waiter = defer.Deferred()
+        waiters = self.in_flight.get(key)
+        if waiters is not None:
+            waiters.append(waiter)
+            return waiter
+
+        self.in_flight[key] = [waiter]
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._release, key)
+        return waiter
+
+    def _release(self, result, key):
+        waiters = self.in_flight.pop(key)
+        last = len(waiters) - 1
+        for i, waiter in enumerate(waiters):
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            elif i < last:
+                waiter.callback(copy.deepcopy(result))
+            else:
+                waiter.callback(result)
 
 
 class Scroller(object):
@@ -33,7 +112,8 @@ class Scroller(object):
         """Fetch next page from scroll API."""
         d = self.es._send_request(
             'POST', '_search/scroll',
-            {'scroll': self.scroll_timeout, 'scroll_id': self.scroll_id})
+            {'scroll': self.scroll_timeout, 'scroll_id': self.scroll_id},
+            stream=True)
         d.addCallback(self._set_results)
         return d
 
@@ -57,27 +137,518 @@ class Scroller(object):
             'DELETE', '_search/scroll',
             body={'scroll_id': [self.scroll_id]}).addCallback(_clear_scroll)
 
+    def hits(self, prefetch=1):
+        """
+        Iterate over the hits of every page, see :class:`HitIterator`.
+
+        The scroll is cleared once the iteration ends.
+        """
+        return HitIterator(self, prefetch)
+
+
+class HitIterator(object):
+
+    """
+    Iterate over the hits of a paged search, fetching pages ahead.
+
+    Up to ``prefetch`` pages are fetched while the current one is being
+    consumed, so the round trips overlap with the caller's processing.
+    ``source`` is a :class:`Scroller` or any object with its ``results``,
+    ``next_page()`` and ``delete()``. ``delete`` is called once the hits
+    run out, a page fails or :meth:`close` is called, so that no search
+    context is left open on the cluster.
+
+    Either call :meth:`next` until it fires with None::
+
+        hits = scroller.hits(prefetch=2)
+        while True:
+            hit = yield hits.next()
+            if hit is None:
+                break
+
+    or give every hit to a callback with :meth:`each`.
+    """
+
+    def __init__(self, source, prefetch=1):
+        self.source = source
+        self.prefetch = max(prefetch, 1)
+        self.closed = False
+        self._hits = collections.deque()
+        self._pages = collections.deque()
+        self._fetching = False
+        self._exhausted = False
+        self._error = None
+        self._waiter = None
+        self._closing = None
+
+        if source.results and source.results['hits']['hits']:
+            self._hits.extend(source.results['hits']['hits'])
+        else:
+            self._exhausted = True
+        self._fetch()
+
+    def _fetch(self):
+        if (self._fetching or self._exhausted or self._error or
+                self.closed or len(self._pages) >= self.prefetch):
+            return
+        self._fetching = True
+        d = self.source.next_page()
+        d.addCallbacks(self._fetched, self._failed)
+
+    def _fetched(self, results):
+        self._fetching = False
+        if results is None:
+            self._exhausted = True
+        else:
+            self._pages.append(results['hits']['hits'])
+        self._fetch()
+        self._wake()
+
+    def _failed(self, reason):
+        self._fetching = False
+        self._error = reason
+        self._wake()
+
+    def _wake(self):
+        if self.closed:
+            if not self._fetching and self._closing is not None:
+                closing, self._closing = self._closing, None
+                closing.callback(None)
+        elif self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            self._next().chainDeferred(waiter)
+
+    def _next(self):
+        if not self._hits and self._pages:
+            self._hits.extend(self._pages.popleft())
+            self._fetch()
+        if self._hits:
+            return defer.succeed(self._hits.popleft())
+
+        if self._error is not None:
+            error = self._error
+            return self.close().addCallback(lambda _: error)
+        if self._exhausted:
+            return self.close()
+
+        self._waiter = defer.Deferred()
+        return self._waiter
+
+    def next(self):
+        """
+        Return a Deferred firing with the next hit, or None after the last.
+
+        Fails with the error of a page that could not be fetched. Only call
+        it again once the previous Deferred has fired.
+        """
+        if self.closed:
+            return defer.succeed(None)
+        return self._next()
+
+    @defer.inlineCallbacks
+    def each(self, callback):
+        """
+        Call ``callback(hit)`` for every hit, waiting on what it returns.
+
+        Returns a Deferred firing with the number of hits once the search
+        context is cleared. An error from ``callback`` stops the iteration.
+        """
+        count = 0
+        try:
+            while True:
+                hit = yield self.next()
+                if hit is None:
+                    break
+                yield callback(hit)
+                count += 1
+        finally:
+            yield self.close()
+        defer.returnValue(count)
+
+    def close(self):
+        """
+        Stop iterating and delete the search context.
+
+        Waits for a page being fetched, so that its context is the one
+        deleted. Errors deleting it are logged rather than raised.
+        """
+        if self.closed:
+            return defer.succeed(None)
+        self.closed = True
+        self._hits.clear()
+        self._pages.clear()
+        if self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            waiter.callback(None)
+
+        d = defer.succeed(None)
+        if self._fetching:
+            d = self._closing = defer.Deferred()
+        d.addCallback(lambda _: self.source.delete())
+        d.addErrback(log.err, 'Error deleting search context')
+        d.addCallback(lambda _: None)
+        return d
+
+
+class SearchAfter(object):
+
+    """
+    Page through a search with ``search_after``.
+
+    Each page asks for the hits sorted after the last hit of the previous
+    page, so every page costs the same however deep it is, and nothing is
+    held open on the cluster unless ``keep_alive`` is given. The sort of
+    ``query`` is completed with ``tiebreaker`` so that hits with equal
+    sort values are neither skipped nor repeated.
+
+    With ``keep_alive``, the pages are read from a point in time opened on
+    the indexes, so they see a consistent snapshot. :meth:`delete` closes
+    it. It has the interface of :class:`Scroller`, so :meth:`hits`
+    iterates over the hits with prefetching.
+
+    :attr:`cursor` is a token to resume from after the last page fetched,
+    :meth:`cursor_after` one to resume from after a given hit. A cursor is
+    given back as ``cursor`` to carry on from there.
+
+    :param int page_size: hits per page.
+    :param str tiebreaker: unique field added to the sort, defaults to
+                           ``_shard_doc`` with a point in time and ``_id``
+                           otherwise.
+    :param str keep_alive: how long to keep the point in time open between
+                           pages (eg ``'1m'``), or None to not use one.
+    :param str cursor: a cursor to resume from.
+    """
+
+    def __init__(self, es, query, indexes=None, doc_type=None,
+                 page_size=100, tiebreaker=None, keep_alive=None,
+                 cursor=None, **params):
+        self.es = es
+        self.indexes = indexes
+        self.doc_type = doc_type
+        self.keep_alive = keep_alive
+        self.params = params
+        self.results = None
+        self.pit_id = None
+        self.search_after = None
+
+        query = dict(query or {})
+        query['size'] = page_size
+        sort = query.get('sort') or []
+        if not isinstance(sort, list):
+            sort = [sort]
+        if tiebreaker is None:
+            tiebreaker = '_shard_doc' if keep_alive else '_id'
+        fields = [f if isinstance(f, basestring) else list(f)[0]
+                  for f in sort]
+        if tiebreaker not in fields:
+            sort = sort + [tiebreaker]
+        query['sort'] = sort
+        self.query = query
+
+        if cursor is not None:
+            self.search_after, self.pit_id = self.decode_cursor(cursor)
+
+    @staticmethod
+    def encode_cursor(search_after, pit_id=None):
+        data = json.dumps([search_after, pit_id], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data)
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            search_after, pit_id = json.loads(
+                base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise exceptions.InvalidQuery('Invalid cursor: {}'.format(cursor))
+        return search_after, pit_id
+
+    @property
+    def cursor(self):
+        """A token to resume from after the last page fetched."""
+        return self.encode_cursor(self.search_after, self.pit_id)
+
+    def cursor_after(self, hit):
+        """A token to resume from after ``hit``."""
+        return self.encode_cursor(hit['sort'], self.pit_id)
+
+    def start(self):
+        """Fetch the first page, opening a point in time if needed."""
+        d = defer.succeed(None)
+        if self.keep_alive and self.pit_id is None:
+            indices = self.es._validate_indexes(self.indexes)
+            d = self.es._send_request(
+                'POST', make_path([','.join(indices), '_pit']),
+                params={'keep_alive': self.keep_alive})
+            d.addCallback(self._set_pit)
+        d.addCallback(lambda _: self.next_page())
+        d.addCallback(lambda _: self)
+        return d
+
+    def _set_pit(self, result):
+        self.pit_id = result['id']
+
+    def next_page(self):
+        """Fetch the page after the last one."""
+        query = dict(self.query)
+        if self.search_after is not None:
+            query['search_after'] = self.search_after
+        if self.pit_id is not None:
+            query['pit'] = {'id': self.pit_id,
+                            'keep_alive': self.keep_alive or '1m'}
+            d = self.es._send_request(
+                'GET', '/_search', body=query, params=self.params,
+                stream=True)
+        else:
+            d = self.es.search(
+                query, self.indexes, self.doc_type, cache_ttl=0,
+                **self.params)
+        d.addCallback(self._set_results)
+        return d
+
+    def _set_results(self, results):
+        self.pit_id = results.get('pit_id', self.pit_id)
+        hits = results['hits']['hits']
+        if not hits:
+            self.results = None
+        else:
+            self.results = results
+            self.search_after = hits[-1]['sort']
+        return self.results
+
+    def delete(self):
+        """Close the point in time, if any."""
+        if self.pit_id is None:
+            return
+
+        def _closed(result):
+            self.pit_id = None
+
+        return self.es._send_request(
+            'DELETE', '/_pit', body={'id': self.pit_id}).addCallback(_closed)
+
+    def hits(self, prefetch=1):
+        """
+        Iterate over the hits of every page, see :class:`HitIterator`.
+
+        The point in time is closed once the iteration ends.
+        """
+        return HitIterator(self, prefetch)
+
+
+class RandomSelector(object):
+
+    """Pick a node uniformly at random."""
+
+    def select(self, servers):
+        return random.choice(servers)
+
+    def start(self, server):
+        pass
+
+    def finish(self, server, latency, failed=False):
+        pass
+
+    def cancel(self, server):
+        pass
+
+    def forget(self, server):
+        pass
+
+
+class RoundRobinSelector(RandomSelector):
+
+    """Cycle through the nodes in order."""
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def select(self, servers):
+        return servers[next(self._counter) % len(servers)]
+
+
+class LatencySelector(RandomSelector):
+
+    """
+    Pick the less loaded of two random nodes (power of two choices).
+
+    Each node is scored by an exponentially weighted moving average of its
+    response latency multiplied by the number of requests in flight to it,
+    so slow or busy nodes receive a smaller share of the traffic. Nodes
+    without any recorded latency are assumed to be as fast as the mean of
+    the others, or ``initial_latency`` when none has been recorded yet, so
+    they are tried without being flooded before their first response.
+
+    :param float decay: weight given to the newest latency sample.
+    :param float failure_penalty: latency in seconds recorded for a failed
+                                  request.
+    :param float initial_latency: latency in seconds assumed before any
+                                  has been recorded.
+    """
+
+    def __init__(self, decay=0.3, failure_penalty=1.0, initial_latency=0.01):
+        self.decay = decay
+        self.failure_penalty = failure_penalty
+        self.initial_latency = initial_latency
+        self.latency = {}
+        self.in_flight = collections.defaultdict(int)
+
+    def cost(self, server):
+        latency = self.latency.get(server)
+        if latency is None:
+            if self.latency:
+                latency = sum(self.latency.values()) / len(self.latency)
+            else:
+                latency = self.initial_latency
+        return latency * (self.in_flight[server] + 1)
+
+    def select(self, servers):
+        if len(servers) == 1:
+            return servers[0]
+
+        first, second = random.sample(servers, 2)
+        if self.cost(second) < self.cost(first):
+            return second
+        return first
+
+    def start(self, server):
+        self.in_flight[server] += 1
+
+    def finish(self, server, latency, failed=False):
+        if self.in_flight[server] > 0:
+            self.in_flight[server] -= 1
+
+        if failed:
+            latency = max(latency, self.failure_penalty)
+
+        previous = self.latency.get(server)
+        if previous is None:
+            self.latency[server] = latency
+        else:
+            self.latency[server] = (
+                self.decay * latency + (1 - self.decay) * previous)
+
+    def cancel(self, server):
+        if self.in_flight[server] > 0:
+            self.in_flight[server] -= 1
+
+    def forget(self, server):
+        self.latency.pop(server, None)
+
+
+SELECTORS = {
+    'random': RandomSelector,
+    'round_robin': RoundRobinSelector,
+    'latency': LatencySelector,
+}
+
+
+def get_selector(selector=None):
+    """Return a node selector instance from a name or instance."""
+    if selector is None:
+        return LatencySelector()
+
+    if isinstance(selector, basestring):
+        try:
+            return SELECTORS[selector]()
+        except KeyError:
+            raise ValueError('Unknown selector: {}'.format(selector))
+
+    return selector
+
 
 class ServerList(list):
-    def __init__(self, servers, retry_time=10, timeout=None):
+
+    """
+    The nodes requests can be sent to.
+
+    Nodes that fail are moved to ``dead``, a heap ordered by the time they
+    may next be tried. Once that time passes a node re-enters the list in a
+    half-open state where it only receives ``half_open_ratio`` of the
+    traffic until a request to it succeeds. When ``health_checking`` is
+    enabled dead nodes are only revived by :meth:`revive`, after a
+    successful probe from a :class:`txes2.connection_http.HealthChecker`.
+    """
+
+    def __init__(self, servers, retry_time=10, timeout=None, selector=None,
+                 half_open_ratio=0.1, health_checking=False):
         list.__init__(self, servers)
         self.dead = []
+        self.half_open = set()
         self.retry_time = retry_time
         self.timeout = timeout
+        self.selector = get_selector(selector)
+        self.half_open_ratio = half_open_ratio
+        self.health_checking = health_checking
+
+    def get(self, exclude=None):
+        """
+        Pick a node for the next request.
+
+        :param exclude: a node to avoid if any other is available.
+        """
+        if not self.health_checking:
+            for server in self.pop_due():
+                self.revive(server)
 
-    def get(self):
-        if self.dead:
-            retry_time, server = self.dead.pop()
-            if retry_time > time.time():
-                self.dead.append((retry_time, server))
-            else:
-                self.append(server)
         if not self:
             raise exceptions.NoServerAvailable()
 
-        return random.choice(self)
+        candidates = self
+        if exclude is not None and len(self) > 1:
+            candidates = [s for s in self if s != exclude]
+
+        server = self.selector.select(candidates)
+        if (server in self.half_open and
+                any(s not in self.half_open for s in candidates) and
+                random.random() >= self.half_open_ratio):
+            closed = [s for s in candidates if s not in self.half_open]
+            server = self.selector.select(closed)
+
+        return server
 
     def mark_dead(self, server):
         if server in self:
             self.remove(server)
-            self.dead.insert(0, (time.time() + self.retry_time, server))
+            self.half_open.discard(server)
+            self.selector.forget(server)
+            self.reschedule(server)
+
+    def pop_due(self):
+        """Remove and return the dead nodes whose retry time has passed."""
+        now = time.time()
+        due = []
+        while self.dead and self.dead[0][0] <= now:
+            due.append(heapq.heappop(self.dead)[1])
+        return due
+
+    def reschedule(self, server):
+        """Park a dead node until ``retry_time`` seconds from now."""
+        heapq.heappush(self.dead, (time.time() + self.retry_time, server))
+
+    def revive(self, server):
+        """Put a node back into rotation in the half-open state."""
+        if server not in self:
+            # Requests that failed after the node was marked dead have
+            # recorded penalties since; start it from a clean score.
+            self.selector.forget(server)
+            self.append(server)
+            self.half_open.add(server)
+
+    def start_request(self, server):
+        """Record that a request to ``server`` has started."""
+        self.selector.start(server)
+
+    def finish_request(self, server, latency, failed=False):
+        """Record the outcome of a request to ``server``."""
+        self.selector.finish(server, latency, failed)
+        if not failed:
+            self.half_open.discard(server)
+
+    def cancel_request(self, server):
+        """
+        Record that a request to ``server`` was cancelled unanswered.
+
+        It says nothing of the node, so neither its latency nor its
+        half-open state change.
+        """
+        self.selector.cancel(server)